@@ -0,0 +1,51 @@
+"""
+Compare cache formats: file size and load time of all_users/all_service_principals
+like values.
+
+  python -m benchmarks.cache_serialization [number of principals]
+"""
+import sys
+import time
+import uuid
+
+from catharsis.cache_serialization import SERIALIZATION_FORMATS, dumps, loads
+from catharsis.typedefs import Principal, PrincipalType, ServicePrincipalDetails, ServicePrincipalType, UserPrincipalDetails
+
+
+def make_principals(n: int) -> dict[str, Principal]:
+  result = {}
+  for i in range(n):
+    principal_id = str(uuid.UUID(int=i))
+    if i % 5:
+      result[principal_id] = Principal(id=principal_id, displayName=f'User {i}', accountEnabled=i % 7 != 0, raw=None,
+                                       usertype=PrincipalType.User, userDetails=UserPrincipalDetails(upn=f'user{i}@example.com'))
+    else:
+      result[principal_id] = Principal(id=principal_id, displayName=f'App {i}', accountEnabled=True, raw=None,
+                                       usertype=PrincipalType.ServicePrincipal,
+                                       spDetails=ServicePrincipalDetails(ServicePrincipalType.Application, None, 'Example'))
+  return result
+
+
+def best_of(fn, repeat=3) -> float:
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    timings.append(time.perf_counter() - start)
+  return min(timings)
+
+
+def main(n: int):
+  principals = make_principals(n)
+  print(f'{n} principals')
+  print(f'{"format":<8} {"size (KiB)":>12} {"dump (s)":>10} {"load (s)":>10}')
+  for serialization_format in SERIALIZATION_FORMATS:
+    data = dumps(principals, serialization_format)
+    assert loads(data) == principals
+    dump_time = best_of(lambda: dumps(principals, serialization_format))
+    load_time = best_of(lambda: loads(data))
+    print(f'{serialization_format:<8} {len(data) / 1024:>12.0f} {dump_time:>10.3f} {load_time:>10.3f}')
+
+
+if __name__ == '__main__':
+  main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -1,8 +1,11 @@
+import asyncio
 import os
 from typing import List, Tuple, Callable, Mapping, TypeAlias, Set
 
 from catharsis.graph_query import cached_query, ensure_cache_matches, get_group_transitive_members, get_msgraph_client
 from catharsis.ms_credential import get_ms_credential
+from catharsis.request_scheduler import scheduled, ARM_ENDPOINT
+from catharsis import run_metrics
 from catharsis.typedefs import RunConf
 from azure.mgmt.resourcegraph.models import QueryRequest
 from azure.mgmt.resourcegraph.models import QueryRequestOptions
@@ -23,21 +26,27 @@ logger.setLevel(logging.INFO)
 get_az_result_path: Callable[[RunConf, str], str] = lambda runconf, fn: os.path.join(runconf.work_dir, fn)
 
 
+def _get_run_client(args: RunConf, client_cls):
+  # One client per type and run, sharing the run credential
+  clients = getattr(args, '_azure_clients', None)
+  if clients is None:
+    clients = args._azure_clients = {}
+  if client_cls not in clients:
+    clients[client_cls] = client_cls(credential=get_ms_credential(args), subscription_id=args.subscription_id)
+  return clients[client_cls]
+
 async def get_azrm_client(args: RunConf):
-  credential = get_ms_credential(args)
-  client = ResourceGraphClient(credential=credential, subscription_id=args.subscription_id)
+  client = _get_run_client(args, ResourceGraphClient)
   await ensure_cache_matches(args)
   return client
 
 async def get_azmgmt_client(args: RunConf):
-  credential = get_ms_credential(args)
-  client = ResourceManagementClient(credential=credential, subscription_id=args.subscription_id)
+  client = _get_run_client(args, ResourceManagementClient)
   await ensure_cache_matches(args)
   return client
 
 async def get_az_auth_mgmt_client(args: RunConf):
-  credential = get_ms_credential(args)
-  client = AuthorizationManagementClient(credential=credential, subscription_id=args.subscription_id)
+  client = _get_run_client(args, AuthorizationManagementClient)
   await ensure_cache_matches(args)
   return client
 
@@ -70,13 +79,15 @@ async def resource_graph_query(args: RunConf, kql_query: str):
   query.options = QueryRequestOptions(top=1000)
   result = []
   logger.info('Querying KQL: %s ..', kql_query[:50])
-  resp = client.resources(query)
+  resp = await scheduled(ARM_ENDPOINT, asyncio.to_thread, client.resources, query)
+  run_metrics.add_to_current('pages')
   result.extend(resp.data)
   while resp.skip_token:
     query = QueryRequest(query=SUBSCRIPTIONS_QUERY)
     logger.info('Querying for with skip_token: %s...', resp.skip_token[:50])
     query.options = QueryRequestOptions(skip_token=resp.skip_token)
-    resp = client.resources(query)
+    resp = await scheduled(ARM_ENDPOINT, asyncio.to_thread, client.resources, query)
+    run_metrics.add_to_current('pages')
     result.extend(resp.data)
   return result
 
@@ -121,10 +132,14 @@ def map_assignments(assignments):
     results.append(map_rbac_assignment(a))
   return results
 
+async def _list_assignments_for_scope(client: AuthorizationManagementClient, scope: str):
+  # The SDK client is synchronous: page through in a worker thread
+  return await scheduled(ARM_ENDPOINT, asyncio.to_thread, lambda: list(client.role_assignments.list_for_scope(scope)))
+
 async def get_mg_raw_assignments(args: RunConf, mg: CT.AzureMG) -> List[CT.AzureRBACAssignment]:
   async def fn():
     client = await get_az_auth_mgmt_client(args)
-    online_assignments = client.role_assignments.list_for_scope(mg.id)
+    online_assignments = await _list_assignments_for_scope(client, mg.id)
     return map_assignments(online_assignments)
   return await cached_query(args, c.mk_azure_mg_assignment_raw_path(args, mg.name), fn)
 
@@ -133,7 +148,7 @@ async def get_sub_raw_assignments(args: RunConf, sub: CT.AzureSub) -> List[CT.Az
   async def fn():
     client = await get_az_auth_mgmt_client(args)
     # This actually gets roles that are assigned above sub. Nice.
-    online_assignments = client.role_assignments.list_for_scope(sub.id)
+    online_assignments = await _list_assignments_for_scope(client, sub.id)
     return map_assignments(online_assignments)
   return await cached_query(args, c.mk_azure_sub_assignment_raw_path(args, sub.guid), fn)
 
@@ -1,8 +1,9 @@
-from typing import List, Tuple, Set
+from typing import FrozenSet, List, Tuple, Set
 from functools import cache
 from catharsis.common_apps import common_apps
-from catharsis.disjoint_sets import GroupMembers, split_to_disjoint_sets_ordered
-from catharsis.typedefs import CAGuid, GeneralInfo, PolicyModel, PrincipalGuid, UserTargetingDefinition, principal_to_string
+from catharsis.disjoint_sets import GroupMembers, PartitionIndex, get_partition_function, restrict_disjoint_sets, update_incremental_partition
+from catharsis.principal_index import PrincipalDisplayIndex, PrincipalIndex, TargetedPrincipals
+from catharsis.typedefs import CAGuid, GeneralInfo, PolicyModel, PrincipalIdx, UserTargetingDefinition
 from catharsis import utils
 
 from catharsis.utils import assignedmembers_to_id_set, filter_ca_defs
@@ -10,6 +11,10 @@ from catharsis.settings import ALL_CLIENT_APP_TYPES, META_APP_ALL_UNMETIONED_APP
 
 import catharsis.graph_query as queries
 
+import logging
+logger = logging.getLogger('catharsis.ca')
+logger.setLevel(logging.INFO)
+
 
 @cache
 def translate_app_guid(app_id):
@@ -35,25 +40,21 @@ def get_all_referenced_apps(ca_defs):
     apps.remove('None')
   return apps
 
+async def get_principal_display_index(args) -> PrincipalDisplayIndex:
+  """ One per run, shared by the targeting definitions of all policies and the report sections """
+  if getattr(args, '_principal_display_index', None) is None:
+    args._principal_display_index = PrincipalDisplayIndex(await queries.get_all_principals(args))
+  return args._principal_display_index
+
 async def create_targeting_definition(args, ca_policy) -> UserTargetingDefinition:
   udef = ca_policy['conditions']['users']
 
+  display_index = await get_principal_display_index(args)
   # TODO: Include also service principals
-  principals_by_ids = await queries.get_all_users(args)
+  user_ids = (await queries.get_all_users(args)).keys()
 
   def get_user_upns(udef):
-    if udef == ['All']:
-      uids = principals_by_ids.keys()
-    else:
-      uids = udef
-    result = []
-    for uid in uids:
-      principal = principals_by_ids.get(uid)
-      if principal:
-        result.append(principal_to_string(principal))
-      else:
-        result.append('Principal removed? %s' % uid)
-    return result
+    return TargetedPrincipals(display_index, None if udef == ['All'] else udef, all_ids=user_ids)
 
   utd = UserTargetingDefinition(
     included_users=get_user_upns(udef['includeUsers']),
@@ -67,40 +68,60 @@ async def create_targeting_definition(args, ca_policy) -> UserTargetingDefinitio
   )
   return utd
 
-async def resolve_members_for_policy_objects(args, user_selection) -> dict[CAGuid, Set[PrincipalGuid]]:
-  # policy_id guid: set of user guids (lowercase)
+async def get_principal_index(args) -> PrincipalIndex:
+  """
+  One index per run, covering all users. Populations are subsets of it,
+  so principal ids stay the same across report sections.
+  """
+  if getattr(args, '_principal_index', None) is None:
+    args._principal_index = PrincipalIndex((await queries.get_all_users(args)).keys())
+  return args._principal_index
+
+async def get_member_set(args, kind: str, object_id: str, index: PrincipalIndex) -> FrozenSet[PrincipalIdx]:
+  """
+  Transitive members of a group or role ('group', 'role') as principal ids.
+  Converted once per run and shared by all policies and report sections.
+  """
+  member_sets = getattr(args, '_member_sets', None)
+  if member_sets is None:
+    member_sets = args._member_sets = {}
+  key = (kind, object_id)
+  if key not in member_sets:
+    if kind == 'group':
+      members = await queries.get_group_transitive_members(args, object_id)
+    elif kind == 'role':
+      members = await queries.get_role_transitive_members(args, object_id)
+    else:
+      raise Exception('Unknown member object kind: %s' % kind)
+    member_sets[key] = frozenset(index.to_idx_set(assignedmembers_to_id_set(members)))
+  return member_sets[key]
+
+async def resolve_members_for_policy_objects(args, user_selection: Set[PrincipalIdx], index: PrincipalIndex) -> dict[CAGuid, Set[PrincipalIdx]]:
+  # policy_id guid: set of principal ids (see PrincipalIndex)
   memberships = {}
 
-  to_set = assignedmembers_to_id_set
+  async def member_sets(kind, object_ids):
+    return [await get_member_set(args, kind, object_id, index) for object_id in object_ids]
 
   ca_defs = await queries.get_ca_policy_defs(args)
   ca_defs = filter_ca_defs(args, ca_defs)
   for ca_policy in ca_defs:
     user_targeting = ca_policy['conditions']['users']
-    included: Set[PrincipalGuid] = set()
+    included: Set[PrincipalIdx]
     if user_targeting['includeUsers'] == ['All']:
-      included = user_selection.copy()
+      included = user_selection
     else:
-      for includedRoleId in user_targeting['includeRoles']:
-        included |= to_set(await queries.get_role_transitive_members(args, includedRoleId))
-      for includedGroupId in user_targeting['includeGroups']:
-        included |= to_set(await queries.get_group_transitive_members(args, includedGroupId))
-      for includedUserId in user_targeting['includeUsers']:
-        included.add(includedUserId)
+      included = set().union(
+        *await member_sets('role', user_targeting['includeRoles']),
+        *await member_sets('group', user_targeting['includeGroups']),
+        index.to_idx_set(user_targeting['includeUsers']))
       # FIXME: check includeGuestsOrExternalUsers
 
-    for excludedRoleId in user_targeting['excludeRoles']:
-      for excludedMember in to_set(await queries.get_role_transitive_members(args, excludedRoleId)):
-        if excludedMember in included:
-          included.remove(excludedMember)
-    for excludedGroupId in user_targeting['excludeGroups']:
-      for excludedMember in to_set(await queries.get_group_transitive_members(args, excludedGroupId)):
-        if excludedMember in included:
-          included.remove(excludedMember)
-    for excludedUserId in user_targeting['excludeUsers']:
-      # User can be already excluded through previous methods
-      if excludedUserId in included:
-        included.remove(excludedUserId)
+    # User can be already excluded through previous methods
+    included = included.difference(
+      *await member_sets('role', user_targeting['excludeRoles']),
+      *await member_sets('group', user_targeting['excludeGroups']),
+      index.to_idx_set(user_targeting['excludeUsers']))
     # FIXME: check excludeGuestsOrExternalUsers
 
     if user_selection:
@@ -139,16 +160,28 @@ def translate_session_controls(session_control_list):
   return session_controls
 
 
-async def create_policymodels(args, principal_selection) -> Tuple[List[PolicyModel], GeneralInfo]:
-  principal_ids: Set[str] = utils.principals_to_id_set(principal_selection)
+async def create_policymodels(args, principal_selection, population: str = 'all_users') -> Tuple[List[PolicyModel], GeneralInfo]:
+  """
+  population names principal_selection for --partition-backend incremental:
+  tasks modelling different principals keep their partitions apart.
+  """
+  index = await get_principal_index(args)
+  principal_ids: Set[PrincipalIdx] = index.to_idx_set(utils.principals_to_id_set(principal_selection))
+  split_to_disjoint_sets = get_partition_function(args.partition_backend)
 
   # Users
-  policy_user_memberships = await resolve_members_for_policy_objects(args, principal_ids)
+  policy_user_memberships = await resolve_members_for_policy_objects(args, principal_ids, index)
+  if index.unknown_guids:
+    # Service principals, devices, nested groups and removed users in groups, roles and user lists
+    logger.info('%d principals referenced by policies are not users and are left out of the user groups.', len(index.unknown_guids))
   policy_user_memberships['all_meta'] = principal_ids.copy()
 
   users_task = [GroupMembers(name=policy_id, members=members)
       for policy_id, members in policy_user_memberships.items()]
-  policy_user_groups, dja_user_groups = split_to_disjoint_sets_ordered(users_task)
+  if args.partition_backend == 'incremental':
+    policy_user_groups, dja_user_groups = update_incremental_partition(args, population, users_task, index)
+  else:
+    policy_user_groups, dja_user_groups = split_to_disjoint_sets(users_task)
   
   ca_defs = await queries.get_ca_policy_defs(args)
   ca_defs = filter_ca_defs(args, ca_defs)
@@ -160,7 +193,7 @@ async def create_policymodels(args, principal_selection) -> Tuple[List[PolicyMod
   policy_app_memberships = resolve_apps_for_policy_objects(args, all_apps, ca_defs)
   apps_task = [GroupMembers(name=policy_id, members=members)
       for policy_id, members in policy_app_memberships.items()]
-  policy_app_groups, dja_app_groups = split_to_disjoint_sets_ordered(apps_task)
+  policy_app_groups, dja_app_groups = split_to_disjoint_sets(apps_task)
 
   seen_grant_controls = set()
   seen_session_controls = set()
@@ -240,7 +273,49 @@ async def create_policymodels(args, principal_selection) -> Tuple[List[PolicyMod
     seen_session_controls=seen_session_controls,
     seen_app_user_actions=seen_app_user_actions,
     users_count=len(principal_ids),
-    apps_count=len(all_apps)
+    apps_count=len(all_apps),
+    principal_index=index,
+    user_partition=PartitionIndex(policy_user_groups, dja_user_groups),
+    app_partition=PartitionIndex(policy_app_groups, dja_app_groups)
   )
 
-  return policyModels, generalInfo
\ No newline at end of file
+  return policyModels, generalInfo
+
+
+def restrict_policymodels(policyModels: List[PolicyModel], generalInfo: GeneralInfo, principal_selection) -> Tuple[List[PolicyModel], GeneralInfo]:
+  """
+  Policy models for a subset of the principals given to create_policymodels.
+  Reuses the computed partition instead of resolving policies again.
+  """
+  index = generalInfo.principal_index
+  principal_ids: Set[PrincipalIdx] = index.to_idx_set(utils.principals_to_id_set(principal_selection))
+
+  policy_user_groups = {pm.id: pm.condition_usergroups for pm in policyModels}
+  policy_user_groups, dja_user_groups = restrict_disjoint_sets(policy_user_groups, generalInfo.disjoint_artificial_user_groups, principal_ids)
+
+  seen_grant_controls = set()
+  seen_session_controls = set()
+  seen_app_user_actions = set()
+
+  restricted_models = []
+  for pm in policyModels:
+    if not policy_user_groups[pm.id]:
+      # Policy targets nobody in this selection
+      continue
+    seen_grant_controls.update(pm.grant_controls)
+    seen_session_controls.update(pm.session_controls)
+    seen_app_user_actions |= pm.condition_application_user_action
+    restricted_models.append(pm._replace(
+      members=pm.members & principal_ids,
+      condition_usergroups=policy_user_groups[pm.id]
+    ))
+
+  restricted_info = generalInfo._replace(
+    disjoint_artificial_user_groups=dja_user_groups,
+    seen_grant_controls=seen_grant_controls,
+    seen_session_controls=seen_session_controls,
+    seen_app_user_actions=seen_app_user_actions,
+    users_count=len(principal_ids),
+    user_partition=PartitionIndex(policy_user_groups, dja_user_groups)
+  )
+  return restricted_models, restricted_info
\ No newline at end of file
@@ -0,0 +1,252 @@
+"""
+Storage for cached_get. Keys are the paths built by the mk_*_path lambdas in
+cached_get, either under --persist-cache-dir or under the 'mem:' prefix.
+"""
+import abc
+import os
+import sqlite3
+import tempfile
+import time
+import typing
+from collections import OrderedDict
+from os import path as os_path
+
+from catharsis.cache_serialization import dumps, loads
+from catharsis import run_metrics
+
+# Key families for TTLs, by file name (without .json). More specific first.
+KEY_FAMILIES: typing.List[typing.Tuple[str, str]] = [
+    ('all_users_deltalink', 'deltalinks'),
+    ('groups_deltalink', 'deltalinks'),
+    ('all_users', 'users'),
+    ('all_service_principals', 'service_principals'),
+    ('ca', 'ca'),
+    ('group', 'groups'),
+    ('role', 'roles'),
+    ('licenses', 'licenses'),
+    ('tenantid', 'tenant'),
+    ('partition', 'partitions'),
+    ('azure_sub_assignment', 'azure_assignments'),
+    ('azure_mg_assignment', 'azure_assignments'),
+    ('azure', 'azure'),
+]
+CACHE_KEY_FAMILIES = sorted(set(family for _, family in KEY_FAMILIES))
+
+def key_family(key: str) -> str:
+    name = os_path.basename(key)
+    if name.endswith('.json'):
+        name = name[:-len('.json')]
+    for prefix, family in KEY_FAMILIES:
+        if name == prefix or name.startswith(prefix + '_'):
+            return family
+    return run_metrics.OTHER_FAMILY
+
+
+# Advisory lock files, under the cache directory
+LOCK_DIR = '.locks'
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(value: str) -> float:
+    """ '90', '30m', '24h', '7d' -> seconds """
+    if value and value[-1] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
+
+def parse_cache_ttl(value: str) -> typing.Tuple[str, float]:
+    """ 'users=24h' -> ('users', 86400.0) """
+    family, _, duration = value.partition('=')
+    if family not in CACHE_KEY_FAMILIES or not duration:
+        raise ValueError('Expected FAMILY=DURATION with FAMILY one of %s: %s' % (', '.join(CACHE_KEY_FAMILIES), value))
+    return family, parse_duration(duration)
+
+
+class CacheBackend(abc.ABC):
+    @abc.abstractmethod
+    def stored_at(self, key: str) -> typing.Optional[float]:
+        """ Timestamp of when key was stored, None if not cached """
+
+    def fingerprint(self, key: str) -> typing.Any:
+        """ Changes whenever the stored value changes, None if not cached """
+        return self.stored_at(key)
+
+    @abc.abstractmethod
+    def get(self, key: str) -> typing.Any:
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, value: typing.Any) -> typing.Optional[bytes]:
+        """ Returns the stored data, None when values are kept as is """
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def names(self, base: str) -> typing.List[str]:
+        """ File names of cached keys under base """
+
+
+class MemoryCacheBackend(CacheBackend):
+    """ Values kept as is. With max_entries, least recently used are evicted. """
+    def __init__(self, max_entries: typing.Optional[int] = None):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, typing.Tuple[typing.Any, float]] = OrderedDict()
+
+    def stored_at(self, key):
+        entry = self.entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.time())
+        self.entries.move_to_end(key)
+        while self.max_entries is not None and len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def names(self, base):
+        prefix = os_path.join(base, '')
+        return [key[len(prefix):] for key in self.entries.keys() if key.startswith(prefix)]
+
+
+class DirectoryCacheBackend(CacheBackend):
+    """ One file per key, the key being the file path. Files are read in either format. """
+    def __init__(self, serialization_format: str = 'json'):
+        self.serialization_format = serialization_format
+
+    def stored_at(self, key):
+        try:
+            return os.path.getmtime(key)
+        except OSError:
+            return None
+
+    def fingerprint(self, key):
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, key):
+        try:
+            with open(key, 'rb') as in_f:
+                data = in_f.read()
+        except FileNotFoundError:
+            return None
+        run_metrics.add(key_family(key), 'bytes_read', len(data))
+        return loads(data)
+
+    def set(self, key, value):
+        # Write to a temp file and rename: readers in other processes never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=os_path.dirname(key), prefix='.' + os_path.basename(key), suffix='.tmp')
+        try:
+            data = dumps(value, self.serialization_format)
+            with os.fdopen(fd, 'wb') as out_f:
+                out_f.write(data)
+            os.replace(tmp_path, key)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return data
+
+    def delete(self, key):
+        if os.path.exists(key):
+            os.remove(key)
+
+    def names(self, base):
+        return os.listdir(base)
+
+
+class SqliteCacheBackend(CacheBackend):
+    """ All keys of a cache directory in a single SQLite file, stored by file name """
+    def __init__(self, db_path: str, serialization_format: str = 'json'):
+        self.db_path = db_path
+        self.serialization_format = serialization_format
+        # Several processes may share the file: wait for their locks, let readers run during writes
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (name TEXT PRIMARY KEY, value BLOB NOT NULL, stored_at REAL NOT NULL)')
+        self.connection.commit()
+
+    def stored_at(self, key):
+        row = self.connection.execute('SELECT stored_at FROM cache WHERE name = ?', (os_path.basename(key),)).fetchone()
+        return row[0] if row else None
+
+    def get(self, key):
+        row = self.connection.execute('SELECT value FROM cache WHERE name = ?', (os_path.basename(key),)).fetchone()
+        if not row:
+            return None
+        run_metrics.add(key_family(key), 'bytes_read', len(row[0]))
+        return loads(row[0])
+
+    def set(self, key, value):
+        data = dumps(value, self.serialization_format)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO cache (name, value, stored_at) VALUES (?, ?, ?)',
+                                    (os_path.basename(key), data, time.time()))
+        return data
+
+    def delete(self, key):
+        with self.connection:
+            self.connection.execute('DELETE FROM cache WHERE name = ?', (os_path.basename(key),))
+
+    def names(self, base):
+        return [row[0] for row in self.connection.execute('SELECT name FROM cache')]
+
+
+class HotCacheLayer(CacheBackend):
+    """
+    Read-through memory layer over a persistent backend. Decoded values are
+    kept by key and backend fingerprint (mtime and size for files), so each
+    stored entry is decoded at most once per process unless it changes.
+    """
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.entries: dict[str, typing.Tuple[typing.Any, typing.Any]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stored_at(self, key):
+        return self.backend.stored_at(key)
+
+    def fingerprint(self, key):
+        return self.backend.fingerprint(key)
+
+    def get(self, key):
+        fingerprint = self.backend.fingerprint(key)
+        if fingerprint is None:
+            self.entries.pop(key, None)
+            return None
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = self.backend.get(key)
+        self.entries[key] = (fingerprint, value)
+        return value
+
+    def set(self, key, value):
+        data = self.backend.set(key, value)
+        self.entries[key] = (self.backend.fingerprint(key), value)
+        return data
+
+    def delete(self, key):
+        self.backend.delete(key)
+        self.entries.pop(key, None)
+
+    def names(self, base):
+        return self.backend.names(base)
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
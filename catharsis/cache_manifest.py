@@ -0,0 +1,205 @@
+"""
+Manifest of the persisted cache: when each entry was fetched, from which
+tenant, its size, object count and content hash.
+
+The manifest is an append-only journal of JSON lines in the cache directory,
+last line per entry wins. Processes sharing the directory append under an
+advisory lock and read only the lines added since their last read, so
+existence and freshness checks do not touch the entry files. The journal is
+compacted when most of its lines are outdated.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import typing
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from os import path as os_path
+
+from catharsis.cache_backends import CacheBackend, LOCK_DIR, key_family
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # No advisory locks (Windows)
+
+MANIFEST_FILE = '.manifest.jsonl'
+TENANT_CACHE_FILE = 'tenantid.json'
+COMPACT_MIN_LINES = 1000
+
+
+@dataclass
+class ManifestEntry:
+    name: str                  # File name of the key
+    fetched_at: float
+    tenant_id: typing.Optional[str]
+    size: int                  # Stored bytes
+    object_count: int          # Items in a list/dict, else 1
+    sha256: str
+
+
+def object_count(value: typing.Any) -> int:
+    return len(value) if isinstance(value, (list, dict)) else 1
+
+
+@contextmanager
+def _locked(lock_path: str):
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os_path.dirname(lock_path), exist_ok=True)
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class CacheManifest(object):
+    def __init__(self, cache_dir: str):
+        self.path = os_path.join(cache_dir, MANIFEST_FILE)
+        self.lock_path = os_path.join(cache_dir, LOCK_DIR, 'manifest.lock')
+        self.entries: dict[str, ManifestEntry] = {}
+        self._lines = 0
+        self._inode = None
+        self._offset = 0
+
+    def refresh(self):
+        """ Read lines appended since the last read, everything if the journal was compacted """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.entries, self._lines, self._inode, self._offset = {}, 0, None, 0
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self.entries, self._lines, self._inode, self._offset = {}, 0, stat.st_ino, 0
+        if stat.st_size == self._offset:
+            return
+        with open(self.path, 'rb') as in_f:
+            in_f.seek(self._offset)
+            data = in_f.read()
+        # A line being appended right now is read on the next refresh
+        complete = data[:data.rfind(b'\n') + 1]
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            record = json.loads(line)
+            self._lines += 1
+            if record.get('removed'):
+                self.entries.pop(record['name'], None)
+            else:
+                self.entries[record['name']] = ManifestEntry(**record)
+
+    def get(self, name: str) -> typing.Optional[ManifestEntry]:
+        self.refresh()
+        return self.entries.get(name)
+
+    def _append(self, record: dict):
+        with _locked(self.lock_path):
+            with open(self.path, 'a') as out_f:
+                out_f.write(json.dumps(record) + '\n')
+            self.refresh()
+            if self._lines >= COMPACT_MIN_LINES and self._lines > 2 * len(self.entries):
+                self._compact()
+
+    def record(self, entry: ManifestEntry):
+        self._append(asdict(entry))
+
+    def remove(self, name: str):
+        self._append({'name': name, 'removed': True})
+
+    def _compact(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os_path.dirname(self.path), prefix=MANIFEST_FILE, suffix='.tmp')
+        with os.fdopen(fd, 'w') as out_f:
+            for entry in self.entries.values():
+                out_f.write(json.dumps(asdict(entry)) + '\n')
+        os.replace(tmp_path, self.path)
+        self.refresh()
+
+
+class ManifestCacheLayer(CacheBackend):
+    """ Records every write of a persistent backend to the manifest of its cache directory """
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.manifests: dict[str, CacheManifest] = {}
+        self.tenant_ids: dict[str, typing.Optional[str]] = {}
+
+    def manifest(self, key: str) -> CacheManifest:
+        cache_dir = os_path.dirname(key)
+        if cache_dir not in self.manifests:
+            self.manifests[cache_dir] = CacheManifest(cache_dir)
+        return self.manifests[cache_dir]
+
+    def tenant_id(self, key: str) -> typing.Optional[str]:
+        cache_dir = os_path.dirname(key)
+        if self.tenant_ids.get(cache_dir) is None:
+            tenant = self.backend.get(os_path.join(cache_dir, TENANT_CACHE_FILE))
+            self.tenant_ids[cache_dir] = tenant.tenantId if tenant is not None else None
+        return self.tenant_ids[cache_dir]
+
+    def stored_at(self, key):
+        entry = self.manifest(key).get(os_path.basename(key))
+        if entry is not None:
+            return entry.fetched_at
+        # Written before the manifest existed
+        return self.backend.stored_at(key)
+
+    def fingerprint(self, key):
+        entry = self.manifest(key).get(os_path.basename(key))
+        if entry is not None:
+            return entry.fetched_at, entry.sha256
+        return self.backend.fingerprint(key)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            name = os_path.basename(key)
+            if self.manifest(key).get(name) is not None:
+                # Removed outside of the tool: a miss from now on
+                self.manifest(key).remove(name)
+        return value
+
+    def set(self, key, value):
+        data = self.backend.set(key, value)
+        if key_family(key) == 'tenant':
+            self.tenant_ids[os_path.dirname(key)] = value.tenantId
+        self.manifest(key).record(ManifestEntry(
+            name=os_path.basename(key),
+            fetched_at=time.time(),
+            tenant_id=self.tenant_id(key),
+            size=len(data),
+            object_count=object_count(value),
+            sha256=hashlib.sha256(data).hexdigest()
+        ))
+        return data
+
+    def delete(self, key):
+        self.backend.delete(key)
+        name = os_path.basename(key)
+        if self.manifest(key).get(name) is not None:
+            self.manifest(key).remove(name)
+
+    def names(self, base):
+        return self.backend.names(base)
+
+
+def summarize_manifest(cache_dir: str) -> typing.List[dict]:
+    """ Entry count, objects, bytes and fetch time range per key family """
+    manifest = CacheManifest(cache_dir)
+    manifest.refresh()
+    families: dict[str, dict] = {}
+    for entry in manifest.entries.values():
+        family = families.setdefault(key_family(entry.name), {
+            'family': key_family(entry.name), 'entries': 0, 'objects': 0, 'bytes': 0,
+            'oldest': entry.fetched_at, 'newest': entry.fetched_at, 'tenants': set()
+        })
+        family['entries'] += 1
+        family['objects'] += entry.object_count
+        family['bytes'] += entry.size
+        family['oldest'] = min(family['oldest'], entry.fetched_at)
+        family['newest'] = max(family['newest'], entry.fetched_at)
+        if entry.tenant_id:
+            family['tenants'].add(entry.tenant_id)
+    return sorted(families.values(), key=lambda f: f['family'])
@@ -0,0 +1,161 @@
+"""
+On-disk formats for cached values.
+
+json: CatharsisEncoder output, decoded with the catharsis_decoder object_hook
+that rebuilds every typed object one dict at a time.
+
+binary: magic, a schema header and a zlib compressed body. Lists (and dict
+values) of one dataclass type are stored column by column and rebuilt in
+bulk, enum columns are stored as plain values. The header records the field
+order of every stored dataclass, so values written before a dataclass gets
+new fields can still be read.
+
+loads() detects the format, so existing JSON caches keep working.
+"""
+import json
+import struct
+import typing
+import zlib
+
+from catharsis.typedefs import CatharsisEncoder, catharsis_decoder, decoded_dataclasses, decoded_enums
+
+SERIALIZATION_FORMATS = ['json', 'binary']
+
+BINARY_MAGIC = b'CATHBIN\x01'
+BINARY_FORMAT_VERSION = 1
+_HEADER_LENGTH = struct.Struct('>I')
+
+_PRIMITIVES = (str, int, float, bool, type(None))
+
+# Markers in the encoded body. Plain dicts having keys starting with ~ are escaped.
+_TABLE = '~T'      # {'~T': typename, 'c': [column, ..], 'p': [plain columns], 'n': length with nulls, 'm': [null positions]}
+_ENUMS = '~E'      # {'~E': typename, 'v': [value, ..]}
+_TABLE_DICT = '~D' # {'~D': [key, ..], 'v': encoded values}
+_OBJECT = '~t'     # {'~t': typename, 'r': [field value, ..]}
+_ENUM = '~e'       # {'~e': typename, 'v': value}
+_ESCAPED = '~d'    # {'~d': [[key, value], ..]}
+
+
+class _Encoder(object):
+  def __init__(self):
+    self.schema: dict[str, typing.List[str]] = {}
+
+  def fields(self, typename: str, obj) -> typing.List[str]:
+    if typename not in self.schema:
+      self.schema[typename] = list(obj.__dict__.keys())
+    return self.schema[typename]
+
+  def encode(self, o):
+    if isinstance(o, _PRIMITIVES):
+      return o
+    typename = type(o).__name__
+    if typename in decoded_dataclasses:
+      fields = self.fields(typename, o)
+      return {_OBJECT: typename, 'r': [self.encode(o.__dict__[f]) for f in fields]}
+    if typename in decoded_enums:
+      return {_ENUM: typename, 'v': o.value}
+    if isinstance(o, dict):
+      if o and all(type(k) is str for k in o.keys()):
+        encoded_values = self.encode_list(list(o.values()))
+        if isinstance(encoded_values, dict):
+          return {_TABLE_DICT: list(o.keys()), 'v': encoded_values}
+      if any(isinstance(k, str) and k.startswith('~') for k in o.keys()):
+        return {_ESCAPED: [[k, self.encode(v)] for k, v in o.items()]}
+      return {k: self.encode(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+      return self.encode_list(o)
+    # Fail like json.dumps(..., cls=CatharsisEncoder) would
+    return CatharsisEncoder().default(o)
+
+  @staticmethod
+  def is_plain(items) -> bool:
+    return isinstance(items, list) and all(isinstance(x, _PRIMITIVES) for x in items)
+
+  def encode_list(self, items):
+    present = [x for x in items if x is not None]
+    if present:
+      cls = type(present[0])
+      typename = cls.__name__
+      if (typename in decoded_dataclasses or typename in decoded_enums) and all(type(x) is cls for x in present):
+        if typename in decoded_enums:
+          if len(present) == len(items):
+            return {_ENUMS: typename, 'v': [x.value for x in items]}
+        else:
+          fields = self.fields(typename, present[0])
+          columns = [self.encode_list([x.__dict__[f] for x in present]) for f in fields]
+          table = {_TABLE: typename, 'c': columns, 'p': [i for i, column in enumerate(columns) if self.is_plain(column)]}
+          if len(present) < len(items):
+            table['n'] = len(items)
+            table['m'] = [i for i, x in enumerate(items) if x is None]
+          return table
+    if all(isinstance(x, _PRIMITIVES) for x in items):
+      return list(items)
+    return [self.encode(x) for x in items]
+
+
+class _Decoder(object):
+  def __init__(self, schema: dict[str, typing.List[str]]):
+    self.schema = schema
+    self.enum_lookups = {name: {m.value: m for m in cls} for name, cls in decoded_enums.items()}
+
+  def decode(self, o):
+    if isinstance(o, list):
+      return [x if isinstance(x, _PRIMITIVES) else self.decode(x) for x in o]
+    if not isinstance(o, dict):
+      return o
+    if _TABLE in o:
+      return self.decode_table(o)
+    if _ENUMS in o:
+      lookup = self.enum_lookups[o[_ENUMS]]
+      return [lookup[v] for v in o['v']]
+    if _TABLE_DICT in o:
+      return dict(zip(o[_TABLE_DICT], self.decode(o['v'])))
+    if _OBJECT in o:
+      typename = o[_OBJECT]
+      values = [self.decode(v) for v in o['r']]
+      return decoded_dataclasses[typename](**dict(zip(self.schema[typename], values)))
+    if _ENUM in o:
+      return decoded_enums[o[_ENUM]](o['v'])
+    if _ESCAPED in o:
+      return {k: self.decode(v) for k, v in o[_ESCAPED]}
+    return {k: self.decode(v) for k, v in o.items()}
+
+  def decode_table(self, o):
+    typename = o[_TABLE]
+    cls = decoded_dataclasses[typename]
+    fields = self.schema[typename]
+    # Plain columns need no decoding
+    plain = set(o['p'])
+    columns = [column if i in plain else self.decode(column) for i, column in enumerate(o['c'])]
+    if fields == list(cls.__dataclass_fields__.keys()):
+      result = list(map(cls, *columns))
+    else:
+      result = [cls(**dict(zip(fields, row))) for row in zip(*columns)]
+    if 'm' in o:
+      nulls = set(o['m'])
+      present = iter(result)
+      result = [None if i in nulls else next(present) for i in range(o['n'])]
+    return result
+
+
+def dumps(value: typing.Any, serialization_format: str = 'json') -> bytes:
+  if serialization_format == 'json':
+    return json.dumps(value, cls=CatharsisEncoder).encode('utf-8')
+  elif serialization_format == 'binary':
+    encoder = _Encoder()
+    body = json.dumps(encoder.encode(value), separators=(',', ':')).encode('utf-8')
+    header = json.dumps({'version': BINARY_FORMAT_VERSION, 'schema': encoder.schema}).encode('utf-8')
+    return BINARY_MAGIC + _HEADER_LENGTH.pack(len(header)) + header + zlib.compress(body)
+  else:
+    raise Exception('Unknown cache serialization format: %s' % serialization_format)
+
+def loads(data: typing.Union[bytes, str]) -> typing.Any:
+  if isinstance(data, bytes) and data.startswith(BINARY_MAGIC):
+    start = len(BINARY_MAGIC) + _HEADER_LENGTH.size
+    (header_length,) = _HEADER_LENGTH.unpack(data[len(BINARY_MAGIC):start])
+    header = json.loads(data[start:start+header_length])
+    if header['version'] != BINARY_FORMAT_VERSION:
+      raise Exception('Unsupported binary cache format version: %s' % header['version'])
+    body = json.loads(zlib.decompress(data[start+header_length:]))
+    return _Decoder(header['schema']).decode(body)
+  return json.loads(data, object_hook=catharsis_decoder)
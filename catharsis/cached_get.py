@@ -1,11 +1,22 @@
 from catharsis.typedefs import RunConf
 from os import path as os_path
 import os
+import asyncio
 import json
+import time
 import typing
+from contextlib import asynccontextmanager
 from functools import cache
 
-from catharsis.typedefs import PrincipalType, RunConf, Principal, ServicePrincipalDetails, ServicePrincipalType, UserPrincipalDetails, CatharsisEncoder, catharsis_decoder
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # No advisory locks (Windows)
+
+from catharsis.cache_backends import CacheBackend, MemoryCacheBackend, DirectoryCacheBackend, SqliteCacheBackend, HotCacheLayer, LOCK_DIR, key_family
+from catharsis.cache_manifest import ManifestCacheLayer
+from catharsis import run_metrics
+from catharsis.typedefs import PrincipalType, RunConf, Principal, ServicePrincipalDetails, ServicePrincipalType, UserPrincipalDetails
 
 import logging
 logger = logging.getLogger('catharsis.cached_get')
@@ -15,6 +26,7 @@ logger.setLevel(logging.INFO)
 
 IN_MEM_CACHE_PREFIX = 'mem:'
 mk_path = lambda args: args.persist_cache_dir or IN_MEM_CACHE_PREFIX
+SQLITE_CACHE_FILE = 'cache.sqlite3'
 
 # Entra
 mk_ca_path = lambda args: os_path.join(mk_path(args), 'ca.json')
@@ -22,9 +34,12 @@ mk_group_result_transitive_path = lambda args, group_id: os_path.join(mk_path(ar
 mk_role_assignment_raw_path = lambda args, role_id: os_path.join(mk_path(args), f'role_{role_id}_raw.json')
 mk_role_result_transitive_path = lambda args, role_id: os_path.join(mk_path(args), f'role_{role_id}_resolved.json')
 mk_all_users_path = lambda args: os_path.join(mk_path(args), 'all_users.json')
+mk_all_users_delta_link_path = lambda args: os_path.join(mk_path(args), 'all_users_deltalink.json')
+mk_groups_delta_link_path = lambda args: os_path.join(mk_path(args), 'groups_deltalink.json')
 mk_all_service_principals_path = lambda args: os_path.join(mk_path(args), 'all_service_principals.json')  # az_ad_sp_list --all
 mk_users_licenses = lambda args: os_path.join(mk_path(args), 'licenses.json')
 mk_tenant_id = lambda args: os_path.join(mk_path(args), 'tenantid.json')
+mk_partition_state_path = lambda args, name: os_path.join(mk_path(args), f'partition_{name}.json')
 
 # Azure
 mk_azure_subs = lambda args: os_path.join(mk_path(args), 'azure_subscriptions.json')
@@ -32,31 +47,104 @@ mk_azure_mgs = lambda args: os_path.join(mk_path(args), 'azure_management_groups
 mk_azure_sub_assignment_raw_path = lambda args, sub_guid: os_path.join(mk_path(args), f'azure_sub_assignment_{sub_guid}_raw.json')
 mk_azure_mg_assignment_raw_path = lambda args, mg_name: os_path.join(mk_path(args), f'azure_mg_assignment_{mg_name}_raw.json')
 
-_IN_MEMORY_CACHE: dict[str, typing.Any] = {}
+_MEMORY_BACKEND: CacheBackend = MemoryCacheBackend()
+_PERSISTENT_BACKEND: CacheBackend = HotCacheLayer(ManifestCacheLayer(DirectoryCacheBackend()))
+_CACHE_TTLS: dict[str, float] = {}
+
+def set_cache_backends(memory: CacheBackend = None, persistent: CacheBackend = None, ttls: typing.Mapping[str, float] = None):
+    global _MEMORY_BACKEND, _PERSISTENT_BACKEND, _CACHE_TTLS
+    _MEMORY_BACKEND = memory or MemoryCacheBackend()
+    _PERSISTENT_BACKEND = persistent or HotCacheLayer(ManifestCacheLayer(DirectoryCacheBackend()))
+    _CACHE_TTLS = dict(ttls or {})
+
+def configure_cache(args: RunConf):
+    """ Backends and TTLs from --cache-backend, --cache-format, --cache-max-entries and --cache-ttl """
+    if args.cache_backend == 'sqlite' and is_cache_persisted(args):
+        persistent = SqliteCacheBackend(os_path.join(args.persist_cache_dir, SQLITE_CACHE_FILE), args.cache_format)
+    else:
+        persistent = DirectoryCacheBackend(args.cache_format)
+    set_cache_backends(MemoryCacheBackend(args.cache_max_entries), HotCacheLayer(ManifestCacheLayer(persistent)), dict(args.cache_ttl or []))
+
+def hot_cache_stats() -> typing.Optional[dict[str, int]]:
+    """ Hit/miss counts of the memory layer over the persisted cache """
+    if isinstance(_PERSISTENT_BACKEND, HotCacheLayer):
+        return _PERSISTENT_BACKEND.stats()
+    return None
 
 def is_cache_persisted(args: RunConf):
   return args.persist_cache_dir is not None
 
+def _backend_for(key: str) -> CacheBackend:
+    return _MEMORY_BACKEND if key.startswith(IN_MEM_CACHE_PREFIX) else _PERSISTENT_BACKEND
+
+def _is_fresh(key: str, stored_at: typing.Optional[float]) -> bool:
+    if stored_at is None:
+        return False
+    ttl = _CACHE_TTLS.get(key_family(key))
+    if ttl is not None and time.time() - stored_at > ttl:
+        logger.info('Cache entry expired with key=%s', key)
+        return False
+    return True
+
+def is_cached(key: str) -> bool:
+    return _is_fresh(key, _backend_for(key).stored_at(key))
+
 def get_cached(key: str) -> typing.Any:
-    if key.startswith(IN_MEM_CACHE_PREFIX):
-        cached = _IN_MEMORY_CACHE.get(key)
-        if not cached:
-            logger.info('Cache miss with key=%s', key)
-        return cached
-    else:
-        if os.path.exists(key):
-            # Cache this
-            with open(key) as in_f:
-                return json.load(in_f, object_hook=catharsis_decoder)
+    backend = _backend_for(key)
+    if not _is_fresh(key, backend.stored_at(key)):
         logger.info('Cache miss with key=%s', key)
+        run_metrics.add(key_family(key), 'misses')
         return None
+    value = backend.get(key)
+    run_metrics.add(key_family(key), 'hits' if value is not None else 'misses')
+    return value
+
+def invalidate_cached(key: str):
+    _backend_for(key).delete(key)
+
+def list_cached_keys(args: RunConf, prefix: str, suffix: str = '.json') -> typing.List[str]:
+    """ Cache keys with file name prefix and suffix, e.g. 'group_' """
+    base = mk_path(args)
+    names = _backend_for(base).names(base)
+    return [os_path.join(base, name) for name in names if name.startswith(prefix) and name.endswith(suffix)]
 
 def set_cached(key: str, value: typing.Any) -> typing.Any:
-    if key.startswith(IN_MEM_CACHE_PREFIX):
-        _IN_MEMORY_CACHE[key] = value
-    else:
-        with open(key, 'w') as out_f:
-            return json.dump(value, out_f, cls=CatharsisEncoder)
+    data = _backend_for(key).set(key, value)
+    run_metrics.add(key_family(key), 'writes')
+    if data is not None:
+        run_metrics.add(key_family(key), 'bytes_written', len(data))
+
+LOCK_POLL_SECONDS = 0.1
+
+@asynccontextmanager
+async def fetch_lock(key: str):
+    """
+    Advisory lock for fetching a persisted key: processes sharing the cache
+    directory wait for the one already fetching it. No-op for in-memory keys.
+    """
+    if key.startswith(IN_MEM_CACHE_PREFIX) or fcntl is None:
+        yield
+        return
+    lock_dir = os_path.join(os_path.dirname(key), LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    fd = os.open(os_path.join(lock_dir, os_path.basename(key) + '.lock'), os.O_CREAT | os.O_RDWR)
+    try:
+        waited = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not waited:
+                    logger.info('Waiting for another fetch of key=%s', key)
+                    waited = True
+                await asyncio.sleep(LOCK_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
 
 
 @cache
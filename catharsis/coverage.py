@@ -0,0 +1,139 @@
+"""
+Scenario coverage without the CP solver.
+
+The scenario space is every combination of artificial user group, artificial
+app group, client app type, user risk and sign-in risk. Each policy's
+conditions are boolean masks over these axes, combined into a tensor of the
+applying policies per cell, one of the blocked cells and one per required
+grant control. Answers "which cells have no MFA or block" without building
+the cpmpy model.
+"""
+from functools import reduce
+from typing import List, NamedTuple
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from catharsis.settings import ALL_CLIENT_APP_TYPES, ALL_SIGNIN_RISK_LEVELS, ALL_USER_RISK_LEVELS
+from catharsis.typedefs import GeneralInfo, PolicyModel
+
+SCENARIO_AXES = ['user_group', 'app_group', 'client_app_type', 'user_risk', 'signin_risk']
+
+# Grant control name for policies requiring an authentication strength
+AUTH_STRENGTH_CONTROL = 'authStrength'
+# A cell requiring none of these and not blocked is unprotected
+STRONG_AUTH_CONTROLS = ['mfa', AUTH_STRENGTH_CONTROL]
+
+
+class ScenarioCell(NamedTuple):
+  user_group: int
+  app_group: int
+  client_app_type: str
+  user_risk: str
+  signin_risk: str
+
+
+def get_required_controls(pm: PolicyModel) -> List[str]:
+  """
+  Grant controls every sign-in the policy applies to must satisfy. With OR,
+  a single control is required, several are alternatives so none of them is.
+  """
+  controls = [c for c in pm.grant_controls if c != 'block']
+  if pm.grant_authentication_strength:
+    controls.append(AUTH_STRENGTH_CONTROL)
+  if pm.grant_operator == 'OR' and len(controls) > 1:
+    return []
+  return controls
+
+
+class ScenarioCoverage(object):
+  """
+  Tensors indexed [user group, app group, client app type, user risk,
+  sign-in risk] along the labels in axes.
+  """
+  def __init__(self, axes: List[list], controls: List[str], blocked, required, policy_counts):
+    self.axes = axes
+    self.controls = controls
+    self.blocked = blocked              # Some applying policy blocks
+    self.required = required            # [control, *cell]: some applying policy requires the control
+    self.policy_counts = policy_counts  # Applying policies
+
+  @property
+  def shape(self):
+    return self.blocked.shape
+
+  def requires(self, control: str):
+    if control not in self.controls:
+      return np.zeros(self.shape, dtype=bool)
+    return self.required[self.controls.index(control)]
+
+  def unprotected(self):
+    """ Cells not blocked and requiring no MFA or authentication strength """
+    strong = reduce(np.logical_or, [self.requires(c) for c in STRONG_AUTH_CONTROLS])
+    return ~self.blocked & ~strong
+
+  def cells(self, mask) -> List[ScenarioCell]:
+    return [ScenarioCell(*[labels[i] for labels, i in zip(self.axes, position)])
+            for position in np.argwhere(mask).tolist()]
+
+
+def _axis_masks(labels: list, selections: list) -> 'np.ndarray':
+  """ [policy, label] """
+  positions = {label: i for i, label in enumerate(labels)}
+  masks = np.zeros((len(selections), len(labels)), dtype=bool)
+  for row, selected in enumerate(selections):
+    masks[row, [positions[s] for s in selected if s in positions]] = True
+  return masks
+
+def _outer(a: 'np.ndarray', b: 'np.ndarray') -> 'np.ndarray':
+  """ Per policy outer AND of [policy, x] and [policy, y] to [policy, x*y] """
+  return (a[:, :, None] & b[:, None, :]).reshape(len(a), -1)
+
+
+def evaluate_scenario_coverage(policyModels: List[PolicyModel], generalInfo: GeneralInfo) -> ScenarioCoverage:
+  """
+  Same policy semantics as translate_policymodels_to_task: a policy applies
+  when its user group, app group, client app type and risk conditions all
+  match, an empty risk condition matching every level.
+
+  A policy's cells are the outer product of its (user group, app group) and
+  (client app type, user risk, sign-in risk) masks, so the number of
+  applying policies per cell is one matrix product over the policies.
+  """
+  if np is None:
+    raise Exception('numpy is not available')
+
+  axes = [
+    sorted(generalInfo.disjoint_artificial_user_groups.keys()),
+    sorted(generalInfo.disjoint_artificial_app_groups.keys()),
+    ALL_CLIENT_APP_TYPES,
+    ALL_USER_RISK_LEVELS,
+    ALL_SIGNIN_RISK_LEVELS
+  ]
+  shape = tuple(len(labels) for labels in axes)
+  policy_controls = [get_required_controls(pm) for pm in policyModels]
+  controls = sorted(set().union(*policy_controls))
+
+  groups = _outer(
+    _axis_masks(axes[0], [pm.condition_usergroups for pm in policyModels]),
+    _axis_masks(axes[1], [pm.condition_applications for pm in policyModels])
+  ).astype(np.float32)
+  conditions = _outer(_outer(
+    _axis_masks(axes[2], [pm.condition_client_app_types for pm in policyModels]),
+    _axis_masks(axes[3], [pm.condition_user_risk_levels or ALL_USER_RISK_LEVELS for pm in policyModels])),
+    _axis_masks(axes[4], [pm.condition_signin_risk_levels or ALL_SIGNIN_RISK_LEVELS for pm in policyModels])
+  ).astype(np.float32)
+
+  def count_applying(selected: List[bool]) -> 'np.ndarray':
+    rows = np.array(selected, dtype=bool)
+    return (groups[rows].T @ conditions[rows]).reshape(shape)
+
+  policy_counts = count_applying([True] * len(policyModels)).astype(np.int32)
+  blocked = count_applying(['block' in pm.grant_controls for pm in policyModels]) > 0
+  required = np.zeros((len(controls),) + shape, dtype=bool)
+  for i, control in enumerate(controls):
+    required[i] = count_applying([control in pm_controls for pm_controls in policy_controls]) > 0
+
+  return ScenarioCoverage(axes, controls, blocked, required, policy_counts)
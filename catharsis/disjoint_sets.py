@@ -1,6 +1,17 @@
 from collections import namedtuple
 from collections import Counter
 
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+import catharsis.cached_get as c
+
+import logging
+logger = logging.getLogger('catharsis.disjoint_sets')
+logger.setLevel(logging.INFO)
+
 # Type for giving in the task
 GroupMembers = namedtuple('GroupMembers', ['name', 'members'])
 
@@ -38,7 +49,7 @@ def split_to_disjoint_sets(groups: [GroupMembers]):
 
   while True:
     unref_member_id = pick_any_unreferenced_members()
-    if not unref_member_id:
+    if unref_member_id is None:
       break
 
     new_group_member_ids = find_unref_members_that_have_same_groups(unref_member_id)
@@ -75,4 +86,333 @@ def split_to_disjoint_sets_ordered(groups: [GroupMembers]):
   for pol_name, group_ids in unsorted_task_groups.items():
     sorted_task_groups[pol_name] = sorted([translation[gid] for gid in group_ids])
 
-  return (sorted_task_groups, sorted_artificial_groups)
\ No newline at end of file
+  return (sorted_task_groups, sorted_artificial_groups)
+
+def split_to_disjoint_sets_by_signature(groups: [GroupMembers]):
+  """
+  Same result as split_to_disjoint_sets_ordered, computed in a single pass.
+
+  Each member gets a signature: the indices of the groups it belongs to.
+  Members sharing a signature form one artificial group.
+  """
+  signatures = {}
+  for group_index, g in enumerate(groups):
+    for member in set(g.members):
+      signatures.setdefault(member, []).append(group_index)
+
+  buckets = {}
+  for member, signature in signatures.items():
+    buckets.setdefault(tuple(signature), set()).add(member)
+
+  # Same ordering as split_to_disjoint_sets_ordered: size descending, then smallest member id
+  ordered = sorted(buckets.items(), key=lambda b: (-len(b[1]), min(b[1])))
+
+  group_artificial_ids = [[] for _ in groups]
+  artificial_groups = {}
+  for artificial_id, (signature, member_ids) in enumerate(ordered):
+    artificial_groups[artificial_id] = member_ids
+    for group_index in signature:
+      group_artificial_ids[group_index].append(artificial_id)
+
+  plain_groups = {g.name: group_artificial_ids[i] for i, g in enumerate(groups)}
+  return (plain_groups, artificial_groups)
+
+
+def split_to_disjoint_sets_numpy(groups: [GroupMembers]):
+  """
+  Same result as split_to_disjoint_sets_ordered, using a bit-packed
+  members x groups matrix. Rows with equal bits form one artificial group.
+  """
+  if np is None:
+    raise Exception('numpy is not available')
+
+  group_members = [set(g.members) for g in groups]
+  # Sorted so that the first row of each artificial group holds its smallest member id
+  members = sorted(set().union(*group_members))
+  if not members:
+    return ({g.name: [] for g in groups}, {})
+  member_rows = {m: i for i, m in enumerate(members)}
+
+  matrix = np.zeros((len(members), len(groups)), dtype=bool)
+  for group_index, gm in enumerate(group_members):
+    if gm:
+      matrix[[member_rows[m] for m in gm], group_index] = True
+  packed = np.packbits(matrix, axis=1)
+
+  unique_rows, first_rows, inverse, counts = np.unique(
+    packed, axis=0, return_index=True, return_inverse=True, return_counts=True)
+  inverse = inverse.reshape(-1)
+
+  # Size descending, then smallest member id
+  order = np.lexsort((first_rows, -counts))
+  artificial_ids = np.empty(len(order), dtype=np.int64)
+  artificial_ids[order] = np.arange(len(order))
+
+  artificial_groups = {i: set() for i in range(len(order))}
+  for member, artificial_id in zip(members, artificial_ids[inverse].tolist()):
+    artificial_groups[artificial_id].add(member)
+
+  signatures = np.unpackbits(unique_rows, axis=1, count=len(groups)).astype(bool)
+  plain_groups = {}
+  for group_index, g in enumerate(groups):
+    plain_groups[g.name] = sorted(artificial_ids[signatures[:, group_index]].tolist())
+  return (plain_groups, artificial_groups)
+
+
+PARTITION_BACKENDS = {
+  'reference': split_to_disjoint_sets_ordered,
+  'signature': split_to_disjoint_sets_by_signature,
+  'numpy': split_to_disjoint_sets_numpy
+}
+
+
+def get_partition_function(backend: str = 'auto'):
+  """
+  'auto' prefers numpy and falls back to the pure-Python signature backend.
+  'incremental' (see update_incremental_partition) needs the run's state and
+  is handled by the caller; other groups use 'auto' then.
+  """
+  if backend in ('auto', 'incremental'):
+    backend = 'numpy' if np is not None else 'signature'
+  elif backend == 'numpy' and np is None:
+    logger.warning('numpy is not available. Falling back to the signature partition backend.')
+    backend = 'signature'
+  if backend not in PARTITION_BACKENDS:
+    raise Exception('Unknown partition backend: %s' % backend)
+  return PARTITION_BACKENDS[backend]
+
+
+class IncrementalPartition(object):
+  """
+  Disjoint sets that are kept up to date with membership deltas.
+
+  Members sharing the same set of groups (signature) form one artificial group.
+  Each delta touches only the changed member's old and new artificial group,
+  so applying a few changes does not recompute the whole partition.
+
+  Artificial group ids are internal and stable while the group exists.
+  Use to_ordered() for the same ids and ordering as split_to_disjoint_sets_ordered.
+  Members must be stable across runs (GUIDs, not principal index ids) when
+  the state is persisted.
+  """
+  def __init__(self):
+    self.groups: dict = {}              # group name: set of members
+    self._signatures: dict = {}         # member: frozenset of group names
+    self._buckets: dict = {}            # signature: artificial group id
+    self.artificial_groups: dict = {}   # artificial group id: set of members
+    self._artificial_signatures: dict = {}  # artificial group id: signature
+    self.group_artificial_ids: dict = {}    # group name: set of artificial group ids
+    self._min_members: dict = {}        # artificial group id: smallest member, None if to be recomputed
+    self._next_artificial_id = 0
+    self.changes = 0                    # Members moved since created or loaded
+
+  def _move(self, member, old_signature, new_signature):
+    self.changes += 1
+    if old_signature:
+      old_id = self._buckets[old_signature]
+      old_members = self.artificial_groups[old_id]
+      old_members.discard(member)
+      if not old_members:
+        del self._buckets[old_signature]
+        del self.artificial_groups[old_id]
+        del self._artificial_signatures[old_id]
+        del self._min_members[old_id]
+        for name in old_signature:
+          self.group_artificial_ids[name].discard(old_id)
+      elif self._min_members[old_id] == member:
+        self._min_members[old_id] = None
+
+    if new_signature:
+      self._signatures[member] = new_signature
+      new_id = self._buckets.get(new_signature)
+      if new_id is None:
+        new_id = self._next_artificial_id
+        self._next_artificial_id += 1
+        self._buckets[new_signature] = new_id
+        self.artificial_groups[new_id] = set()
+        self._artificial_signatures[new_id] = new_signature
+        self._min_members[new_id] = member
+        for name in new_signature:
+          self.group_artificial_ids[name].add(new_id)
+      self.artificial_groups[new_id].add(member)
+      if self._min_members[new_id] is not None and member < self._min_members[new_id]:
+        self._min_members[new_id] = member
+    else:
+      self._signatures.pop(member, None)
+
+  def add_group(self, name, members=()):
+    if name in self.groups:
+      raise Exception('Group already exists: %s' % name)
+    self.groups[name] = set()
+    self.group_artificial_ids[name] = set()
+    for member in members:
+      self.add_member(name, member)
+
+  def remove_group(self, name):
+    for member in list(self.groups[name]):
+      self.remove_member(name, member)
+    del self.groups[name]
+    del self.group_artificial_ids[name]
+
+  def add_member(self, name, member):
+    group = self.groups[name]
+    if member in group:
+      return
+    group.add(member)
+    old_signature = self._signatures.get(member, frozenset())
+    self._move(member, old_signature, old_signature | {name})
+
+  def remove_member(self, name, member):
+    group = self.groups[name]
+    if member not in group:
+      return
+    group.remove(member)
+    old_signature = self._signatures[member]
+    self._move(member, old_signature, old_signature - {name})
+
+  def set_group_members(self, name, members):
+    """
+    Add or update a group to given members. Cost is proportional to the difference.
+    """
+    members = set(members)
+    if name not in self.groups:
+      self.add_group(name, members)
+      return
+    current = self.groups[name]
+    for member in current - members:
+      self.remove_member(name, member)
+    for member in members - current:
+      self.add_member(name, member)
+
+  def to_ordered(self):
+    """
+    Returns (plain_groups, artificial_groups) like split_to_disjoint_sets_ordered
+    for the current groups. Only artificial groups and the ones whose smallest
+    member was removed are visited, the member sets are the partition's own:
+    copy them before changing the partition if they are kept.
+    """
+    for gid, min_member in self._min_members.items():
+      if min_member is None:
+        self._min_members[gid] = min(self.artificial_groups[gid])
+    sorted_ids = sorted(self.artificial_groups.keys(), key=lambda x: (-len(self.artificial_groups[x]), self._min_members[x]))
+    translation = {from_id: to_id for to_id, from_id in enumerate(sorted_ids)}
+    artificial_groups = {translation[from_id]: self.artificial_groups[from_id] for from_id in sorted_ids}
+    plain_groups = {name: sorted([translation[gid] for gid in self.group_artificial_ids[name]]) for name in self.groups}
+    return (plain_groups, artificial_groups)
+
+  def to_dict(self) -> dict:
+    """ JSON serializable state. Members must be JSON serializable (e.g. GUIDs). """
+    return {
+      'groups': list(self.groups.keys()),
+      'artificial_groups': [
+        {'signature': sorted(self._artificial_signatures[gid]), 'members': sorted(members)}
+        for gid, members in self.artificial_groups.items()
+      ]
+    }
+
+  @staticmethod
+  def from_dict(state: dict) -> 'IncrementalPartition':
+    partition = IncrementalPartition()
+    for name in state['groups']:
+      partition.add_group(name)
+    for stored in state['artificial_groups']:
+      signature = frozenset(stored['signature'])
+      members = set(stored['members'])
+      gid = partition._next_artificial_id
+      partition._next_artificial_id += 1
+      partition._buckets[signature] = gid
+      partition.artificial_groups[gid] = members
+      partition._artificial_signatures[gid] = signature
+      partition._min_members[gid] = min(members)
+      for name in signature:
+        partition.groups[name].update(members)
+        partition.group_artificial_ids[name].add(gid)
+      for member in members:
+        partition._signatures[member] = signature
+    return partition
+
+
+def load_incremental_partition(args, name: str) -> IncrementalPartition:
+  """
+  Partition state from the previous run (or an empty one) from the cache, e.g. --persist-cache-dir.
+  """
+  stored = c.get_cached(c.mk_partition_state_path(args, name))
+  if stored is None:
+    return IncrementalPartition()
+  return IncrementalPartition.from_dict(stored)
+
+
+def save_incremental_partition(args, name: str, partition: IncrementalPartition):
+  c.set_cached(c.mk_partition_state_path(args, name), partition.to_dict())
+
+
+def update_incremental_partition(args, name: str, groups: [GroupMembers], index):
+  """
+  Same result as split_to_disjoint_sets_ordered for groups of principal ids,
+  starting from the partition persisted by the previous run under name so
+  that only changed memberships are moved. The state is kept by GUID, as
+  principal ids (see PrincipalIndex) are assigned per run.
+  """
+  partition = load_incremental_partition(args, name)
+  names = set(g.name for g in groups)
+  for stale_name in [n for n in partition.groups if n not in names]:
+    partition.remove_group(stale_name)
+  for g in groups:
+    partition.set_group_members(g.name, index.to_guid_set(g.members))
+  logger.info('Incremental partition %s: %d membership changes since the previous run.', name, partition.changes)
+  if partition.changes or not c.is_cached(c.mk_partition_state_path(args, name)):
+    save_incremental_partition(args, name, partition)
+
+  plain_groups, artificial_groups = partition.to_ordered()
+  return ({g.name: plain_groups[g.name] for g in groups},
+          {gid: index.to_idx_set(members) for gid, members in artificial_groups.items()})
+
+
+class PartitionIndex(object):
+  """
+  Reverse lookups of a partition: the artificial group of each member and the
+  plain groups of each artificial group as a bitmask (signature), bit i being
+  the i:th plain group.
+  """
+  def __init__(self, plain_groups: dict, artificial_groups: dict):
+    self.bits: dict = {name: 1 << i for i, name in enumerate(plain_groups.keys())}
+    self.group_of: dict = {member: gid for gid, members in artificial_groups.items() for member in members}
+    self.signatures: dict = dict.fromkeys(artificial_groups.keys(), 0)
+    for name, gids in plain_groups.items():
+      bit = self.bits[name]
+      for gid in gids:
+        self.signatures[gid] |= bit
+
+  def artificial_group(self, member):
+    """ None if member is in no plain group """
+    return self.group_of.get(member)
+
+  def in_group(self, artificial_id, name) -> bool:
+    return bool(self.signatures.get(artificial_id, 0) & self.bits.get(name, 0))
+
+  def groups_of(self, artificial_id) -> list:
+    signature = self.signatures.get(artificial_id, 0)
+    return [name for name, bit in self.bits.items() if signature & bit]
+
+
+def restrict_disjoint_sets(plain_groups: dict, artificial_groups: dict, selection: set):
+  """
+  Restrict an ordered partition to a subset of its members.
+
+  Members that share groups in the full partition share them in any subset,
+  so the restricted artificial groups are the non-empty intersections with
+  the selection. Result is ordered and numbered like split_to_disjoint_sets_ordered.
+  """
+  restricted = {}
+  for gid, members in artificial_groups.items():
+    kept = members & selection
+    if kept:
+      restricted[gid] = kept
+
+  sorted_ids = sorted(restricted.keys(), key=lambda x: (-len(restricted[x]), min(restricted[x])))
+  translation = {from_id: to_id for to_id, from_id in enumerate(sorted_ids)}
+
+  sorted_artificial_groups = {translation[from_id]: restricted[from_id] for from_id in sorted_ids}
+  sorted_plain_groups = {name: sorted([translation[gid] for gid in group_ids if gid in translation])
+      for name, group_ids in plain_groups.items()}
+  return (sorted_plain_groups, sorted_artificial_groups)
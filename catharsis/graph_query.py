@@ -1,8 +1,10 @@
+import asyncio
 import json
 import os
 import hashlib
-from typing import List
-from collections.abc import Callable, Awaitable
+import time
+from typing import Any, List, NamedTuple, Optional
+from collections.abc import AsyncIterator, Callable, Awaitable
 
 # Graph SDK stuff 
 
@@ -12,15 +14,25 @@ from msgraph.generated.models.service_principal import ServicePrincipal as MSGSe
 from msgraph.generated.models.unified_role_assignment import UnifiedRoleAssignment as MSGUnifiedRoleAssignment
 from msgraph.generated.models.organization import Organization as MSGOrganization
 from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+from msgraph.generated.models.directory_object_collection_response import DirectoryObjectCollectionResponse
+from msgraph.generated.models.unified_role_assignment_collection_response import UnifiedRoleAssignmentCollectionResponse
+from msgraph_core.requests.batch_request_content import BatchRequestContent
+from msgraph_core.requests.batch_request_item import BatchRequestItem
+from msgraph_core.requests.batch_response_content import BatchResponseContent
+from kiota_serialization_json.json_parse_node_factory import JsonParseNodeFactory
 
 from msgraph.generated.role_management.entitlement_management.role_assignments.role_assignments_request_builder import RoleAssignmentsRequestBuilder
 from msgraph.generated.users.users_request_builder import UsersRequestBuilder
+from msgraph.generated.users.delta.delta_request_builder import DeltaRequestBuilder as UsersDeltaRequestBuilder
+from msgraph.generated.groups.delta.delta_request_builder import DeltaRequestBuilder as GroupsDeltaRequestBuilder
 from msgraph.generated.applications.applications_request_builder import ApplicationsRequestBuilder
 from kiota_abstractions.native_response_handler import NativeResponseHandler
 from kiota_http.middleware.options import ResponseHandlerOption
 from kiota_abstractions.base_request_configuration import RequestConfiguration
 
 from catharsis.ms_credential import get_ms_credential
+from catharsis.request_scheduler import get_scheduler, parse_retry_after, scheduled, GRAPH_ENDPOINT, THROTTLING_STATUS_CODES
+from catharsis import run_metrics
 from catharsis.typedefs import RunConf
 import catharsis.typedefs as CT
 import catharsis.cached_get as c
@@ -33,9 +45,16 @@ logger.setLevel(logging.INFO)
 # Graph SDK
 
 async def ensure_cache_matches(args: RunConf, tenant_id_check=True):
+  if tenant_id_check and not args._tenant_id_checked:
+    # Concurrent fetches must not run the tenant check in parallel, lock is created per run
+    async with args._tenant_check_lock:
+      await _ensure_cache_matches(args)
+
+
+async def _ensure_cache_matches(args: RunConf):
   # Nothing prevents user from pointing cache dir (or other caching)
   # towards a place that hosts stuff from other tenant. Except this.
-  if tenant_id_check and not args._tenant_id_checked:
+  if not args._tenant_id_checked:
     online_tenant = await get_online_tenant(args)
     if c.is_cache_persisted(args):
       logger.info("Graph client requested. Cache is persisted. Double checking that online tenant id matches to cached before first request.")
@@ -48,16 +67,27 @@ async def ensure_cache_matches(args: RunConf, tenant_id_check=True):
 
 
 async def get_msgraph_client(args: RunConf, tenant_id_check=True):
-  credential = get_ms_credential(args)
-  scopes = ['https://graph.microsoft.com/.default']
-  client = GraphServiceClient(credentials=credential, scopes=scopes)
+  # One client (and connection pool) per run
+  if getattr(args, '_msgraph_client', None) is None:
+    credential = get_ms_credential(args)
+    scopes = ['https://graph.microsoft.com/.default']
+    args._msgraph_client = GraphServiceClient(credentials=credential, scopes=scopes)
   await ensure_cache_matches(args, tenant_id_check)
-  return client
+  return args._msgraph_client
 
 
-async def do_msgraph_sdk_graph_query(request_builder, initial_method_name='get', req_conf=None):
+async def _follow_next_links(request_builder, response, result: list):
+  while response is not None and response.odata_next_link is not None:
+    response = await scheduled(GRAPH_ENDPOINT, request_builder.with_url(response.odata_next_link).get)
+    run_metrics.add_to_current('pages')
+    for o in response.value:
+      result.append(o)
+  return result
+
+
+async def iterate_msgraph_sdk_graph_query(request_builder, initial_method_name='get', req_conf=None):
+  """ Yields results page by page, only one page is kept in memory. """
    # https://github.com/microsoftgraph/msgraph-sdk-python?tab=readme-ov-file#32-pagination
-  result = []
 
   # members.get?
   fn = getattr(request_builder, initial_method_name)
@@ -65,21 +95,108 @@ async def do_msgraph_sdk_graph_query(request_builder, initial_method_name='get',
   if req_conf:
     params['request_configuration'] = req_conf
 
-  response = await fn(**params)
-  for o in response.value:
-    result.append(o)
-    
+  response = await scheduled(GRAPH_ENDPOINT, fn, **params)
+  run_metrics.add_to_current('pages')
+  yield response.value
+
   while response is not None and response.odata_next_link is not None:
-    response = await request_builder.with_url(response.odata_next_link).get()
-    for o in response.value:
-      result.append(o)
-  
+    response = await scheduled(GRAPH_ENDPOINT, request_builder.with_url(response.odata_next_link).get)
+    run_metrics.add_to_current('pages')
+    yield response.value
+
+
+async def send_checked(send_fn: Callable[..., Awaitable], *send_args, **send_kwargs):
+  """
+  For requests with NativeResponseHandler, which returns error responses
+  instead of raising: raises within scheduled(), so throttling is retried there.
+  """
+  response = await send_fn(*send_args, **send_kwargs)
+  response.raise_for_status()
+  return response
+
+
+async def do_msgraph_sdk_graph_query(request_builder, initial_method_name='get', req_conf=None):
+  result = []
+  async for page in iterate_msgraph_sdk_graph_query(request_builder, initial_method_name, req_conf):
+    result.extend(page)
   return result
 
 
+# https://learn.microsoft.com/en-us/graph/json-batching
+GRAPH_BATCH_MAX_REQUESTS = 20
+
+class BatchResult(NamedTuple):
+  status: Optional[int]
+  value: Optional[list]   # None if the request failed
+
+
+def parse_json_to_model(obj: dict, model_type):
+  parse_node = JsonParseNodeFactory().get_root_parse_node('application/json', json.dumps(obj).encode('utf-8'))
+  return parse_node.get_object_value(model_type)
+
+
+async def _send_batch(client: GraphServiceClient, requests: dict[str, tuple[Any, Any]], keys: List[str]) -> dict[str, Optional[dict]]:
+  """ One /$batch of keys, the raw JSON response of each (None if missing) """
+  batch = BatchRequestContent()
+  for i, key in enumerate(keys):
+    request_builder, req_conf = requests[key]
+    params = {}
+    if req_conf:
+      params['request_configuration'] = req_conf
+    batch.add_request(str(i), BatchRequestItem(request_builder.to_get_request_information(**params), id=str(i)))
+  # Batch responses are read as raw JSON: BatchResponseContent does not keep inline JSON bodies
+  request_info = await client.batch.to_post_request_information(batch)
+  request_info.add_request_options([ResponseHandlerOption(NativeResponseHandler())])
+  http_response = await scheduled(GRAPH_ENDPOINT, send_checked, client.request_adapter.send_async, request_info, BatchResponseContent, {})
+  responses = {r['id']: r for r in http_response.json()['responses']}
+  return {key: responses.get(str(i)) for i, key in enumerate(keys)}
+
+
+async def do_msgraph_sdk_batch_query(client: GraphServiceClient, requests: dict[str, tuple[Any, Any]], response_type) -> dict[str, BatchResult]:
+  """
+  GET many collections: requests are {key: (request_builder, req_conf)}.
+  First pages are fetched with /$batch calls of up to 20 requests, rest
+  of the pages are followed for each request through @odata.nextLink.
+  Throttled (429/503) requests of a batch pause the scheduler like any
+  throttled request and are sent again in a batch of their own.
+  """
+  results = {}
+  keys = list(requests.keys())
+  scheduler = get_scheduler()
+  for start in range(0, len(keys), GRAPH_BATCH_MAX_REQUESTS):
+    chunk = keys[start:start+GRAPH_BATCH_MAX_REQUESTS]
+    attempt = 0
+    while chunk:
+      responses = await _send_batch(client, requests, chunk)
+      throttled = [key for key in chunk if responses[key] and responses[key]['status'] in THROTTLING_STATUS_CODES]
+      retry = throttled if attempt < scheduler.max_retries else []
+      for key in chunk:
+        if key in retry:
+          continue
+        response = responses[key]
+        status = response['status'] if response else None
+        if status is None or status >= 300:
+          results[key] = BatchResult(status=status, value=None)
+          continue
+        page = parse_json_to_model(response['body'], response_type)
+        run_metrics.add_to_current('pages')
+        result = list(page.value or [])
+        request_builder, _ = requests[key]
+        results[key] = BatchResult(status=status, value=await _follow_next_links(request_builder, page, result))
+      if throttled:
+        retry_afters = [parse_retry_after(responses[key].get('headers')) for key in throttled]
+        retry_after = max(retry_afters) if None not in retry_afters else None
+        retry_after = scheduler.on_throttled(GRAPH_ENDPOINT, retry_after, attempt)
+        if retry:
+          logger.info('%d requests throttled within a batch. Sending them again in %.1fs (attempt %d/%d).', len(retry), retry_after, attempt + 1, scheduler.max_retries)
+      chunk = retry
+      attempt += 1
+  return results
+
+
 async def _get_msgraph_ca_policy_json(client: GraphServiceClient):
   req_config = client.identity.conditional_access.policies.PoliciesRequestBuilderGetRequestConfiguration(options=[ResponseHandlerOption(NativeResponseHandler())], )
-  response = await client.identity.conditional_access.policies.get(request_configuration=req_config)
+  response = await scheduled(GRAPH_ENDPOINT, send_checked, client.identity.conditional_access.policies.get, request_configuration=req_config)
   if response:
     return response.json()
   else:
@@ -90,16 +207,16 @@ def fetch_ca_policy_gsdk(args: RunConf):
     pass
 
 
-async def _get_msgraph_group_transitive_members(client: GraphServiceClient, group_id: str):
+def _iterate_msgraph_group_transitive_members(client: GraphServiceClient, group_id: str):
   """ https://graph.microsoft.com/v1.0/groups/{group_id}/transitiveMembers """
-  return await do_msgraph_sdk_graph_query(client.groups.by_group_id(group_id=group_id).transitive_members)
+  return iterate_msgraph_sdk_graph_query(client.groups.by_group_id(group_id=group_id).transitive_members)
 
 
 def principal_ids_to_filter_argument(principal_id_selection):
   id_list = ','.join(["'%s'" % guid for guid in principal_id_selection])
   return f"id in ({id_list})"
 
-async def _get_msgraph_all_users(client: GraphServiceClient, principal_id_selection: List[CT.PrincipalGuid]=None) -> List[MSGUser]:
+def _iterate_msgraph_all_users(client: GraphServiceClient, principal_id_selection: List[CT.PrincipalGuid]=None) -> AsyncIterator[List[MSGUser]]:
   """ https://graph.microsoft.com/beta/users?select=id,accountenabled,userPrincipalName """
   query_params = UsersRequestBuilder.UsersRequestBuilderGetQueryParameters(
     select = ['id', 'userPrincipalName', 'accountenabled', 'displayName']
@@ -107,29 +224,32 @@ async def _get_msgraph_all_users(client: GraphServiceClient, principal_id_select
   if principal_id_selection:
     query_params.filter = principal_ids_to_filter_argument(principal_id_selection)
   request_configuration = RequestConfiguration(query_parameters=query_params)
-  return await do_msgraph_sdk_graph_query(client.users, req_conf=request_configuration)
+  return iterate_msgraph_sdk_graph_query(client.users, req_conf=request_configuration)
 
 
-async def _get_msgraph_all_service_principals(client: GraphServiceClient, principal_id_selection: List[CT.PrincipalGuid]=None) -> List[MSGServicePrincipal]:
+def _iterate_msgraph_all_service_principals(client: GraphServiceClient, principal_id_selection: List[CT.PrincipalGuid]=None) -> AsyncIterator[List[MSGServicePrincipal]]:
   query_params = ApplicationsRequestBuilder.ApplicationsRequestBuilderGetQueryParameters()
   if principal_id_selection:
     query_params.filter = principal_ids_to_filter_argument(principal_id_selection)
   request_configuration = RequestConfiguration(query_parameters=query_params)
-  return await do_msgraph_sdk_graph_query(client.service_principals, req_conf=request_configuration)
+  return iterate_msgraph_sdk_graph_query(client.service_principals, req_conf=request_configuration)
 
 
-async def _get_msgraph_role_assignment(client: GraphServiceClient, role_id: str):
+def _role_assignment_request_configuration(role_id: str):
     query_params = RoleAssignmentsRequestBuilder.RoleAssignmentsRequestBuilderGetQueryParameters(
       filter = f"roleDefinitionId eq '{role_id}'",
 	  	expand = ["principal"]  # TODO: Big expansion just to get principal type
     )
-    request_configuration = RequestConfiguration(query_parameters=query_params)
-    result = await client.role_management.directory.role_assignments.get(request_configuration = request_configuration)
+    return RequestConfiguration(query_parameters=query_params)
+
+async def _get_msgraph_role_assignment(client: GraphServiceClient, role_id: str):
+    request_configuration = _role_assignment_request_configuration(role_id)
+    result = await scheduled(GRAPH_ENDPOINT, client.role_management.directory.role_assignments.get, request_configuration=request_configuration)
     assert result.odata_next_link == None
     return result
 
 async def _get_msgraph_tenantid(client: GraphServiceClient) -> MSGOrganization:
-  resp = await client.organization.get()
+  resp = await scheduled(GRAPH_ENDPOINT, client.organization.get)
   return resp.value[0]
 
 # Utils on top of fetchers
@@ -143,12 +263,46 @@ def take_value_from_object(obj):
    return obj.value
 
 
+# Fetches in progress by cache key: concurrent callers await the same fetch
+_IN_FLIGHT: dict[str, asyncio.Future] = {}
+
 async def cached_query(args: RunConf, cache_key: str, getter_function: Awaitable):
   cached = c.get_cached(cache_key)
   if cached is not None:
     return cached
-  else:
-    result = await getter_function()
+  in_flight = _IN_FLIGHT.get(cache_key)
+  if in_flight is not None:
+    run_metrics.add(c.key_family(cache_key), 'coalesced')
+    # Shielded: a cancelled waiter must not cancel the fetch of the others
+    return await asyncio.shield(in_flight)
+
+  future = asyncio.get_running_loop().create_future()
+  _IN_FLIGHT[cache_key] = future
+  try:
+    result = await _fetch_and_cache(cache_key, getter_function)
+    future.set_result(result)
+    return result
+  except asyncio.CancelledError:
+    future.cancel()
+    raise
+  except BaseException as e:
+    future.set_exception(e)
+    future.exception()  # Retrieved: no warning when nobody else was waiting
+    raise
+  finally:
+    del _IN_FLIGHT[cache_key]
+
+
+async def _fetch_and_cache(cache_key: str, getter_function: Awaitable):
+  family = c.key_family(cache_key)
+  async with c.fetch_lock(cache_key):
+    # Another process sharing the cache may have fetched it while we waited
+    if c.is_cached(cache_key):
+      return c.get_cached(cache_key)
+    with run_metrics.fetching(family):
+      start = time.monotonic()
+      result = await getter_function()
+      run_metrics.observe_fetch(family, time.monotonic() - start)
     c.set_cached(cache_key, result)
     return result
 
@@ -162,10 +316,12 @@ async def get_ca_policy_defs(args: RunConf):
   return await cached_query(args, key, fn)
 
 
+def role_assignment_to_type(assignment: MSGUnifiedRoleAssignment) -> CT.AssignedMember:
+  assert assignment.principal.odata_type != None
+  return CT.AssignedMember(principalId=assignment.principal_id, principalType=CT.map_odata_type_to_principaltype(assignment.principal.odata_type))
+
+
 async def get_unresolved_role_assignments(args: RunConf, role_id: str) -> List[CT.AssignedMember]:
-  def role_assignment_to_type(assignment: MSGUnifiedRoleAssignment) -> CT.AssignedMember:
-    assert assignment.principal.odata_type != None
-    return CT.AssignedMember(principalId=assignment.principal_id, principalType=CT.map_odata_type_to_principaltype(assignment.principal.odata_type))
   key = c.mk_role_assignment_raw_path(args, role_id)
   async def fn():
     result = await _get_msgraph_role_assignment(await get_msgraph_client(args), role_id)
@@ -177,17 +333,18 @@ async def get_unresolved_role_assignments(args: RunConf, role_id: str) -> List[C
 def sha1sum(msg: str) -> str:
     return hashlib.sha1(msg.encode()).hexdigest()
 
+def msgraph_user_to_principal(u: MSGUser) -> CT.Principal:
+  return CT.Principal(
+    id=u.id,
+    displayName=u.display_name,
+    accountEnabled=u.account_enabled,
+    raw={},
+    usertype=CT.PrincipalType.User,
+    userDetails=CT.UserPrincipalDetails(upn=u.user_principal_name)
+  )
+
+
 async def get_all_users(args: RunConf, principal_id_selection: List[CT.PrincipalGuid]=None) -> dict[CT.PrincipalGuid, CT.Principal]:
-  def msgraph_user_to_principal(u: MSGUser) -> CT.Principal:
-    return CT.Principal(
-      id=u.id,
-      displayName=u.display_name,
-      accountEnabled=u.account_enabled,
-      raw={},
-      usertype=CT.PrincipalType.User,
-      userDetails=CT.UserPrincipalDetails(upn=u.user_principal_name)
-    )
-  
   # temp
   selection_key = ''
   if principal_id_selection:
@@ -196,20 +353,29 @@ async def get_all_users(args: RunConf, principal_id_selection: List[CT.Principal
 
   key = c.mk_all_users_path(args) + selection_key
   async def fn():
-    result = await _get_msgraph_all_users(await get_msgraph_client(args), principal_id_selection=principal_id_selection)
-    principals: dict[str, CT.Principal] = {u.id:msgraph_user_to_principal(u) for u in result}
+    principals: dict[str, CT.Principal] = {}
+    # Convert page by page: SDK objects of one page at a time
+    async for page in _iterate_msgraph_all_users(await get_msgraph_client(args), principal_id_selection=principal_id_selection):
+      for u in page:
+        principals[u.id] = msgraph_user_to_principal(u)
     return principals
   return await cached_query(args, key, fn)
 
 
+def group_members_to_type(members) -> List[CT.AssignedMember]:
+  mapped = [CT.AssignedMember(principalId=p.id, principalType=CT.map_odata_type_to_principaltype(p.odata_type)) for p in members]
+  excl_devices = [p for p in mapped if p.principalType != CT.PrincipalType.Device]
+  return excl_devices
+
+
 async def get_group_transitive_members(args: RunConf, group_id: str) -> List[CT.AssignedMember]:
   key = c.mk_group_result_transitive_path(args, group_id)
   async def fn():
     try:
-      result = await _get_msgraph_group_transitive_members(await get_msgraph_client(args), group_id)
-      mapped = [CT.AssignedMember(principalId=p.id, principalType=CT.map_odata_type_to_principaltype(p.odata_type)) for p in result]
-      excl_devices = [p for p in mapped if p.principalType != CT.PrincipalType.Device]
-      return excl_devices
+      members: List[CT.AssignedMember] = []
+      async for page in _iterate_msgraph_group_transitive_members(await get_msgraph_client(args), group_id):
+        members.extend(group_members_to_type(page))
+      return members
     except Exception as e:
       if isinstance(e, ODataError) and e.response_status_code == 404:
         logger.warning('Group %s is referenced but not present in directory anymore.', group_id)
@@ -219,24 +385,78 @@ async def get_group_transitive_members(args: RunConf, group_id: str) -> List[CT.
   return await cached_query(args, key, fn)
 
 
+async def expand_member_references(args: RunConf, references: CT.MemberReferences) -> List[CT.AssignedMember]:
+  members_excl_groups: dict[str, CT.AssignedMember] = {}
+  for reference in references.entries:
+    if reference.principalType == CT.PrincipalType.Group:
+      group_members: List[CT.AssignedMember] = await get_group_transitive_members(args, reference.principalId)
+      for group_membership in group_members:
+        members_excl_groups[group_membership.principalId] = group_membership
+    else:
+      members_excl_groups[reference.principalId] = reference
+  return list(members_excl_groups.values())
+
+
 async def get_role_transitive_members(args: RunConf, role_id: str) -> List[CT.AssignedMember]:
+  """
+  The resolved entry keeps only references to the assigned groups' entries
+  plus direct members. Groups are expanded on each call from their own
+  (in-memory) cache entries.
+  """
   key = c.mk_role_result_transitive_path(args, role_id)
   async def fn():
     assignments: List[CT.AssignedMember] = await get_unresolved_role_assignments(args, role_id)
-    members_excl_groups: dict[str, CT.AssignedMember] = {}
     for assignment in assignments:
-      if assignment.principalType == CT.PrincipalType.Group:
-        group_members: List[CT.AssignedMember] = await get_group_transitive_members(args, assignment.principalId)
-        for group_membership in group_members:
-          members_excl_groups[group_membership.principalId] = group_membership
-      elif assignment.principalType == CT.PrincipalType.User:
-        members_excl_groups[assignment.principalId] = assignment
-      elif assignment.principalType == CT.PrincipalType.ServicePrincipal:
-        members_excl_groups[assignment.principalId] = assignment
-      else:
+      if assignment.principalType not in (CT.PrincipalType.Group, CT.PrincipalType.User, CT.PrincipalType.ServicePrincipal):
         raise Exception('Unknown referenced principal type: %s' % str(assignment.principalType))
-    return list(members_excl_groups.values())
-  return await cached_query(args, key, fn)
+    return CT.MemberReferences(entries=list(assignments))
+  resolved = await cached_query(args, key, fn)
+  if isinstance(resolved, list):
+    # Fully expanded entry from earlier versions
+    return resolved
+  return await expand_member_references(args, resolved)
+
+
+async def prefetch_group_transitive_members(args: RunConf, group_ids: List[str]):
+  """
+  Same cache entries as get_group_transitive_members, fetched with /$batch.
+  Groups failing within the batch are retried one by one.
+  """
+  missing = [group_id for group_id in group_ids if not c.is_cached(c.mk_group_result_transitive_path(args, group_id))]
+  if not missing:
+    return
+  client = await get_msgraph_client(args)
+  requests = {group_id: (client.groups.by_group_id(group_id=group_id).transitive_members, None) for group_id in missing}
+  with run_metrics.fetching('groups'):
+    results = await do_msgraph_sdk_batch_query(client, requests, DirectoryObjectCollectionResponse)
+  for group_id, batch_result in results.items():
+    if batch_result.value is not None:
+      c.set_cached(c.mk_group_result_transitive_path(args, group_id), group_members_to_type(batch_result.value))
+    elif batch_result.status == 404:
+      logger.warning('Group %s is referenced but not present in directory anymore.', group_id)
+      c.set_cached(c.mk_group_result_transitive_path(args, group_id), [])
+    else:
+      logger.info('Batched fetch for group %s failed with status %s. Retrying without batching.', group_id, batch_result.status)
+      await get_group_transitive_members(args, group_id)
+
+
+async def prefetch_unresolved_role_assignments(args: RunConf, role_ids: List[str]):
+  """
+  Same cache entries as get_unresolved_role_assignments, fetched with /$batch.
+  """
+  missing = [role_id for role_id in role_ids if not c.is_cached(c.mk_role_assignment_raw_path(args, role_id))]
+  if not missing:
+    return
+  client = await get_msgraph_client(args)
+  requests = {role_id: (client.role_management.directory.role_assignments, _role_assignment_request_configuration(role_id)) for role_id in missing}
+  with run_metrics.fetching('roles'):
+    results = await do_msgraph_sdk_batch_query(client, requests, UnifiedRoleAssignmentCollectionResponse)
+  for role_id, batch_result in results.items():
+    if batch_result.value is not None:
+      c.set_cached(c.mk_role_assignment_raw_path(args, role_id), [role_assignment_to_type(a) for a in batch_result.value])
+    else:
+      logger.info('Batched fetch for role %s failed with status %s. Retrying without batching.', role_id, batch_result.status)
+      await get_unresolved_role_assignments(args, role_id)
 
 
 async def get_all_service_principals(args: RunConf, principal_id_selection: List[CT.PrincipalGuid]=None) -> dict[CT.PrincipalGuid, CT.Principal]:
@@ -282,8 +502,10 @@ async def get_all_service_principals(args: RunConf, principal_id_selection: List
 
   key = c.mk_all_service_principals_path(args) + selection_key
   async def fn():
-    result = await _get_msgraph_all_service_principals(await get_msgraph_client(args), principal_id_selection=principal_id_selection)
-    principals: dict[str, CT.Principal] = {u.id:msgraph_sp_to_principal(u) for u in result}
+    principals: dict[str, CT.Principal] = {}
+    async for page in _iterate_msgraph_all_service_principals(await get_msgraph_client(args), principal_id_selection=principal_id_selection):
+      for u in page:
+        principals[u.id] = msgraph_sp_to_principal(u)
     return principals
   return await cached_query(args, key, fn)
 
@@ -299,6 +521,131 @@ async def get_all_principals(args: RunConf) -> dict[CT.PrincipalGuid, CT.Princip
   return result
 
 
+# Delta sync: https://learn.microsoft.com/en-us/graph/delta-query-overview
+
+USER_SELECT = ['id', 'userPrincipalName', 'accountEnabled', 'displayName']
+
+async def do_msgraph_sdk_delta_query(request_builder, delta_link: Optional[str], req_conf=None):
+  """ Returns (changed objects, new delta link). Without delta link, returns everything. """
+  if delta_link:
+    response = await scheduled(GRAPH_ENDPOINT, request_builder.with_url(delta_link).get)
+  else:
+    response = await scheduled(GRAPH_ENDPOINT, request_builder.get, request_configuration=req_conf)
+  run_metrics.add_to_current('pages')
+  result = list(response.value)
+  while response.odata_next_link is not None:
+    response = await scheduled(GRAPH_ENDPOINT, request_builder.with_url(response.odata_next_link).get)
+    run_metrics.add_to_current('pages')
+    result.extend(response.value)
+  return result, response.odata_delta_link
+
+
+def is_removed_in_delta(o) -> bool:
+  return bool(o.additional_data and '@removed' in o.additional_data)
+
+
+async def sync_users_with_delta(args: RunConf):
+  """
+  Apply changes since previous run to cached all users. Without a delta
+  link (first run), all users are fetched through delta to get one.
+  """
+  key = c.mk_all_users_path(args)
+  delta_key = c.mk_all_users_delta_link_path(args)
+  users = c.get_cached(key)
+  delta_link = c.get_cached(delta_key)
+  if users is None or delta_link is None:
+    users, delta_link = {}, None
+
+  client = await get_msgraph_client(args)
+  query_params = UsersDeltaRequestBuilder.DeltaRequestBuilderGetQueryParameters(select=USER_SELECT)
+  changes, new_delta_link = await do_msgraph_sdk_delta_query(client.users.delta, delta_link, RequestConfiguration(query_parameters=query_params))
+
+  for u in changes:
+    if is_removed_in_delta(u):
+      users.pop(u.id, None)
+      continue
+    changed = msgraph_user_to_principal(u)
+    previous = users.get(u.id)
+    if previous:
+      # Delta results contain at least the changed properties
+      changed.displayName = changed.displayName if changed.displayName is not None else previous.displayName
+      changed.accountEnabled = changed.accountEnabled if changed.accountEnabled is not None else previous.accountEnabled
+      if changed.userDetails.upn is None:
+        changed.userDetails = previous.userDetails
+    users[u.id] = changed
+
+  logger.info('Users delta sync: %d changes (%s).', len(changes), 'incremental' if delta_link else 'full')
+  c.set_cached(key, users)
+  c.set_cached(delta_key, new_delta_link)
+
+
+def group_id_from_key(key: str) -> str:
+  return os.path.basename(key)[len('group_'):-len('.json')]
+
+
+async def sync_groups_with_delta(args: RunConf):
+  """
+  Group delta gives direct member changes only. Cached transitive
+  members are invalidated for the changed groups, groups that have them
+  nested and expanded role entries of earlier versions that have any of
+  these assigned. They are refetched on use. Current role entries only
+  reference group entries and need no invalidation.
+
+  Without a delta link (first run), changes are tracked from now on and
+  every cached group entry is invalidated, as nothing tells how old they are.
+  """
+  delta_key = c.mk_groups_delta_link_path(args)
+  delta_link = c.get_cached(delta_key)
+  client = await get_msgraph_client(args)
+  query_params = GroupsDeltaRequestBuilder.DeltaRequestBuilderGetQueryParameters(select=['members'])
+  req_conf = RequestConfiguration(query_parameters=query_params)
+
+  if delta_link is None:
+    request_info = client.groups.delta.to_get_request_information(request_configuration=req_conf)
+    request_info.path_parameters['baseurl'] = client.request_adapter.base_url
+    # Only a delta link, no current state: https://learn.microsoft.com/en-us/graph/delta-query-overview#use-delta-query-to-track-changes-in-a-resource-collection
+    response = await scheduled(GRAPH_ENDPOINT, client.groups.delta.with_url(request_info.url + '&$deltatoken=latest').get)
+    new_delta_link = response.odata_delta_link
+    changed_groups = set([group_id_from_key(key) for key in c.list_cached_keys(args, 'group_')])
+    logger.info('Groups delta sync: started tracking changes.')
+  else:
+    changes, new_delta_link = await do_msgraph_sdk_delta_query(client.groups.delta, delta_link, req_conf)
+    changed_groups = set([g.id for g in changes])
+    logger.info('Groups delta sync: %d changed groups.', len(changes))
+
+  if changed_groups:
+    # Transitive members include nested groups at every level
+    for key in c.list_cached_keys(args, 'group_'):
+      group_id = group_id_from_key(key)
+      if group_id in changed_groups:
+        continue
+      members = c.get_cached(key)
+      # None: expired (--cache-ttl) or removed since listing, may have a changed group nested
+      if members is None or any(m.principalId in changed_groups for m in members):
+        changed_groups.add(group_id)
+
+    invalidated_roles = 0
+    for key in c.list_cached_keys(args, 'role_', '_raw.json'):
+      role_id = os.path.basename(key)[len('role_'):-len('_raw.json')]
+      if not isinstance(c.get_cached(c.mk_role_result_transitive_path(args, role_id)), list):
+        continue
+      assignments = c.get_cached(key)
+      # Without (expired) assignments the groups of the expanded entry are not known
+      if assignments is None or any(a.principalId in changed_groups for a in assignments):
+        c.invalidate_cached(c.mk_role_result_transitive_path(args, role_id))
+        invalidated_roles += 1
+
+    for group_id in changed_groups:
+      c.invalidate_cached(c.mk_group_result_transitive_path(args, group_id))
+    logger.info('Groups delta sync: %d invalidated groups, %d invalidated roles.', len(changed_groups), invalidated_roles)
+  c.set_cached(delta_key, new_delta_link)
+
+
+async def sync_directory_with_delta(args: RunConf):
+  await sync_users_with_delta(args)
+  await sync_groups_with_delta(args)
+
+
 # Exception for handling Tenant: explicit caching.
 
 def get_cached_tenant(args: RunConf) -> CT.Tenant:
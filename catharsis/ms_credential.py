@@ -1,13 +1,52 @@
+import threading
+import time
+
 from azure.identity import AzureCliCredential
 from azure.identity import ManagedIdentityCredential
 
 from catharsis.typedefs import RunConf
 
+# Refresh tokens this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
 
-def get_ms_credential(args: RunConf):
+
+class CachingTokenCredential(object):
+    """
+    Keeps tokens until they are about to expire. AzureCliCredential
+    would otherwise run `az account get-access-token` for every request.
+    """
+    def __init__(self, credential):
+        self.credential = credential
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        if kwargs.get('claims'):
+            # Claims challenge: always get a new token
+            return self.credential.get_token(*scopes, **kwargs)
+        key = (scopes, tuple(sorted(kwargs.items())))
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is None or token.expires_on - TOKEN_REFRESH_MARGIN < time.time():
+                token = self.credential.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    def close(self):
+        self.credential.close()
+
+
+def _create_ms_credential(args: RunConf):
     if args.auth == 'azcli':
         return AzureCliCredential()
     elif args.auth == 'systemassignedmanagedidentity':
         return ManagedIdentityCredential()
     else:
-        raise Exception('Unknown auth mode: %s' % args.auth)
\ No newline at end of file
+        raise Exception('Unknown auth mode: %s' % args.auth)
+
+
+def get_ms_credential(args: RunConf):
+    """ One credential per run """
+    if getattr(args, '_ms_credential', None) is None:
+        args._ms_credential = CachingTokenCredential(_create_ms_credential(args))
+    return args._ms_credential
@@ -0,0 +1,94 @@
+from typing import Collection, Iterable, Iterator, List, Mapping, Optional, Set
+
+from catharsis.typedefs import Principal, PrincipalDisplayname, PrincipalGuid, PrincipalIdx, principal_to_string
+
+
+class PrincipalIndex(object):
+  """
+  Dense integer ids for principal GUIDs.
+
+  Ids are assigned in sorted GUID order, so ordering principals by their
+  int id is the same as ordering them by GUID. GUIDs not known to the index
+  are dropped when translating sets and collected in unknown_guids.
+  """
+  def __init__(self, principal_ids: Iterable[PrincipalGuid]):
+    self.guids: List[PrincipalGuid] = sorted(set(principal_ids))
+    self.ids: dict[PrincipalGuid, PrincipalIdx] = {guid: i for i, guid in enumerate(self.guids)}
+    self.unknown_guids: Set[PrincipalGuid] = set()
+
+  def __len__(self):
+    return len(self.guids)
+
+  def __contains__(self, guid: PrincipalGuid):
+    return guid in self.ids
+
+  def to_idx(self, guid: PrincipalGuid) -> PrincipalIdx:
+    return self.ids[guid]
+
+  def to_guid(self, idx: PrincipalIdx) -> PrincipalGuid:
+    return self.guids[idx]
+
+  def to_idx_set(self, guids: Iterable[PrincipalGuid]) -> Set[PrincipalIdx]:
+    ids = self.ids
+    result = set()
+    for guid in guids:
+      idx = ids.get(guid)
+      if idx is None:
+        self.unknown_guids.add(guid)
+      else:
+        result.add(idx)
+    return result
+
+  def to_guid_set(self, idxs: Iterable[PrincipalIdx]) -> Set[PrincipalGuid]:
+    guids = self.guids
+    return {guids[idx] for idx in idxs}
+
+
+class PrincipalDisplayIndex(object):
+  """
+  Display strings (see principal_to_string) of principals, formatted on
+  first use and then kept for the run.
+  """
+  def __init__(self, principals_by_ids: Mapping[PrincipalGuid, Principal]):
+    self.principals = principals_by_ids
+    self.names: dict[PrincipalGuid, PrincipalDisplayname] = {}
+
+  def __len__(self):
+    return len(self.principals)
+
+  def display(self, guid: PrincipalGuid) -> PrincipalDisplayname:
+    name = self.names.get(guid)
+    if name is None:
+      principal = self.principals.get(guid)
+      name = principal_to_string(principal) if principal else 'Principal removed? %s' % guid
+      self.names[guid] = name
+    return name
+
+
+class TargetedPrincipals(object):
+  """
+  Display names of principals targeted by a policy, formatted only when
+  iterated. Without principal ids, refers to every principal of all_ids
+  (includeUsers: All), by default every principal of the index, without
+  listing them.
+  """
+  def __init__(self, display_index: PrincipalDisplayIndex, principal_ids: Optional[List[PrincipalGuid]] = None, all_ids: Optional[Collection[PrincipalGuid]] = None):
+    self.display_index = display_index
+    self.principal_ids = principal_ids
+    self.all_ids = all_ids if all_ids is not None else display_index.principals.keys()
+
+  @property
+  def all(self) -> bool:
+    return self.principal_ids is None
+
+  def __len__(self):
+    return len(self.all_ids) if self.all else len(self.principal_ids)
+
+  def __iter__(self) -> Iterator[PrincipalDisplayname]:
+    ids = self.all_ids if self.all else self.principal_ids
+    return (self.display_index.display(guid) for guid in ids)
+
+  def __repr__(self):
+    if self.all:
+      return 'All (%d)' % len(self)
+    return repr(list(self))
@@ -3,8 +3,8 @@ import csv
 from typing import List
 
 import pandas as pd
-from catharsis.graph_query import get_all_principals
-from catharsis.typedefs import GeneralInfo, PolicyModel, principal_to_string
+from catharsis.ca import get_principal_display_index
+from catharsis.typedefs import GeneralInfo, PolicyModel
 
 from catharsis.settings import mk_report_csv_path, mk_report_ca_coverage_path, mk_solutions_report_path
 
@@ -25,14 +25,15 @@ mk_html5_doc = lambda title, body_content: """
 
 
 async def create_additional_section(args, policyModels, generalInfo:GeneralInfo):
-  principals_by_uids = await get_all_principals(args)
+  display_index = await get_principal_display_index(args)
+  index = generalInfo.principal_index
 
   s = '<ul>'
   s += '<li>Total users in section: %s</li>' % generalInfo.users_count
   for ug_id, principal_ids in generalInfo.disjoint_artificial_user_groups.items():
-    example_principal_id = sorted(list(principal_ids))[0]
-    example_principal = principals_by_uids[example_principal_id]
-    s += '<li>User group %d: Users: %d. Example user: %s</li>' % (ug_id, len(principal_ids), principal_to_string(example_principal))
+    # Index ids are in GUID order: smallest id is the smallest GUID
+    example_principal_id = index.to_guid(min(principal_ids))
+    s += '<li>User group %d: Users: %d. Example user: %s</li>' % (ug_id, len(principal_ids), display_index.display(example_principal_id))
   s += '</ul>'
   return s
 
@@ -61,7 +62,7 @@ async def create_report_section(args, policyModels:List[PolicyModel], generalInf
     u_count = len(member_principal_ids)
     ug_col_name = 'UG%s' % ug
     #d['UG%s/ %d' % (ug, u_count)] = [x(ug in p.condition_usergroups) for p in pms]
-    d[ug_col_name] = [x(ug in p.condition_usergroups) for p in pms]
+    d[ug_col_name] = [x(generalInfo.user_partition.in_group(ug, p.id)) for p in pms]
     ugs.append(ug_col_name)
     ug_counts[ug_col_name] = u_count
   col_groups.append({
@@ -77,7 +78,7 @@ async def create_report_section(args, policyModels:List[PolicyModel], generalInf
       ag_id = 'AG%s %s' % (ag, list(apps)[0])
     else:
       ag_id = 'AG%s (%d apps)' % (ag, len(apps))
-    d[ag_id] = [x(ag in p.condition_applications) for p in pms]
+    d[ag_id] = [x(generalInfo.app_partition.in_group(ag, p.id)) for p in pms]
     ags.append(ag_id)
   if ags:
     col_groups.append({
@@ -207,7 +208,8 @@ async def create_report_section(args, policyModels:List[PolicyModel], generalInf
 
   title_fn = title.replace(' ', '_').replace('&', '-')
 
-  principals = await get_all_principals(args)
+  display_index = await get_principal_display_index(args)
+  index = generalInfo.principal_index
 
   for ug, member_principal_ids in generalInfo.disjoint_artificial_user_groups.items():
     if '(' in title_fn:
@@ -218,10 +220,10 @@ async def create_report_section(args, policyModels:List[PolicyModel], generalInf
       writer = csv.DictWriter(out_f, fieldnames=fieldnames, dialect=csv.excel)
       writer.writeheader()
       for member_id in member_principal_ids:
-        principal = principals[member_id]
+        principal = display_index.principals[index.to_guid(member_id)]
         writer.writerow({
           'id': principal.id,
-          'upn': principal_to_string(principal),
+          'upn': display_index.display(principal.id),
           'accountEnabled': str(principal.accountEnabled),
           'roles': ''
         })
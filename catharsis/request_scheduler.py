@@ -0,0 +1,234 @@
+"""
+Pacing for Graph and ARM requests.
+
+The SDKs retry throttled requests by themselves, but every request does so
+independently. Here all requests to the same endpoint share a token bucket
+(requests per second), a concurrency limit that halves when throttled and
+grows back while responses are healthy, and a pause that honours Retry-After.
+"""
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Mapping, Optional, Tuple
+
+from catharsis.typedefs import RunConf
+from catharsis import run_metrics
+
+import logging
+logger = logging.getLogger('catharsis.request_scheduler')
+logger.setLevel(logging.INFO)
+
+GRAPH_ENDPOINT = 'graph'
+ARM_ENDPOINT = 'arm'
+
+THROTTLING_STATUS_CODES = (429, 503)
+
+# (requests per second, burst)
+# Graph: https://learn.microsoft.com/en-us/graph/throttling-limits
+# ARM/Resource Graph: https://learn.microsoft.com/en-us/azure/governance/resource-graph/concepts/guidance-for-throttled-requests
+DEFAULT_RATES: Mapping[str, Tuple[float, int]] = {
+  GRAPH_ENDPOINT: (50.0, 50),
+  ARM_ENDPOINT: (3.0, 15)
+}
+
+MAX_RETRIES = 5
+BASE_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+
+def get_throttling_info(e: Exception) -> Tuple[bool, Optional[float]]:
+  """
+  (is throttled, Retry-After seconds) for Graph SDK (kiota APIError),
+  azure-core (HttpResponseError) and httpx (HTTPStatusError, raw responses
+  of NativeResponseHandler) exceptions.
+  """
+  status = getattr(e, 'response_status_code', None) or getattr(e, 'status_code', None)
+  if status is None and getattr(e, 'response', None) is not None:
+    status = getattr(e.response, 'status_code', None)
+  if status not in THROTTLING_STATUS_CODES:
+    return False, None
+  headers = getattr(e, 'response_headers', None)
+  if headers is None and getattr(e, 'response', None) is not None:
+    headers = getattr(e.response, 'headers', None)
+  return True, parse_retry_after(headers)
+
+
+def parse_retry_after(headers) -> Optional[float]:
+  if not headers:
+    return None
+  value = None
+  for name, header_value in headers.items():
+    if name.lower() == 'retry-after':
+      value = header_value[0] if isinstance(header_value, (list, tuple, set)) else header_value
+      break
+  if value is None:
+    return None
+  try:
+    return max(0.0, float(value))
+  except (TypeError, ValueError):
+    pass
+  try:
+    return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+
+class TokenBucket(object):
+  def __init__(self, rate: float, capacity: int):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = float(capacity)
+    self.updated = time.monotonic()
+    self.paused_until = 0.0
+
+  def pause(self, seconds: float):
+    self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+  async def acquire(self):
+    while True:
+      now = time.monotonic()
+      if now < self.paused_until:
+        await asyncio.sleep(self.paused_until - now)
+        continue
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return
+      await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter(object):
+  """
+  Concurrency limit with additive increase (one step per `limit` healthy
+  responses) and multiplicative decrease (halve when throttled).
+  """
+  def __init__(self, limit: int, min_limit: int = 1):
+    self.max_limit = max(1, limit)
+    self.min_limit = min(min_limit, self.max_limit)
+    self.limit = self.max_limit
+    self.in_flight = 0
+    self._healthy = 0
+    self._condition = asyncio.Condition()
+
+  async def acquire(self):
+    async with self._condition:
+      await self._condition.wait_for(lambda: self.in_flight < self.limit)
+      self.in_flight += 1
+
+  async def release(self):
+    async with self._condition:
+      self.in_flight -= 1
+      self._condition.notify_all()
+
+  def on_throttled(self):
+    self.limit = max(self.min_limit, self.limit // 2)
+    self._healthy = 0
+
+  def on_success(self):
+    self._healthy += 1
+    if self._healthy >= self.limit and self.limit < self.max_limit:
+      self.limit += 1
+      self._healthy = 0
+
+
+@dataclass
+class EndpointStats:
+  requests: int = 0
+  throttled: int = 0
+  retried: int = 0
+  failed: int = 0
+
+
+class RequestScheduler(object):
+  def __init__(self, max_concurrency: int = 8, rates: Mapping[str, Tuple[float, int]] = DEFAULT_RATES, max_retries: int = MAX_RETRIES, base_backoff: float = BASE_BACKOFF_SECONDS):
+    self.max_concurrency = max_concurrency
+    self.rates = dict(rates)
+    self.max_retries = max_retries
+    self.base_backoff = base_backoff
+    self._buckets: dict[str, TokenBucket] = {}
+    self._limiters: dict[str, AdaptiveLimiter] = {}
+    self._stats: dict[str, EndpointStats] = {}
+
+  def _endpoint(self, endpoint: str) -> Tuple[TokenBucket, AdaptiveLimiter, EndpointStats]:
+    if endpoint not in self._buckets:
+      rate, burst = self.rates.get(endpoint, self.rates[GRAPH_ENDPOINT])
+      self._buckets[endpoint] = TokenBucket(rate, burst)
+      self._limiters[endpoint] = AdaptiveLimiter(self.max_concurrency)
+      self._stats[endpoint] = EndpointStats()
+    return self._buckets[endpoint], self._limiters[endpoint], self._stats[endpoint]
+
+  def on_throttled(self, endpoint: str, retry_after: Optional[float], attempt: int) -> float:
+    """
+    Record a throttled response, also one of a $batch item: shrinks the
+    concurrency limit and pauses the endpoint for Retry-After, or an
+    exponential backoff without one. Returns the pause in seconds.
+    """
+    bucket, limiter, stats = self._endpoint(endpoint)
+    stats.throttled += 1
+    run_metrics.add_to_current(f'{endpoint}_throttled')
+    limiter.on_throttled()
+    if retry_after is None:
+      retry_after = min(MAX_BACKOFF_SECONDS, self.base_backoff * (2 ** attempt)) * (0.5 + random.random() / 2)
+    bucket.pause(retry_after)
+    return retry_after
+
+  async def run(self, endpoint: str, fn: Callable[..., Awaitable], *fn_args, **fn_kwargs) -> Any:
+    """ Call fn(*fn_args, **fn_kwargs) paced for endpoint, retrying when throttled """
+    bucket, limiter, stats = self._endpoint(endpoint)
+    attempt = 0
+    while True:
+      await limiter.acquire()
+      try:
+        await bucket.acquire()
+        stats.requests += 1
+        run_metrics.add_to_current(f'{endpoint}_requests')
+        result = await fn(*fn_args, **fn_kwargs)
+      except Exception as e:
+        throttled, retry_after = get_throttling_info(e)
+        if not throttled:
+          stats.failed += 1
+          raise
+        retry_after = self.on_throttled(endpoint, retry_after, attempt)
+        if attempt >= self.max_retries:
+          stats.failed += 1
+          raise
+        attempt += 1
+        stats.retried += 1
+        logger.info('Throttled by %s. Retrying in %.1fs (attempt %d/%d), concurrency limit now %d.', endpoint, retry_after, attempt, self.max_retries, limiter.limit)
+        continue
+      finally:
+        await limiter.release()
+      limiter.on_success()
+      return result
+
+  def stats(self) -> dict[str, dict]:
+    return {
+      endpoint: {
+        'requests': stats.requests,
+        'throttled': stats.throttled,
+        'retried': stats.retried,
+        'failed': stats.failed,
+        'in_flight': self._limiters[endpoint].in_flight,
+        'concurrency_limit': self._limiters[endpoint].limit
+      } for endpoint, stats in self._stats.items()
+    }
+
+
+_SCHEDULER: Optional[RequestScheduler] = None
+
+def configure_scheduler(args: RunConf) -> RequestScheduler:
+  global _SCHEDULER
+  _SCHEDULER = RequestScheduler(max_concurrency=args.graph_concurrency)
+  return _SCHEDULER
+
+def get_scheduler() -> RequestScheduler:
+  global _SCHEDULER
+  if _SCHEDULER is None:
+    _SCHEDULER = RequestScheduler()
+  return _SCHEDULER
+
+async def scheduled(endpoint: str, fn: Callable[..., Awaitable], *fn_args, **fn_kwargs) -> Any:
+  return await get_scheduler().run(endpoint, fn, *fn_args, **fn_kwargs)
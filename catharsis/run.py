@@ -1,25 +1,49 @@
 import argparse
+import asyncio
 
 from catharsis.settings import setup_logging
 from catharsis.task_ca_report import add_ca_report_subparser
 from catharsis.task_list_admins import add_list_admins_subparser
 from catharsis.task_solver import add_solver_subparser
+from catharsis.task_cache import add_cache_subparser
+from catharsis.task_whatif import add_whatif_subparser
 from catharsis import utils
+from catharsis import graph_query
+from catharsis import request_scheduler
+from catharsis import cached_get
+from catharsis import run_metrics
+from catharsis.cache_backends import CACHE_KEY_FAMILIES, parse_cache_ttl
+from catharsis.cache_serialization import SERIALIZATION_FORMATS
+
+import logging
+logger = logging.getLogger('catharsis.run')
+logger.setLevel(logging.INFO)
 
 catharsis_parser = argparse.ArgumentParser(
   prog='ca-tharsis',
   description='CA stuff',
   epilog='')
 catharsis_parser.add_argument('--persist-cache-dir', type=str, help='Optional: persist cache as files to directory.')
+catharsis_parser.add_argument('--cache-backend', choices=['directory', 'sqlite'], default='directory', help='Configure how --persist-cache-dir is stored: one JSON file per key or a single SQLite file. Default: directory')
+catharsis_parser.add_argument('--cache-format', choices=SERIALIZATION_FORMATS, default='json', help='Configure how cached values are written: JSON or compressed columnar binary (faster to load). Both are read. Default: json')
+catharsis_parser.add_argument('--cache-max-entries', type=int, default=None, help='Without --persist-cache-dir: keep at most this many entries in memory, least recently used are evicted. Default: unbounded')
+catharsis_parser.add_argument('--cache-ttl', type=parse_cache_ttl, action='append', metavar='FAMILY=DURATION', help='Refetch cached entries older than DURATION (e.g. 90s, 30m, 24h, 7d). Can be repeated, e.g. --cache-ttl users=24h --cache-ttl ca=1h. Families: %s. Default: no expiry' % ', '.join(CACHE_KEY_FAMILIES))
 catharsis_parser.add_argument('--debug', action='store_true', help='Enable debugpy debugging.')
 catharsis_parser.add_argument('--include-report-only', action='store_true', help='CA: Include report-only CA policies.')
 catharsis_parser.add_argument('--get-licenses-from-graph', action='store_true', help='Get assigned licenses from Graph API, user per user (slow)')
 catharsis_parser.add_argument('--auth', choices=['azcli', 'systemassignedmanagedidentity'], default='azcli', help='Configure what credentials are used: AzCliCredentials or a Managed Identity. Default: azcli')
+catharsis_parser.add_argument('--delta-sync', action='store_true', help='Update cached users and invalidate changed groups using Graph delta queries before running the task. Use with --persist-cache-dir.')
+catharsis_parser.add_argument('--graph-concurrency', type=utils.positive_int, default=8, help='Maximum number of concurrent Graph/ARM requests per endpoint. Lowered automatically when throttled. Default: 8')
+catharsis_parser.add_argument('--graph-batch-size', type=utils.positive_int, default=20, help='Number of group/role member requests combined into one Graph $batch request when prefetching. 1 disables batching. Max and default: 20')
+catharsis_parser.add_argument('--partition-backend', choices=['auto', 'numpy', 'signature', 'reference', 'incremental'], default='auto', help='Configure how artificial user/app groups are computed. auto: numpy if available, otherwise signature. incremental: update the user groups of the previous run (kept in the cache, use with --persist-cache-dir) with the membership changes. Default: auto')
+catharsis_parser.add_argument('--run-report', type=str, metavar='FILE', help='Optional: write cache hits/misses, bytes, fetch latencies, pages and requests per cache key family as JSON to FILE at exit.')
 catharsis_parser.add_argument('--log-output', choices=['stdout', 'defaulthandler'], default='stdout', help='Configure logging.')
 subparsers = catharsis_parser.add_subparsers(required=True)
 add_ca_report_subparser(subparsers)
 add_solver_subparser(subparsers)
 add_list_admins_subparser(subparsers)
+add_cache_subparser(subparsers)
+add_whatif_subparser(subparsers)
 
 async def main(arg_string=None):
   args = catharsis_parser.parse_args(arg_string)
@@ -28,5 +52,19 @@ async def main(arg_string=None):
   if args.debug:
     utils.prepare_debug()
   args._tenant_id_checked = False
+  args._tenant_check_lock = asyncio.Lock()
   utils.ensure_cache_and_workdir(args)
-  await args.task_func(args)
\ No newline at end of file
+  cached_get.configure_cache(args)
+  scheduler = request_scheduler.configure_scheduler(args)
+  run_metrics.reset()
+  try:
+    if args.delta_sync:
+      await graph_query.sync_directory_with_delta(args)
+    await args.task_func(args)
+  finally:
+    for endpoint, stats in scheduler.stats().items():
+      logger.info('%s requests: %s', endpoint, stats)
+    if cached_get.is_cache_persisted(args):
+      logger.info('Persisted cache reads: %s', cached_get.hot_cache_stats())
+    if args.run_report:
+      run_metrics.write_run_report(args.run_report, {'requests': scheduler.stats(), 'persisted_cache_reads': cached_get.hot_cache_stats()})
\ No newline at end of file
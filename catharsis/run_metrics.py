@@ -0,0 +1,92 @@
+"""
+Per-run counters and fetch timings by cache key family (groups, roles,
+users, ...), written as a JSON run report at exit with --run-report.
+
+Fetches started inside fetching(family) are attributed to that family, also
+through the Graph/ARM requests and pages they make.
+"""
+import json
+import math
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+import logging
+logger = logging.getLogger('catharsis.run_metrics')
+logger.setLevel(logging.INFO)
+
+OTHER_FAMILY = 'other'
+PERCENTILES = [50, 90, 99]
+
+_current_family: ContextVar[str] = ContextVar('catharsis_fetch_family', default=OTHER_FAMILY)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+  """ Nearest-rank percentile """
+  rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+  return sorted_values[rank - 1]
+
+
+class RunMetrics(object):
+  def __init__(self):
+    self.counters: dict[str, dict[str, int]] = {}
+    self.fetch_seconds: dict[str, List[float]] = {}
+
+  def add(self, family: str, name: str, n: int = 1):
+    family_counters = self.counters.setdefault(family, {})
+    family_counters[name] = family_counters.get(name, 0) + n
+
+  def observe_fetch(self, family: str, seconds: float):
+    self.fetch_seconds.setdefault(family, []).append(seconds)
+
+  def to_dict(self) -> dict[str, dict]:
+    result = {}
+    for family in sorted(set(self.counters) | set(self.fetch_seconds)):
+      result[family] = dict(sorted(self.counters.get(family, {}).items()))
+      timings = sorted(self.fetch_seconds.get(family, []))
+      if timings:
+        result[family]['fetch_seconds'] = {
+          'count': len(timings),
+          'total': sum(timings),
+          **{f'p{p}': percentile(timings, p) for p in PERCENTILES},
+          'max': timings[-1]
+        }
+    return result
+
+
+_METRICS = RunMetrics()
+
+def reset():
+  global _METRICS
+  _METRICS = RunMetrics()
+
+def get_metrics() -> RunMetrics:
+  return _METRICS
+
+def add(family: str, name: str, n: int = 1):
+  _METRICS.add(family, name, n)
+
+def observe_fetch(family: str, seconds: float):
+  _METRICS.observe_fetch(family, seconds)
+
+def current_family() -> str:
+  return _current_family.get()
+
+def add_to_current(name: str, n: int = 1):
+  _METRICS.add(_current_family.get(), name, n)
+
+@contextmanager
+def fetching(family: str):
+  token = _current_family.set(family)
+  try:
+    yield
+  finally:
+    _current_family.reset(token)
+
+
+def write_run_report(path: str, extra: Optional[dict] = None):
+  report = {'families': _METRICS.to_dict()}
+  report.update(extra or {})
+  with open(path, 'w') as out_f:
+    json.dump(report, out_f, indent=2)
+  logger.info('Wrote run report to: %s', path)
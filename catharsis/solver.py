@@ -1,11 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum, auto
 from functools import cache
+import heapq
 import itertools
 import math
-from typing import List
+from typing import List, NamedTuple, Optional, Tuple
 from functools import cache, reduce
 import operator
 
+from catharsis.coverage import ScenarioCell
 from catharsis.settings import ALL_CLIENT_APP_TYPES
 from catharsis.typedefs import GeneralInfo, PolicyModel
 
@@ -258,6 +261,7 @@ def translate_policymodels_to_task(args, policyModels:List[PolicyModel], general
   displayed_vars = get_all_vars_for_display(all_vars)
 
   solutions = []
+  costs = []
 
   for i in range(0, args.number_of_solutions):
     model = cp.Model(*requirements)
@@ -279,7 +283,198 @@ def translate_policymodels_to_task(args, policyModels:List[PolicyModel], general
     # Print solution
     vars = ', '.join([x.name for x in displayed_vars if x.value()])
     result = cost_user.value() * reduce(operator.mul, [v.value() for v in cost_vector])
+    costs.append(result)
     cost_parts = '*'.join([str(v.value()) for v in itertools.chain([cost_user], cost_vector)])
     print('Solution #%d: %s cost=%d (%s)' % (i, vars, result, cost_parts))
 
-  # solutions_to_table(args, solutions, displayed_vars)
\ No newline at end of file
+  # solutions_to_table(args, solutions, displayed_vars)
+  return costs
+
+
+# Exhaustive search over the same scenarios and costs as translate_policymodels_to_task
+
+class ScenarioSolution(NamedTuple):
+  cost: int
+  cell: ScenarioCell             # Risk levels are None when no policy has risk conditions
+  controls: List[str]            # Grant controls the attacker satisfies
+  cost_parts: List[int]          # cost_user, then cost_vector
+
+
+class _EnumerationPolicy(NamedTuple):
+  app_groups: frozenset
+  client_app_types: frozenset
+  user_risk_levels: Optional[frozenset]    # None: no condition
+  signin_risk_levels: Optional[frozenset]
+  any_of: Optional[int]                    # Grant control bits, OR
+  all_of: int                              # Grant control bits, AND
+
+
+class _EnumerationTask(NamedTuple):
+  policies: List[_EnumerationPolicy]
+  uag_policies: List[List[int]]            # Positions of the policies targeting each user group
+  uag_costs: List[Tuple[int, int]]
+  aag_costs: List[Tuple[int, int]]
+  client_app_type_costs: List[Tuple[str, int]]
+  user_risk_costs: List[Tuple[Optional[str], int]]
+  signin_risk_costs: List[Tuple[Optional[str], int]]
+  controls: List[str]
+  control_costs: List[int]
+  control_subsets: List[Tuple[int, int]]   # (cost, bits), cheapest first
+
+
+def _risk_level_costs(levels_by_policy, cost_func, args) -> List[Tuple[Optional[str], int]]:
+  # As in the CP model: referenced levels and none, only if some policy has the condition
+  if not any(levels_by_policy):
+    return [(None, UNUSED_VARIABLE_COST)]
+  levels = sorted(set().union(*levels_by_policy) | {'none'})
+  return [(level, cost_func(args, level)) for level in levels]
+
+def _create_enumeration_task(args, policyModels: List[PolicyModel], generalInfo: GeneralInfo) -> _EnumerationTask:
+  controls = [c for c in sorted(generalInfo.seen_grant_controls) if c != 'block']
+  control_bits = {c: 1 << i for i, c in enumerate(controls)}
+  control_costs = [get_builtin_control_cost(args, c, generalInfo) for c in controls]
+
+  policies = []
+  for pm in policyModels:
+    bits = reduce(operator.or_, [control_bits[c] for c in pm.grant_controls if c != 'block'], 0)
+    policies.append(_EnumerationPolicy(
+      app_groups=frozenset(pm.condition_applications),
+      client_app_types=frozenset(pm.condition_client_app_types),
+      user_risk_levels=frozenset(pm.condition_user_risk_levels) if pm.condition_user_risk_levels else None,
+      signin_risk_levels=frozenset(pm.condition_signin_risk_levels) if pm.condition_signin_risk_levels else None,
+      any_of=bits if pm.grant_operator == 'OR' else None,
+      all_of=0 if pm.grant_operator == 'OR' else bits
+    ))
+
+  control_subsets = []
+  for bits in range(1 << len(controls)):
+    cost = reduce(operator.mul, [c if bits & (1 << i) else UNUSED_VARIABLE_COST for i, c in enumerate(control_costs)], 1)
+    control_subsets.append((cost, bits))
+  control_subsets.sort()
+
+  uag_ids = sorted(generalInfo.disjoint_artificial_user_groups.keys())
+  user_partition = generalInfo.user_partition
+  return _EnumerationTask(
+    policies=policies,
+    uag_policies=[[i for i, pm in enumerate(policyModels) if user_partition.in_group(uag_id, pm.id)] for uag_id in uag_ids],
+    uag_costs=[(uag_id, get_uag_cost(args, uag_id, generalInfo)) for uag_id in uag_ids],
+    aag_costs=[(aag_id, get_aag_cost(args, aag_id, generalInfo)) for aag_id in sorted(generalInfo.disjoint_artificial_app_groups.keys())],
+    client_app_type_costs=[(c, get_client_app_type_cost(args, c)) for c in ALL_CLIENT_APP_TYPES],
+    user_risk_costs=_risk_level_costs([pm.condition_user_risk_levels for pm in policyModels], get_user_risk_cost, args),
+    signin_risk_costs=_risk_level_costs([pm.condition_signin_risk_levels for pm in policyModels], get_signin_risk_cost, args),
+    controls=controls,
+    control_costs=control_costs,
+    control_subsets=control_subsets
+  )
+
+
+def _cheapest_controls(task: _EnumerationTask, applying: List[_EnumerationPolicy]) -> Optional[Tuple[int, int]]:
+  """ (cost, bits) of the cheapest grant controls satisfying every applying policy, None if blocked """
+  all_of = reduce(operator.or_, [p.all_of for p in applying], 0)
+  any_of = set(p.any_of for p in applying if p.any_of is not None)
+  for cost, bits in task.control_subsets:
+    if bits & all_of == all_of and all(bits & m for m in any_of):
+      return cost, bits
+  return None
+
+def _enumerate_shard(task: _EnumerationTask, uag_positions: List[int], number_of_solutions: int) -> List[tuple]:
+  """
+  Cheapest cells of the given user groups as (cost, position, control bits),
+  position being the cell's indexes in the task's cost lists. Cells whose
+  cost without grant controls cannot beat the current top N are skipped.
+  """
+  best: List[tuple] = []  # Max-heap of (-cost, -position, bits)
+  cheapest_controls = {}
+  min_tail = (min(c for _, c in task.client_app_type_costs)
+              * min(c for _, c in task.user_risk_costs)
+              * min(c for _, c in task.signin_risk_costs))
+
+  def beaten(cost) -> bool:
+    # Ties go to the earlier cell, which was pushed first
+    return len(best) == number_of_solutions and cost >= -best[0][0]
+
+  for ui in uag_positions:
+    uag_id, uag_cost = task.uag_costs[ui]
+    user_policies = [task.policies[i] for i in task.uag_policies[ui]]
+    for ai, (aag_id, aag_cost) in enumerate(task.aag_costs):
+      group_cost = uag_cost * aag_cost
+      if beaten(group_cost * min_tail):
+        continue
+      app_policies = [p for p in user_policies if aag_id in p.app_groups]
+      for ci, (client_app_type, client_app_type_cost) in enumerate(task.client_app_type_costs):
+        client_policies = [p for p in app_policies if client_app_type in p.client_app_types]
+        for uri, (user_risk, user_risk_cost) in enumerate(task.user_risk_costs):
+          for sri, (signin_risk, signin_risk_cost) in enumerate(task.signin_risk_costs):
+            cell_cost = group_cost * client_app_type_cost * user_risk_cost * signin_risk_cost
+            if beaten(cell_cost):
+              continue
+            applying = tuple(p for p in client_policies
+                             if (p.user_risk_levels is None or user_risk in p.user_risk_levels)
+                             and (p.signin_risk_levels is None or signin_risk in p.signin_risk_levels))
+            if applying not in cheapest_controls:
+              cheapest_controls[applying] = _cheapest_controls(task, applying)
+            controls = cheapest_controls[applying]
+            if controls is None or beaten(cell_cost * controls[0]):
+              continue
+            position = (ui, ai, ci, uri, sri)
+            entry = (-cell_cost * controls[0], tuple(-i for i in position), controls[1])
+            if len(best) < number_of_solutions:
+              heapq.heappush(best, entry)
+            else:
+              heapq.heapreplace(best, entry)
+
+  return [(-cost, tuple(-i for i in position), bits) for cost, position, bits in best]
+
+
+def _to_solution(task: _EnumerationTask, cost: int, position: tuple, bits: int) -> ScenarioSolution:
+  ui, ai, ci, uri, sri = position
+  uag_id, uag_cost = task.uag_costs[ui]
+  aag_id, aag_cost = task.aag_costs[ai]
+  client_app_type, client_app_type_cost = task.client_app_type_costs[ci]
+  user_risk, user_risk_cost = task.user_risk_costs[uri]
+  signin_risk, signin_risk_cost = task.signin_risk_costs[sri]
+  control_parts = [c if bits & (1 << i) else UNUSED_VARIABLE_COST for i, c in enumerate(task.control_costs)]
+  return ScenarioSolution(
+    cost=cost,
+    cell=ScenarioCell(uag_id, aag_id, client_app_type, user_risk, signin_risk),
+    controls=[c for i, c in enumerate(task.controls) if bits & (1 << i)],
+    # Same order as cost_user and cost_vector of the CP model
+    cost_parts=[uag_cost, aag_cost, UNUSED_VARIABLE_COST, signin_risk_cost, user_risk_cost, client_app_type_cost] + control_parts
+  )
+
+
+def enumerate_cheapest_scenarios(args, policyModels: List[PolicyModel], generalInfo: GeneralInfo) -> List[ScenarioSolution]:
+  """
+  Exhaustive alternative to translate_policymodels_to_task: the
+  args.number_of_solutions cheapest scenarios, each with the cheapest grant
+  controls that pass every policy applying to it, by the same costs.
+
+  Unlike the CP loop, which bans one variable assignment per solution and so
+  may return the same scenario with other controls, each scenario is listed
+  once. Ties are ordered by scenario. User groups are split across
+  args.workers processes.
+  """
+  task = _create_enumeration_task(args, policyModels, generalInfo)
+  workers = max(1, min(args.workers or 1, len(task.uag_costs)))
+  # Round robin, as user group costs (and so pruning) follow the group order
+  shards = [list(range(i, len(task.uag_costs), workers)) for i in range(workers)]
+  if workers == 1:
+    results = [_enumerate_shard(task, shards[0], args.number_of_solutions)]
+  else:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(_enumerate_shard, [task] * workers, shards, [args.number_of_solutions] * workers))
+
+  best = heapq.nsmallest(args.number_of_solutions, itertools.chain(*results), key=lambda r: (r[0], r[1]))
+  solutions = [_to_solution(task, *r) for r in best]
+
+  for i, solution in enumerate(solutions):
+    cell = solution.cell
+    vars = ['UG%s' % cell.user_group, 'AG%s' % cell.app_group, 'ClientAppType:%s' % cell.client_app_type]
+    if cell.signin_risk is not None:
+      vars.append('SigninRisk:%s' % cell.signin_risk)
+    if cell.user_risk is not None:
+      vars.append('UserRisk:%s' % cell.user_risk)
+    vars.extend('Control:%s' % c for c in solution.controls)
+    cost_parts = '*'.join([str(v) for v in solution.cost_parts])
+    print('Solution #%d: %s cost=%d (%s)' % (i, ', '.join(vars), solution.cost, cost_parts))
+  return solutions
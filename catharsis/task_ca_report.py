@@ -1,7 +1,7 @@
 import os
 import shutil
 
-from catharsis.ca import create_policymodels
+from catharsis.ca import create_policymodels, restrict_policymodels
 from catharsis.reporting import create_report_section, mk_html5_doc
 from catharsis.settings import mk_summary_report_path, mk_summary_report_aux_path
 from catharsis.typedefs import RunConf
@@ -27,19 +27,20 @@ async def do_task_ca_report(args: RunConf):
   body_content = ''
   all_users = list((await get_all_users(args)).values())
   # create pre-model separately and translate it later to cpmpy
-  policy_models, generalInfo = await create_policymodels(args, all_users)
-  body_content += await create_report_section(args, policy_models, generalInfo, 'All users')
+  all_policy_models, all_generalInfo = await create_policymodels(args, all_users)
+  body_content += await create_report_section(args, all_policy_models, all_generalInfo, 'All users')
 
+  # Other sections are subsets of all users: restrict the computed models
   active = [u for u in all_users if utils.is_principal_account_enabled(u)]
-  policy_models, generalInfo = await create_policymodels(args, active)
+  policy_models, generalInfo = restrict_policymodels(all_policy_models, all_generalInfo, active)
   body_content += await create_report_section(args, policy_models, generalInfo, 'All active users (%s)' % count_s(len(active), len(all_users)))
 
   active_internal = [u for u in active if not utils.is_user_external(u)]
-  policy_models, generalInfo = await create_policymodels(args, active_internal)
+  policy_models, generalInfo = restrict_policymodels(all_policy_models, all_generalInfo, active_internal)
   body_content += await create_report_section(args, policy_models, generalInfo, 'All active & internal (%s)' % count_s(len(active_internal), len(all_users)))
 
   active_external = [u for u in active if utils.is_user_external(u)]
-  policy_models, generalInfo = await create_policymodels(args, active_external)
+  policy_models, generalInfo = restrict_policymodels(all_policy_models, all_generalInfo, active_external)
   body_content += await create_report_section(args, policy_models, generalInfo, 'All active & guest (%s)' % count_s(len(active_external), len(all_users)))
 
   # TODO Add Service Principals
@@ -0,0 +1,37 @@
+import datetime
+import os
+
+from catharsis.cache_manifest import CacheManifest, summarize_manifest
+from catharsis.typedefs import RunConf
+import catharsis.cached_get as c
+
+
+import logging
+logger = logging.getLogger('catharsis.task_cache')
+logger.setLevel(logging.INFO)
+
+
+def format_timestamp(ts: float) -> str:
+  return datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')
+
+
+async def do_task_cache_stats(args: RunConf):
+  if not c.is_cache_persisted(args):
+    raise Exception('cache stats needs --persist-cache-dir')
+  rows = summarize_manifest(args.persist_cache_dir)
+  print(f'{"family":<20} {"entries":>8} {"objects":>10} {"KiB":>10}  {"oldest":<16}  {"newest":<16}  tenants')
+  for row in rows:
+    print(f'{row["family"]:<20} {row["entries"]:>8} {row["objects"]:>10} {row["bytes"] / 1024:>10.1f}  {format_timestamp(row["oldest"]):<16}  {format_timestamp(row["newest"]):<16}  {", ".join(sorted(row["tenants"])) or "-"}')
+
+  manifest = CacheManifest(args.persist_cache_dir)
+  manifest.refresh()
+  unrecorded = [key for key in c.list_cached_keys(args, '') if os.path.basename(key) not in manifest.entries]
+  if unrecorded:
+    logger.info('%d cache entries were written before the manifest and are not included.', len(unrecorded))
+
+
+def add_cache_subparser(subparsers):
+  cache_parser = subparsers.add_parser('cache')
+  cache_subparsers = cache_parser.add_subparsers(required=True)
+  stats_parser = cache_subparsers.add_parser('stats', help='Summarize the manifest of --persist-cache-dir.')
+  stats_parser.set_defaults(task_func=do_task_cache_stats)
@@ -1,5 +1,8 @@
+import os
+
 from catharsis.ca import create_policymodels
-from catharsis.solver import translate_policymodels_to_task
+from catharsis.solver import enumerate_cheapest_scenarios, translate_policymodels_to_task
+from catharsis import coverage
 from catharsis.typedefs import RunConf
 from catharsis.graph_query import get_all_users
 from catharsis import utils
@@ -19,20 +22,32 @@ except ImportError:
   solver_imports_available = False
 
 async def do_task_solver(args: RunConf):
-  if not solver_imports_available:
+  if args.backend == 'ortools' and not solver_imports_available:
     raise Exception("cpmpy related libraries are not available!")
   logger.warning('This solver is really, really experimental.')
 
   all_users = list((await get_all_users(args)).values())
   active = [u for u in all_users if utils.is_principal_account_enabled(u)]
-  policy_models, generalInfo = await create_policymodels(args, active)
-
-  # create model
-  translate_policymodels_to_task(args, policy_models, generalInfo)
+  policy_models, generalInfo = await create_policymodels(args, active, population='active_users')
+
+  if coverage.np is not None:
+    scenario_coverage = coverage.evaluate_scenario_coverage(policy_models, generalInfo)
+    unprotected = scenario_coverage.cells(scenario_coverage.unprotected())
+    logger.info('%d of %d scenarios have no MFA or block.', len(unprotected), scenario_coverage.blocked.size)
+    for cell in unprotected[:args.number_of_solutions]:
+      logger.info('No MFA or block: %s', cell)
+
+  if args.backend == 'enumerate':
+    enumerate_cheapest_scenarios(args, policy_models, generalInfo)
+  else:
+    # create model
+    translate_policymodels_to_task(args, policy_models, generalInfo)
   logger.info('Task ready.')
 
 
 def add_solver_subparser(subparsers):
   solver_parser = subparsers.add_parser('solver')
   solver_parser.set_defaults(task_func=do_task_solver)
-  solver_parser.add_argument('--number-of-solutions', type=int, default=5)
\ No newline at end of file
+  solver_parser.add_argument('--number-of-solutions', type=int, default=5)
+  solver_parser.add_argument('--backend', choices=['ortools', 'enumerate'], default='ortools', help='ortools: cpmpy model solved with OR-Tools. enumerate: exhaustive search over all scenarios, no cpmpy needed. Default: ortools')
+  solver_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='enumerate: number of processes the user groups are split across. Default: number of CPUs')
\ No newline at end of file
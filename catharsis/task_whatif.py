@@ -0,0 +1,43 @@
+import sys
+
+from catharsis.ca import create_policymodels
+from catharsis.typedefs import RunConf
+from catharsis.graph_query import get_all_users
+from catharsis.whatif import WHATIF_FORMATS, WhatIfEvaluator, read_scenarios, write_results
+
+
+import logging
+logger = logging.getLogger('catharsis.task_whatif')
+logger.setLevel(logging.INFO)
+
+
+def get_whatif_format(args, path: str) -> str:
+  if args.format != 'auto':
+    return args.format
+  return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+async def do_task_whatif(args: RunConf):
+  all_users = list((await get_all_users(args)).values())
+  policy_models, generalInfo = await create_policymodels(args, all_users)
+  evaluator = WhatIfEvaluator(policy_models, generalInfo)
+
+  in_f = sys.stdin if args.scenarios == '-' else open(args.scenarios, newline='')
+  out_f = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+  try:
+    scenarios = read_scenarios(in_f, get_whatif_format(args, args.scenarios))
+    count = write_results(out_f, evaluator.evaluate_all(scenarios), get_whatif_format(args, args.output))
+  finally:
+    if in_f is not sys.stdin:
+      in_f.close()
+    if out_f is not sys.stdout:
+      out_f.close()
+  logger.info('Evaluated %d scenarios in %d scenario cells.', count, len(evaluator.cells))
+  logger.info('Task ready.')
+
+
+def add_whatif_subparser(subparsers):
+  whatif_parser = subparsers.add_parser('what-if')
+  whatif_parser.add_argument('scenarios', type=str, help='CSV or JSONL file of sign-in scenarios, - for stdin. Fields: principal_id, app_id, client_app_type, user_risk, signin_risk (or userId, appId, clientAppUsed, riskLevelAggregated, riskLevelDuringSignIn of exported sign-in logs).')
+  whatif_parser.add_argument('--output', type=str, default='-', help='File to write the applying policies and controls of each scenario to. Default: stdout')
+  whatif_parser.add_argument('--format', choices=['auto'] + WHATIF_FORMATS, default='auto', help='Format of scenarios and output. auto: csv for .csv files, otherwise jsonl. Default: auto')
+  whatif_parser.set_defaults(task_func=do_task_whatif)
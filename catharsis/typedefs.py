@@ -1,5 +1,5 @@
 from enum import Enum, auto
-from typing import List, Optional, Set, TypeAlias, NamedTuple, Mapping, Any
+from typing import Iterable, List, Optional, Set, TypeAlias, NamedTuple, Mapping, Any
 import json
 import argparse
 from dataclasses import dataclass
@@ -9,6 +9,7 @@ RunConf: TypeAlias = argparse.Namespace
 from typing import TypeAlias, NamedTuple
 
 PrincipalGuid: TypeAlias = str
+PrincipalIdx: TypeAlias = int   # Dense per-run id, see catharsis.principal_index
 PrincipalDisplayname: TypeAlias = str
 CAGuid: TypeAlias = str
 SubGuid: TypeAlias = str
@@ -19,11 +20,12 @@ MGName: TypeAlias = str
 # ca-tharsis internal structures
 
 class UserTargetingDefinition(NamedTuple):
-  included_users: List[PrincipalDisplayname]
+  # Iterables of display names, formatted lazily (see principal_index.TargetedPrincipals)
+  included_users: Iterable[PrincipalDisplayname]
   included_groups: List[str]
   included_roles: List[str]
   includeGuestsOrExternalUsers: List[str]
-  excluded_users: List[PrincipalDisplayname]
+  excluded_users: Iterable[PrincipalDisplayname]
   excluded_groups: List[str]
   excluded_roles: List[str]
   excludeGuestsOrExternalUsers: List[str]
@@ -58,6 +60,12 @@ class GeneralInfo(NamedTuple):
   seen_app_user_actions: Any
   users_count: Any
   apps_count: Any
+  # Translates the principal ids in user groups and policy members back to GUIDs
+  principal_index: Any = None
+  # PartitionIndex: principal id -> user group, user group -> policy ids (signature)
+  user_partition: Any = None
+  # PartitionIndex: app -> app group, app group -> policy ids (signature)
+  app_partition: Any = None
 
 
 # entra structures / mappings
@@ -104,6 +112,14 @@ class AssignedMember:
   principalId: str
   principalType: PrincipalType   # microsoft.graph.[user,group,servicePrincipal]
 
+@dataclass
+class MemberReferences:
+  """
+  Members stored by reference, in assignment order: Group entries stand for
+  the cached transitive members of the group, others are members as such.
+  """
+  entries: List[AssignedMember]
+
 @dataclass
 class Tenant:
   tenantId: str
@@ -185,6 +201,7 @@ decoded_dataclasses = {
   'UserPrincipalDetails': UserPrincipalDetails,
   'ServicePrincipalDetails': ServicePrincipalDetails,
   'AssignedMember': AssignedMember,
+  'MemberReferences': MemberReferences,
   'Tenant': Tenant,
   'AzureSub': AzureSub,
   'AzureMG': AzureMG,
@@ -1,14 +1,21 @@
+import asyncio
 import math
 import os
+import time
 
+from itertools import islice
 from typing import Iterable, Set
 
 from catharsis.typedefs import PrincipalGuid, RunConf
-from catharsis.graph_query import get_group_transitive_members, get_role_transitive_members
+from catharsis.graph_query import get_group_transitive_members, get_role_transitive_members, get_unresolved_role_assignments
 
 import catharsis.typedefs as CT
 import catharsis.graph_query as queries
 
+import logging
+logger = logging.getLogger('catharsis.utils')
+logger.setLevel(logging.INFO)
+
 
 def ensure_cache_and_workdir(args: RunConf):
   if args.persist_cache_dir and not os.path.exists(args.persist_cache_dir):
@@ -18,6 +25,14 @@ def ensure_cache_and_workdir(args: RunConf):
     os.makedirs(args.report_dir)
 
 
+def positive_int(value: str) -> int:
+  """ argparse type for counts that must be at least 1 """
+  number = int(value)
+  if number < 1:
+    raise ValueError('Expected a number >= 1: %s' % value)
+  return number
+
+
 def count_s(a, b):
   frac = math.floor(a / b * 100)
   return '%d of %d / %s %%' % (a,b,frac)
@@ -37,14 +52,66 @@ async def list_ca_referred_groups_roles(args):
   return set(groups), set(roles)
 
 
-async def prefetch_ca_memberships_with_query(args):
+def chunk(it, size):
+  it = iter(it)
+  return iter(lambda: tuple(islice(it, size)), ())
+
+
+async def _timed_fetch(semaphore: asyncio.Semaphore, latencies: dict, kind: str, object_ids: Iterable[str], fetch_fn, *fetch_args):
+  async with semaphore:
+    started = time.perf_counter()
+    result = await fetch_fn(*fetch_args)
+    latency = time.perf_counter() - started
+    for object_id in object_ids:
+      # Objects fetched in the same batch share the latency
+      latencies[(kind, object_id)] = latency
+    logger.debug('Fetched %s %s in %.2fs', kind, ','.join(object_ids), latency)
+    return result
+
+
+async def prefetch_ca_memberships_with_query(args) -> dict[tuple[str, str], float]:
+  """
+  Fetch members of all CA referenced groups and roles, at most
+  args.graph_concurrency requests at a time. With args.graph_batch_size > 1
+  each request is a Graph /$batch of that many objects. Returns fetch latency
+  in seconds by (kind, object id).
+  """
   groups, roles = await list_ca_referred_groups_roles(args)
+  semaphore = asyncio.Semaphore(args.graph_concurrency)
+  batch_size = min(args.graph_batch_size, queries.GRAPH_BATCH_MAX_REQUESTS)
+  latencies: dict[tuple[str, str], float] = {}
+  started = time.perf_counter()
+
+  async def fetch_all(kind, object_ids, fetch_fn, batch_fetch_fn):
+    if batch_size > 1:
+      await asyncio.gather(*[
+        _timed_fetch(semaphore, latencies, kind, ids, batch_fetch_fn, args, list(ids))
+        for ids in chunk(sorted(object_ids), batch_size)])
+    else:
+      await asyncio.gather(*[
+        _timed_fetch(semaphore, latencies, kind, [object_id], fetch_fn, args, object_id)
+        for object_id in object_ids])
+
+  # Role assignments first: groups assigned to roles are fetched
+  # together with (and deduplicated against) directly referenced groups.
+  await fetch_all('role', roles, get_unresolved_role_assignments, queries.prefetch_unresolved_role_assignments)
+  role_groups = set()
+  for role_id in roles:
+    assignments = await get_unresolved_role_assignments(args, role_id)
+    role_groups.update([a.principalId for a in assignments if a.principalType == CT.PrincipalType.Group])
+  all_groups = groups | role_groups
+
+  await fetch_all('group', all_groups, get_group_transitive_members, queries.prefetch_group_transitive_members)
 
+  # Groups are in cache now, this only expands them
   for role_id in roles:
     await get_role_transitive_members(args, role_id)
 
-  for group_id in groups:
-    await get_group_transitive_members(args, group_id)
+  logger.info('Prefetched %d roles and %d groups (%d only via roles) in %.1fs with concurrency %d, batch size %d.',
+    len(roles), len(all_groups), len(role_groups - groups), time.perf_counter() - started, args.graph_concurrency, batch_size)
+  for (kind, object_id), latency in sorted(latencies.items(), key=lambda i: i[1], reverse=True)[:5]:
+    logger.info('Slowest prefetch: %s %s %.2fs', kind, object_id, latency)
+  return latencies
 
 
 def principal_to_principal_id(principal: CT.Principal) -> PrincipalGuid:
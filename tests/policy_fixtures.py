@@ -0,0 +1,35 @@
+""" Policy models and GeneralInfo for tests working on artificial groups """
+from catharsis.disjoint_sets import PartitionIndex
+from catharsis.settings import ALL_CLIENT_APP_TYPES
+from catharsis.typedefs import GeneralInfo, PolicyModel
+
+def policy(name, usergroups, applications, grant_controls, operator='OR', client_app_types=None, user_risk=None, signin_risk=None, strength=None, session_controls=None):
+    return PolicyModel(
+        id=name, name=name, members=set(), enabled=True, targeting_definition=None,
+        condition_usergroups=usergroups,
+        condition_applications=applications,
+        condition_application_user_action=set(),
+        condition_client_app_types=set(client_app_types or ALL_CLIENT_APP_TYPES),
+        condition_signin_risk_levels=set(signin_risk or []),
+        condition_user_risk_levels=set(user_risk or []),
+        grant_operator=operator,
+        grant_controls=grant_controls,
+        grant_authentication_strength=strength,
+        session_controls=session_controls or [])
+
+def mk_general_info(user_groups, app_groups, policies=None, principal_index=None):
+    """ Partition indexes are built when the policies are given """
+    general_info = GeneralInfo(
+        disjoint_artificial_user_groups=user_groups,
+        disjoint_artificial_app_groups=app_groups,
+        seen_grant_controls={'mfa', 'block', 'compliantDevice'},
+        seen_session_controls=set(),
+        seen_app_user_actions=set(),
+        users_count=len(set().union(*user_groups.values())),
+        apps_count=len(set().union(*app_groups.values())),
+        principal_index=principal_index)
+    if policies is None:
+        return general_info
+    return general_info._replace(
+        user_partition=PartitionIndex({pm.id: pm.condition_usergroups for pm in policies}, user_groups),
+        app_partition=PartitionIndex({pm.id: pm.condition_applications for pm in policies}, app_groups))
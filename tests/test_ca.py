@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+import catharsis.cached_get as c
+from catharsis.ca import resolve_members_for_policy_objects
+from catharsis.principal_index import PrincipalIndex
+from catharsis.typedefs import AssignedMember, PrincipalType
+
+def ca_policy(policy_id, include_users=(), include_groups=(), include_roles=(), exclude_users=(), exclude_groups=(), exclude_roles=()):
+    return {'id': policy_id, 'state': 'enabled', 'conditions': {'users': {
+        'includeUsers': list(include_users), 'includeGroups': list(include_groups), 'includeRoles': list(include_roles),
+        'excludeUsers': list(exclude_users), 'excludeGroups': list(exclude_groups), 'excludeRoles': list(exclude_roles)}}}
+
+def members(*user_ids):
+    return [AssignedMember(u, PrincipalType.User) for u in user_ids]
+
+class TestResolveMembers(unittest.TestCase):
+
+    def setUp(self):
+        c.set_cache_backends()
+
+    def test_members_are_resolved_once_per_run(self):
+        args = SimpleNamespace(persist_cache_dir=None, include_report_only=False)
+        index = PrincipalIndex(['u%d' % i for i in range(6)])
+        c.set_cached(c.mk_ca_path(args), [
+            ca_policy('all', include_users=['All'], exclude_groups=['breakglass']),
+            ca_policy('admins', include_roles=['r1'], include_users=['u5'], exclude_groups=['breakglass'], exclude_users=['u2']),
+            ca_policy('staff', include_groups=['staff', 'breakglass'], exclude_roles=['r1'], exclude_groups=['breakglass']),
+        ])
+        c.set_cached(c.mk_group_result_transitive_path(args, 'breakglass'), members('u0'))
+        c.set_cached(c.mk_group_result_transitive_path(args, 'staff'), members('u1', 'u3', 'u4', 'removed'))
+        c.set_cached(c.mk_role_assignment_raw_path(args, 'r1'), members('u0', 'u1', 'u2'))
+
+        selection = {0, 1, 2, 3, 4}
+        memberships = asyncio.run(resolve_members_for_policy_objects(args, selection, index))
+        self.assertEqual(memberships, {'all': {1, 2, 3, 4}, 'admins': {1}, 'staff': {3, 4}})
+        self.assertEqual(selection, {0, 1, 2, 3, 4})
+        self.assertEqual(sorted(args._member_sets.keys()), [('group', 'breakglass'), ('group', 'staff'), ('role', 'r1')])
+
+        # Later sections reuse the converted sets
+        c.set_cached(c.mk_group_result_transitive_path(args, 'breakglass'), [])
+        self.assertEqual(asyncio.run(resolve_members_for_policy_objects(args, {0, 1}, index))['all'], {1})
+        self.assertEqual(asyncio.run(resolve_members_for_policy_objects(args, {0, 5}, index))['admins'], {5})
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import tempfile
+import unittest
+import catharsis.cached_get as c
+from catharsis.graph_query import cached_query
+from catharsis.cache_backends import *
+from catharsis.cache_manifest import CacheManifest, ManifestCacheLayer, summarize_manifest
+from catharsis.typedefs import *
+
+USER = Principal(
+    id='1-2-3-4',
+    displayName='John Doe',
+    accountEnabled=True,
+    raw=None,
+    usertype=PrincipalType.User,
+    userDetails=UserPrincipalDetails(upn='john.doe@domain.com')
+)
+
+class TestCacheBackends(unittest.TestCase):
+
+    def tearDown(self):
+        c.set_cache_backends()
+
+    def test_key_families(self):
+        self.assertEqual(key_family('mem:/all_users.json'), 'users')
+        self.assertEqual(key_family('/cache/all_users_deltalink.json'), 'deltalinks')
+        self.assertEqual(key_family('/cache/ca.json'), 'ca')
+        self.assertEqual(key_family('/cache/role_abc_resolved.json'), 'roles')
+        self.assertEqual(parse_cache_ttl('users=24h'), ('users', 86400.0))
+        self.assertRaises(ValueError, parse_cache_ttl, 'cats=1h')
+
+    def test_memory_backend_evicts_least_recently_used(self):
+        backend = MemoryCacheBackend(max_entries=2)
+        backend.set('mem:/a.json', 1)
+        backend.set('mem:/b.json', 2)
+        backend.get('mem:/a.json')
+        backend.set('mem:/c.json', 3)
+        self.assertEqual(sorted(backend.names('mem:')), ['a.json', 'c.json'])
+
+    def test_persistent_backends_round_trip(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for backend in [DirectoryCacheBackend(), SqliteCacheBackend(os.path.join(cache_dir, 'cache.sqlite3'))]:
+                key = os.path.join(cache_dir, 'all_users.json')
+                self.assertIsNone(backend.stored_at(key))
+                backend.set(key, {USER.id: USER})
+                self.assertIsNotNone(backend.stored_at(key))
+                self.assertEqual(backend.get(key)[USER.id].userDetails, USER.userDetails)
+                self.assertIn('all_users.json', backend.names(cache_dir))
+                backend.delete(key)
+                self.assertIsNone(backend.get(key))
+
+    def test_entries_expire_by_family(self):
+        memory = MemoryCacheBackend()
+        c.set_cache_backends(memory=memory, ttls={'ca': 3600})
+        c.set_cached('mem:/ca.json', ['policy'])
+        c.set_cached('mem:/all_users.json', {})
+        self.assertEqual(c.get_cached('mem:/ca.json'), ['policy'])
+        for key in list(memory.entries.keys()):
+            value, stored_at = memory.entries[key]
+            memory.entries[key] = (value, stored_at - 7200)
+        self.assertIsNone(c.get_cached('mem:/ca.json'))
+        self.assertFalse(c.is_cached('mem:/ca.json'))
+        self.assertEqual(c.get_cached('mem:/all_users.json'), {})
+
+    def test_hot_layer_decodes_once_until_entry_changes(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            key = os.path.join(cache_dir, 'group_g1.json')
+            layer = HotCacheLayer(DirectoryCacheBackend())
+            layer.set(key, [1])
+            self.assertEqual(layer.get(key), [1])
+            self.assertEqual(layer.get(key), [1])
+            DirectoryCacheBackend().set(key, [1, 2])
+            self.assertEqual(layer.get(key), [1, 2])
+            self.assertEqual(layer.stats(), {'hits': 2, 'misses': 1, 'entries': 1})
+            layer.delete(key)
+            self.assertIsNone(layer.get(key))
+
+    def test_directory_writes_leave_no_partial_files(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            key = os.path.join(cache_dir, 'ca.json')
+            DirectoryCacheBackend().set(key, ['a'])
+            DirectoryCacheBackend('binary').set(key, ['b'])
+            self.assertEqual(os.listdir(cache_dir), ['ca.json'])
+            self.assertEqual(DirectoryCacheBackend().get(key), ['b'])
+
+    @unittest.skipIf(c.fcntl is None, 'No advisory locks')
+    def test_concurrent_fetches_of_persisted_key_are_coalesced(self):
+        calls = []
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return ['member']
+
+        async def run(key):
+            return await asyncio.gather(cached_query(None, key, fetch), cached_query(None, key, fetch))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            c.set_cache_backends()
+            results = asyncio.run(run(os.path.join(cache_dir, 'group_g1.json')))
+            self.assertEqual(results, [['member'], ['member']])
+            self.assertEqual(len(calls), 1)
+
+    def test_manifest_records_entries_for_other_processes(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            layer = ManifestCacheLayer(DirectoryCacheBackend())
+            layer.set(os.path.join(cache_dir, 'tenantid.json'), Tenant('t1', 'Tenant', 'example.com'))
+            layer.set(os.path.join(cache_dir, 'group_g1.json'), [AssignedMember('u1', PrincipalType.User)] * 3)
+            layer.set(os.path.join(cache_dir, 'group_g2.json'), [])
+            layer.delete(os.path.join(cache_dir, 'group_g2.json'))
+
+            other_process = CacheManifest(cache_dir)
+            entry = other_process.get('group_g1.json')
+            self.assertEqual((entry.tenant_id, entry.object_count), ('t1', 3))
+            self.assertEqual(entry.size, os.path.getsize(os.path.join(cache_dir, 'group_g1.json')))
+            self.assertIsNone(other_process.get('group_g2.json'))
+            self.assertEqual(layer.stored_at(os.path.join(cache_dir, 'group_g1.json')), entry.fetched_at)
+
+            layer.set(os.path.join(cache_dir, 'group_g1.json'), [])
+            self.assertEqual(other_process.get('group_g1.json').object_count, 0)
+            self.assertEqual([(f['family'], f['entries']) for f in summarize_manifest(cache_dir)], [('groups', 1), ('tenant', 1)])
+
+            # File removed without the tool: a miss once read
+            os.remove(os.path.join(cache_dir, 'group_g1.json'))
+            self.assertIsNone(layer.get(os.path.join(cache_dir, 'group_g1.json')))
+            self.assertIsNone(CacheManifest(cache_dir).get('group_g1.json'))
+            self.assertIsNone(layer.stored_at(os.path.join(cache_dir, 'group_g1.json')))
+            self.assertIsNone(layer.fingerprint(os.path.join(cache_dir, 'group_g1.json')))
@@ -0,0 +1,74 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+import catharsis.cached_get as c
+from catharsis.graph_query import cached_query, get_role_transitive_members
+from catharsis.typedefs import AssignedMember, MemberReferences, PrincipalType
+
+class TestCachedQuery(unittest.TestCase):
+
+    def setUp(self):
+        c.set_cache_backends()
+
+    def test_concurrent_calls_share_one_fetch(self):
+        calls = []
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ['member']
+
+        async def run():
+            return await asyncio.gather(*[cached_query(None, 'mem:/group_g1.json', fetch) for _ in range(5)])
+
+        results = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_failure_propagates_to_all_waiters_and_is_not_cached(self):
+        calls = []
+        async def failing_fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError('fetch failed')
+
+        async def fetch():
+            return ['member']
+
+        async def run():
+            results = await asyncio.gather(*[cached_query(None, 'mem:/group_g2.json', failing_fetch) for _ in range(3)], return_exceptions=True)
+            return results, await cached_query(None, 'mem:/group_g2.json', fetch)
+
+        results, retried = asyncio.run(run())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(retried, ['member'])
+
+    def test_cancelled_waiter_does_not_cancel_the_fetch(self):
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return ['member']
+
+        async def run():
+            leader = asyncio.create_task(cached_query(None, 'mem:/group_g3.json', fetch))
+            waiter = asyncio.create_task(cached_query(None, 'mem:/group_g3.json', fetch))
+            await asyncio.sleep(0.01)
+            waiter.cancel()
+            return await leader
+
+        self.assertEqual(asyncio.run(run()), ['member'])
+
+    def test_role_members_are_stored_as_references(self):
+        args = SimpleNamespace(persist_cache_dir=None)
+        user, sp = AssignedMember('u1', PrincipalType.User), AssignedMember('s1', PrincipalType.ServicePrincipal)
+        c.set_cached(c.mk_role_assignment_raw_path(args, 'r1'), [AssignedMember('g1', PrincipalType.Group), user, sp])
+        c.set_cached(c.mk_group_result_transitive_path(args, 'g1'), [AssignedMember('u2', PrincipalType.User), user])
+
+        members = asyncio.run(get_role_transitive_members(args, 'r1'))
+        self.assertEqual([m.principalId for m in members], ['u2', 'u1', 's1'])
+        stored = c.get_cached(c.mk_role_result_transitive_path(args, 'r1'))
+        self.assertEqual(stored, MemberReferences(entries=[AssignedMember('g1', PrincipalType.Group), user, sp]))
+
+        # Group changes show up without refetching the role
+        c.set_cached(c.mk_group_result_transitive_path(args, 'g1'), [])
+        members = asyncio.run(get_role_transitive_members(args, 'r1'))
+        self.assertEqual([m.principalId for m in members], ['u1', 's1'])
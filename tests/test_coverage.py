@@ -0,0 +1,36 @@
+import unittest
+from catharsis.coverage import *
+from policy_fixtures import mk_general_info, policy
+
+GENERAL_INFO = mk_general_info({0: {1, 2, 3}, 1: {4}, 2: {5}}, {0: {'app1'}, 1: {'app2'}})
+
+@unittest.skipIf(np is None, 'numpy not available')
+class TestScenarioCoverage(unittest.TestCase):
+
+    def test_unprotected_cells(self):
+        policies = [
+            policy('mfa', [0, 1], [0, 1], ['mfa']),
+            policy('legacy auth', [0, 1], [0, 1], ['block'], client_app_types=['exchangeActiveSync', 'other']),
+            policy('mfa in browser', [2], [0, 1], ['mfa'], client_app_types=['browser']),
+            policy('strength for app1', [2], [0], [], strength={'id': 'phishing resistant'}),
+            # Alternatives: MFA is not required
+            policy('mfa or device', [2], [1], ['mfa', 'compliantDevice'], user_risk=['high'])
+        ]
+
+        result = evaluate_scenario_coverage(policies, GENERAL_INFO)
+        self.assertEqual(result.shape, (3, 2, 4, 4, 4))
+        self.assertEqual(result.controls, ['authStrength', 'mfa'])
+        cells = result.cells(result.unprotected())
+        self.assertEqual(len(cells), 3 * 4 * 4)
+        self.assertEqual(set(c.client_app_type for c in cells), {'mobileAppsAndDesktopClients', 'exchangeActiveSync', 'other'})
+        self.assertTrue(all(c.user_group == 2 and c.app_group == 1 for c in cells))
+        self.assertTrue(result.blocked[0, 0, ALL_CLIENT_APP_TYPES.index('other')].all())
+        self.assertEqual(result.policy_counts[2, 0, 0, 0, 0], 2)
+
+    def test_risk_conditions_restrict_levels(self):
+        policies = [policy('risky sign-ins', [0, 1, 2], [0, 1], ['mfa'], signin_risk=['high', 'medium'])]
+        result = evaluate_scenario_coverage(policies, GENERAL_INFO)
+        protected_levels = [ALL_SIGNIN_RISK_LEVELS[i] for i in range(4) if result.requires('mfa')[0, 0, 0, 0, i]]
+        self.assertEqual(protected_levels, ['high', 'medium'])
+        self.assertFalse(result.requires('compliantDevice').any())
+        self.assertEqual(result.unprotected().sum(), 3 * 2 * 4 * 4 * 2)
@@ -1,5 +1,14 @@
 import unittest
+import json
+import random
+from types import SimpleNamespace
+import catharsis.cached_get as c
 from catharsis.disjoint_sets import *
+from catharsis.principal_index import PrincipalIndex
+
+def random_groups(rnd, members, count):
+    """ count groups of random members, sizes from empty to all """
+    return [GroupMembers('pol%d' % i, set(rnd.sample(members, rnd.randint(0, len(members))))) for i in range(count)]
 
 class TestStringMethods(unittest.TestCase):
 
@@ -115,3 +124,134 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(tg['pol3'], [0,1,3,4,5])
         self.assertEqual(tg['pol4'], [3,4])
         self.assertEqual(tg['pol5'], [5])
+
+    def test_signature_grouping_matches_ordered(self):
+        groups = [
+            GroupMembers('pol1', set(range(1,21))),
+            GroupMembers('pol2', set(range(1,7))),
+            GroupMembers('pol3', set(range(1,17))),
+            GroupMembers('pol4', set([4,10,11])),
+            GroupMembers('pol5', set([6])),
+            GroupMembers('pol6', set())
+        ]
+
+        self.assertEqual(split_to_disjoint_sets_by_signature(groups), split_to_disjoint_sets_ordered(groups))
+
+    def test_signature_grouping_matches_ordered_random(self):
+        rnd = random.Random(1234)
+        users = ['%08x-user' % rnd.getrandbits(32) for _ in range(300)]
+        groups = random_groups(rnd, users, 12)
+
+        self.assertEqual(split_to_disjoint_sets_by_signature(groups), split_to_disjoint_sets_ordered(groups))
+
+    def test_int_member_ids_include_zero(self):
+        # Principal index ids start from 0
+        groups = [GroupMembers('p1', {0, 1, 2}), GroupMembers('p2', {0, 3})]
+        expected = ({'p1': [0, 1], 'p2': [1, 2]}, {0: {1, 2}, 1: {0}, 2: {3}})
+        self.assertEqual(split_to_disjoint_sets_ordered(groups), expected)
+        self.assertEqual(split_to_disjoint_sets_by_signature(groups), expected)
+
+    def test_signature_grouping_empty_works(self):
+        self.assertEqual(split_to_disjoint_sets_by_signature([]), ({}, {}))
+
+    @unittest.skipIf(np is None, 'numpy not available')
+    def test_numpy_grouping_matches_ordered(self):
+        rnd = random.Random(4321)
+        groups = random_groups(rnd, list(range(300)), 20)
+        groups.append(GroupMembers('empty', set()))
+
+        self.assertEqual(split_to_disjoint_sets_numpy(groups), split_to_disjoint_sets_ordered(groups))
+        self.assertEqual(split_to_disjoint_sets_numpy([]), ({}, {}))
+
+    def test_partition_backend_selection(self):
+        self.assertIs(get_partition_function('signature'), split_to_disjoint_sets_by_signature)
+        self.assertIs(get_partition_function('reference'), split_to_disjoint_sets_ordered)
+        expected_auto = split_to_disjoint_sets_numpy if np is not None else split_to_disjoint_sets_by_signature
+        self.assertIs(get_partition_function('auto'), expected_auto)
+        with self.assertRaises(Exception):
+            get_partition_function('nope')
+
+    def test_incremental_partition_matches_ordered(self):
+        rnd = random.Random(99)
+        users = list(range(120))
+        current = {g.name: g.members for g in random_groups(rnd, users, 8)}
+
+        partition = IncrementalPartition()
+        for name, members in current.items():
+            partition.add_group(name, members)
+
+        def check():
+            groups = [GroupMembers(name, members) for name, members in current.items()]
+            self.assertEqual(partition.to_ordered(), split_to_disjoint_sets_ordered(groups))
+
+        check()
+        for _ in range(200):
+            name = rnd.choice(list(current.keys()))
+            user = rnd.choice(users)
+            if rnd.random() < 0.5:
+                partition.add_member(name, user)
+                current[name].add(user)
+            else:
+                partition.remove_member(name, user)
+                current[name].discard(user)
+        check()
+
+        partition.add_group('new', users[:10])
+        current['new'] = set(users[:10])
+        partition.remove_group('pol0')
+        del current['pol0']
+        check()
+
+        partition.set_group_members('pol1', users[5:50])
+        current['pol1'] = set(users[5:50])
+        check()
+
+        restored = IncrementalPartition.from_dict(json.loads(json.dumps(partition.to_dict())))
+        self.assertEqual(restored.to_ordered(), partition.to_ordered())
+        restored.add_member('pol2', users[0])
+        partition.add_member('pol2', users[0])
+        self.assertEqual(restored.to_ordered(), partition.to_ordered())
+
+    def test_incremental_partition_is_persisted_by_guid(self):
+        args = SimpleNamespace(persist_cache_dir=None)
+        c.set_cache_backends()
+        guids = ['%02d-guid' % i for i in range(20)]
+        guid_groups = [GroupMembers('pol1', set(guids)), GroupMembers('pol2', set(guids[:6])), GroupMembers('pol3', {guids[0], guids[9]})]
+
+        def run(users, guid_groups):
+            index = PrincipalIndex(users)
+            idx_groups = [GroupMembers(g.name, index.to_idx_set(g.members)) for g in guid_groups]
+            self.assertEqual(update_incremental_partition(args, 'users', idx_groups, index), split_to_disjoint_sets_ordered(idx_groups))
+
+        run(guids, guid_groups)
+        # Next run: a new user shifts the principal ids, one membership changed, one policy removed
+        guid_groups = [GroupMembers('pol1', set(guids) | {'00-new'}), GroupMembers('pol2', set(guids[1:6]))]
+        run(guids + ['00-new'], guid_groups)
+        stored = c.get_cached(c.mk_partition_state_path(args, 'users'))
+        self.assertEqual(stored['groups'], ['pol1', 'pol2'])
+        self.assertIn(sorted(['00-new', '00-guid'] + guids[6:]), [sorted(g['members']) for g in stored['artificial_groups']])
+
+    def test_restricted_partition_matches_partition_of_subset(self):
+        rnd = random.Random(7)
+        users = list(range(200))
+        groups = random_groups(rnd, users, 10)
+        selection = set(rnd.sample(users, 60))
+
+        full_tg, full_ag = split_to_disjoint_sets_ordered(groups)
+        restricted_groups = [GroupMembers(g.name, g.members & selection) for g in groups]
+        self.assertEqual(restrict_disjoint_sets(full_tg, full_ag, selection), split_to_disjoint_sets_ordered(restricted_groups))
+        self.assertEqual(restrict_disjoint_sets(full_tg, full_ag, set()), ({g.name: [] for g in groups}, {}))
+
+    def test_partition_index_lookups(self):
+        rnd = random.Random(11)
+        users = list(range(100))
+        groups = random_groups(rnd, users, 8)
+        plain_groups, artificial_groups = split_to_disjoint_sets_ordered(groups)
+        index = PartitionIndex(plain_groups, artificial_groups)
+        for g in groups:
+            for user in users:
+                gid = index.artificial_group(user)
+                self.assertEqual(gid is not None and index.in_group(gid, g.name), user in g.members)
+        for gid, members in artificial_groups.items():
+            self.assertEqual(index.groups_of(gid), [g.name for g in groups if members <= g.members])
+        self.assertFalse(index.in_group(0, 'unknown'))
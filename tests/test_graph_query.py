@@ -0,0 +1,344 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from msgraph import GraphServiceClient
+from kiota_abstractions.method import Method
+from kiota_abstractions.request_information import RequestInformation
+from msgraph.generated.models.directory_object_collection_response import DirectoryObjectCollectionResponse
+from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+import catharsis.cached_get as c
+from catharsis.cache_backends import MemoryCacheBackend
+from catharsis.graph_query import do_msgraph_sdk_batch_query, iterate_msgraph_sdk_graph_query, get_group_transitive_members, parse_json_to_model, prefetch_group_transitive_members, sync_groups_with_delta, sync_users_with_delta
+from catharsis.utils import prefetch_ca_memberships_with_query
+from catharsis import request_scheduler
+from catharsis.typedefs import AssignedMember, MemberReferences, PrincipalType
+
+GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+
+def group_url(group_id):
+    return '%s/groups/%s/transitiveMembers' % (GRAPH_URL, group_id)
+
+def members_page(user_ids, next_link=None):
+    page = {'value': [{'@odata.type': '#microsoft.graph.user', 'id': user_id} for user_id in user_ids]}
+    page['value'].append({'@odata.type': '#microsoft.graph.device', 'id': 'device'})
+    if next_link:
+        page['@odata.nextLink'] = next_link
+    return page
+
+
+class FakeRequestBuilder(object):
+    def __init__(self, graph, url):
+        self.graph = graph
+        self.url = url
+
+    def to_get_request_information(self, request_configuration=None):
+        request_info = RequestInformation(Method.GET)
+        request_info.url = self.url
+        return request_info
+
+    async def get(self, request_configuration=None):
+        self.graph.gets.append(self.url)
+        if self.url not in self.graph.pages:
+            error = ODataError()
+            error.response_status_code = 404
+            raise error
+        return parse_json_to_model(self.graph.pages[self.url], DirectoryObjectCollectionResponse)
+
+    def with_url(self, url):
+        return FakeRequestBuilder(self.graph, url)
+
+
+class FakeHttpResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+class FakeGraphClient(object):
+    """ Pages by URL, /$batch answered from the same pages """
+    def __init__(self, pages, failing_in_batch=(), throttled_in_batch=None):
+        self.pages = pages
+        self.failing_in_batch = failing_in_batch
+        self.throttled_in_batch = throttled_in_batch or {}  # Times to answer 429 by URL
+        self.gets = []
+        self.batches = []
+        self.batch = self
+        self.request_adapter = self
+        self.groups = SimpleNamespace(by_group_id=lambda group_id: SimpleNamespace(transitive_members=FakeRequestBuilder(self, group_url(group_id))))
+
+    async def to_post_request_information(self, batch):
+        self.pending_batch = batch
+        return RequestInformation(Method.POST)
+
+    async def send_async(self, request_info, parsable_factory, error_map):
+        items = self.pending_batch.requests
+        self.batches.append([item.url for item in items.values()])
+        responses = []
+        for request_id, item in items.items():
+            if self.throttled_in_batch.get(item.url):
+                self.throttled_in_batch[item.url] -= 1
+                responses.append({'id': request_id, 'status': 429, 'headers': {'Retry-After': '0'}})
+            elif item.url in self.failing_in_batch:
+                responses.append({'id': request_id, 'status': 500})
+            elif item.url in self.pages:
+                responses.append({'id': request_id, 'status': 200, 'body': self.pages[item.url]})
+            else:
+                responses.append({'id': request_id, 'status': 404, 'body': {'error': {'code': 'Request_ResourceNotFound'}}})
+        # Responses of a batch come in any order
+        return FakeHttpResponse({'responses': list(reversed(responses))})
+
+
+class FakePagedBuilder(object):
+    """ Pages as (values, next link) by URL, first page at 'first' """
+    def __init__(self, pages, url='first', calls=None):
+        self.pages = pages
+        self.url = url
+        self.calls = calls if calls is not None else []
+
+    async def get(self, request_configuration=None):
+        self.calls.append((self.url, request_configuration))
+        value, next_link = self.pages[self.url]
+        return SimpleNamespace(value=value, odata_next_link=next_link)
+
+    def with_url(self, url):
+        return FakePagedBuilder(self.pages, url, self.calls)
+
+
+class TestIterateQuery(unittest.TestCase):
+
+    def test_pages_are_yielded_one_at_a_time(self):
+        builder = FakePagedBuilder({'first': (['a', 'b'], 'next1'), 'next1': ([], 'next2'), 'next2': (['c'], None)})
+
+        async def run():
+            pages = []
+            async for page in iterate_msgraph_sdk_graph_query(builder, req_conf='conf'):
+                pages.append((page, len(builder.calls)))
+            return pages
+
+        pages = asyncio.run(run())
+        # Next page is fetched only when the previous one is consumed
+        self.assertEqual(pages, [(['a', 'b'], 1), ([], 2), (['c'], 3)])
+        self.assertEqual(builder.calls, [('first', 'conf'), ('next1', None), ('next2', None)])
+
+    def test_single_empty_page(self):
+        builder = FakePagedBuilder({'first': ([], None)})
+
+        async def run():
+            return [page async for page in iterate_msgraph_sdk_graph_query(builder)]
+
+        self.assertEqual(asyncio.run(run()), [[]])
+        self.assertEqual(builder.calls, [('first', None)])
+
+
+class TestBatchQuery(unittest.TestCase):
+
+    def setUp(self):
+        c.set_cache_backends()
+
+    def test_batches_of_20_and_next_links_followed(self):
+        pages = {group_url('g%d' % i): members_page(['u%d' % i]) for i in range(45)}
+        pages[group_url('g3')] = members_page(['u3'], next_link='%s/next/g3' % GRAPH_URL)
+        pages['%s/next/g3' % GRAPH_URL] = members_page(['u3b'], next_link='%s/next/g3b' % GRAPH_URL)
+        pages['%s/next/g3b' % GRAPH_URL] = members_page(['u3c'])
+        client = FakeGraphClient(pages, failing_in_batch=[group_url('g5')])
+        requests = {'g%d' % i: (client.groups.by_group_id('g%d' % i).transitive_members, None) for i in range(45)}
+        requests['gone'] = (client.groups.by_group_id('gone').transitive_members, None)
+
+        results = asyncio.run(do_msgraph_sdk_batch_query(client, requests, DirectoryObjectCollectionResponse))
+        self.assertEqual([len(batch) for batch in client.batches], [20, 20, 6])
+        self.assertEqual(client.gets, ['%s/next/g3' % GRAPH_URL, '%s/next/g3b' % GRAPH_URL])
+        self.assertEqual([o.id for o in results['g3'].value], ['u3', 'device', 'u3b', 'device', 'u3c', 'device'])
+        self.assertEqual((results['g44'].status, [o.id for o in results['g44'].value]), (200, ['u44', 'device']))
+        self.assertEqual(results['g5'], (500, None))
+        self.assertEqual(results['gone'], (404, None))
+
+    def test_throttled_batch_items_are_sent_again(self):
+        pages = {group_url('g%d' % i): members_page(['u%d' % i]) for i in range(25)}
+        client = FakeGraphClient(pages, throttled_in_batch={group_url('g1'): 2, group_url('g2'): 1, group_url('g21'): 1})
+        requests = {'g%d' % i: (client.groups.by_group_id('g%d' % i).transitive_members, None) for i in range(25)}
+        scheduler = request_scheduler.configure_scheduler(SimpleNamespace(graph_concurrency=8))
+
+        results = asyncio.run(do_msgraph_sdk_batch_query(client, requests, DirectoryObjectCollectionResponse))
+        # Throttled items of the first 20 are sent again before the next 20
+        self.assertEqual([len(batch) for batch in client.batches], [20, 2, 1, 5, 1])
+        self.assertEqual(client.batches[1:3], [[group_url('g1'), group_url('g2')], [group_url('g1')]])
+        self.assertEqual(client.batches[4], [group_url('g21')])
+        self.assertEqual(client.gets, [])
+        self.assertTrue(all(r.status == 200 for r in results.values()))
+        self.assertEqual([o.id for o in results['g1'].value], ['u1', 'device'])
+        stats = scheduler.stats()[request_scheduler.GRAPH_ENDPOINT]
+        self.assertEqual((stats['requests'], stats['throttled']), (5, 3))
+        self.assertLess(stats['concurrency_limit'], 8)
+
+    def test_batch_items_throttled_until_max_retries_are_fetched_one_by_one(self):
+        pages = {group_url('g1'): members_page(['u1'])}
+        client = FakeGraphClient(pages, throttled_in_batch={group_url('g1'): 100})
+        args = SimpleNamespace(persist_cache_dir=None, _msgraph_client=client, _tenant_id_checked=True)
+        request_scheduler.configure_scheduler(SimpleNamespace(graph_concurrency=8))
+
+        asyncio.run(prefetch_group_transitive_members(args, ['g1']))
+        self.assertEqual(len(client.batches), request_scheduler.MAX_RETRIES + 1)
+        self.assertEqual(client.gets, [group_url('g1')])
+        self.assertEqual([m.principalId for m in c.get_cached(c.mk_group_result_transitive_path(args, 'g1'))], ['u1'])
+
+    def test_prefetch_matches_unbatched_cache(self):
+        group_ids = ['g%d' % i for i in range(25)] + ['gone']
+        pages = {group_url(group_id): members_page(['u-' + group_id, 'u-shared']) for group_id in group_ids[:-1]}
+        pages[group_url('g1')] = members_page(['u1'], next_link='%s/next/g1' % GRAPH_URL)
+        pages['%s/next/g1' % GRAPH_URL] = members_page(['u1b'])
+
+        def cached_groups(args):
+            return {group_id: c.get_cached(c.mk_group_result_transitive_path(args, group_id)) for group_id in group_ids}
+
+        client = FakeGraphClient(pages, failing_in_batch=[group_url('g7')])
+        args = SimpleNamespace(persist_cache_dir=None, _msgraph_client=client, _tenant_id_checked=True)
+        asyncio.run(prefetch_group_transitive_members(args, group_ids))
+        batched = cached_groups(args)
+        # Only the group failing within the batch is fetched one by one
+        self.assertEqual(client.gets, ['%s/next/g1' % GRAPH_URL, group_url('g7')])
+        self.assertEqual(batched['gone'], [])
+        self.assertEqual([m.principalId for m in batched['g1']], ['u1', 'u1b'])
+
+        c.set_cache_backends()
+        client = FakeGraphClient(pages)
+        args = SimpleNamespace(persist_cache_dir=None, _msgraph_client=client, _tenant_id_checked=True)
+        async def fetch_unbatched():
+            for group_id in group_ids:
+                await get_group_transitive_members(args, group_id)
+        asyncio.run(fetch_unbatched())
+        self.assertEqual(client.batches, [])
+        self.assertEqual(cached_groups(args), batched)
+
+        # Nothing left to prefetch
+        asyncio.run(prefetch_group_transitive_members(args, group_ids))
+        self.assertEqual(client.batches, [])
+
+    def test_groups_via_roles_are_fetched_once(self):
+        pages = {group_url(group_id): members_page(['u-' + group_id]) for group_id in ['g1', 'g2', 'g3']}
+        for batch_size in [20, 1]:
+            c.set_cache_backends()
+            client = FakeGraphClient(pages)
+            args = SimpleNamespace(persist_cache_dir=None, _msgraph_client=client, _tenant_id_checked=True, graph_concurrency=4, graph_batch_size=batch_size)
+            c.set_cached(c.mk_ca_path(args), [{'conditions': {'users': {'includeGroups': ['g1'], 'excludeGroups': ['g3'], 'includeRoles': ['r1']}}}])
+            # g1 is referenced directly and through the role
+            c.set_cached(c.mk_role_assignment_raw_path(args, 'r1'), [AssignedMember('g1', PrincipalType.Group), AssignedMember('g2', PrincipalType.Group)])
+
+            latencies = asyncio.run(prefetch_ca_memberships_with_query(args))
+            self.assertEqual(sorted(latencies.keys()), [('group', 'g1'), ('group', 'g2'), ('group', 'g3'), ('role', 'r1')])
+            fetched = [url for batch in client.batches for url in batch] + client.gets
+            self.assertEqual(sorted(fetched), [group_url('g1'), group_url('g2'), group_url('g3')])
+            self.assertEqual(len(client.batches), 1 if batch_size > 1 else 0)
+
+
+class FakeRequestAdapter(object):
+    """ Request adapter of a real GraphServiceClient, responses by URL """
+    base_url = ''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.urls = []
+
+    def enable_backing_store(self, backing_store_factory):
+        pass
+
+    async def send_async(self, request_info, parsable_factory, error_map):
+        request_info.path_parameters['baseurl'] = self.base_url
+        self.urls.append(request_info.url)
+        return parse_json_to_model(self.pages[request_info.url], parsable_factory)
+
+
+class TestDeltaSync(unittest.TestCase):
+
+    def setUp(self):
+        c.set_cache_backends()
+        self.users_url = GRAPH_URL + '/users/delta()?%24select=id,userPrincipalName,accountEnabled,displayName'
+        self.groups_url = GRAPH_URL + '/groups/delta()?%24select=members'
+
+    def sync(self, sync_function, pages):
+        adapter = FakeRequestAdapter(pages)
+        args = SimpleNamespace(persist_cache_dir=None, _msgraph_client=GraphServiceClient(request_adapter=adapter), _tenant_id_checked=True)
+        asyncio.run(sync_function(args))
+        return args, adapter.urls
+
+    def test_users_full_then_incremental(self):
+        args, urls = self.sync(sync_users_with_delta, {
+            self.users_url: {'value': [{'id': 'u1', 'displayName': 'One', 'userPrincipalName': 'one@x'}], '@odata.nextLink': GRAPH_URL + '/next'},
+            GRAPH_URL + '/next': {'value': [{'id': 'u2', 'displayName': 'Two', 'userPrincipalName': 'two@x'}], '@odata.deltaLink': GRAPH_URL + '/delta1'}
+        })
+        self.assertEqual(urls, [self.users_url, GRAPH_URL + '/next'])
+        self.assertEqual(sorted(c.get_cached(c.mk_all_users_path(args)).keys()), ['u1', 'u2'])
+
+        args, urls = self.sync(sync_users_with_delta, {
+            GRAPH_URL + '/delta1': {'value': [
+                {'id': 'u1', 'displayName': 'Renamed'},
+                {'id': 'u2', '@removed': {'reason': 'changed'}},
+                {'id': 'u3', 'displayName': 'Three', 'userPrincipalName': 'three@x'}
+            ], '@odata.deltaLink': GRAPH_URL + '/delta2'}
+        })
+        users = c.get_cached(c.mk_all_users_path(args))
+        self.assertEqual(urls, [GRAPH_URL + '/delta1'])
+        self.assertEqual(sorted(users.keys()), ['u1', 'u3'])
+        self.assertEqual((users['u1'].displayName, users['u1'].userDetails.upn), ('Renamed', 'one@x'))
+        self.assertEqual(c.get_cached(c.mk_all_users_delta_link_path(args)), GRAPH_URL + '/delta2')
+
+    def cache_groups_and_roles(self, args):
+        user = lambda user_id: AssignedMember(user_id, PrincipalType.User)
+        group = lambda group_id: AssignedMember(group_id, PrincipalType.Group)
+        # g1 has g2 nested, g3 is unrelated
+        c.set_cached(c.mk_group_result_transitive_path(args, 'g1'), [group('g2'), user('u1'), user('u2')])
+        c.set_cached(c.mk_group_result_transitive_path(args, 'g2'), [user('u2')])
+        c.set_cached(c.mk_group_result_transitive_path(args, 'g3'), [user('u3')])
+        # Expanded role entries of earlier versions (lists) and current references
+        for role_id, assigned in [('r1', group('g1')), ('r2', group('g2')), ('r3', group('g3'))]:
+            c.set_cached(c.mk_role_assignment_raw_path(args, role_id), [assigned, user('u9')])
+        c.set_cached(c.mk_role_result_transitive_path(args, 'r1'), [user('u1'), user('u2'), user('u9')])
+        c.set_cached(c.mk_role_result_transitive_path(args, 'r2'), MemberReferences(entries=[group('g2'), user('u9')]))
+        c.set_cached(c.mk_role_result_transitive_path(args, 'r3'), [user('u3'), user('u9')])
+
+    def cached_entries(self, args):
+        return ([group_id for group_id in ['g1', 'g2', 'g3'] if c.is_cached(c.mk_group_result_transitive_path(args, group_id))],
+                [role_id for role_id in ['r1', 'r2', 'r3'] if c.is_cached(c.mk_role_result_transitive_path(args, role_id))])
+
+    def test_groups_first_run_invalidates_cached_entries(self):
+        self.cache_groups_and_roles(SimpleNamespace(persist_cache_dir=None))
+        latest_url = self.groups_url + '&$deltatoken=latest'
+        args, urls = self.sync(sync_groups_with_delta, {latest_url: {'value': [], '@odata.deltaLink': GRAPH_URL + '/delta1'}})
+        self.assertEqual(urls, [latest_url])
+        self.assertEqual(self.cached_entries(args), ([], ['r2']))
+        self.assertEqual(c.get_cached(c.mk_groups_delta_link_path(args)), GRAPH_URL + '/delta1')
+
+    def test_groups_changes_invalidate_nesting_groups_and_legacy_roles(self):
+        args = SimpleNamespace(persist_cache_dir=None)
+        self.cache_groups_and_roles(args)
+        c.set_cached(c.mk_groups_delta_link_path(args), GRAPH_URL + '/delta1')
+        args, urls = self.sync(sync_groups_with_delta, {
+            GRAPH_URL + '/delta1': {'value': [{'id': 'g2', 'members@delta': [{'id': 'u4'}]}], '@odata.deltaLink': GRAPH_URL + '/delta2'}
+        })
+        self.assertEqual(urls, [GRAPH_URL + '/delta1'])
+        # g1 has g2 nested, r1 has g1 assigned, r2 only references the group entries
+        self.assertEqual(self.cached_entries(args), (['g3'], ['r2', 'r3']))
+        self.assertEqual(c.get_cached(c.mk_groups_delta_link_path(args)), GRAPH_URL + '/delta2')
+
+        args, urls = self.sync(sync_groups_with_delta, {GRAPH_URL + '/delta2': {'value': [], '@odata.deltaLink': GRAPH_URL + '/delta3'}})
+        self.assertEqual(self.cached_entries(args), (['g3'], ['r2', 'r3']))
+
+    def test_groups_changes_with_expired_entries(self):
+        memory = MemoryCacheBackend()
+        c.set_cache_backends(memory, ttls={'groups': 3600, 'roles': 3600})
+        args = SimpleNamespace(persist_cache_dir=None)
+        self.cache_groups_and_roles(args)
+        c.set_cached(c.mk_groups_delta_link_path(args), GRAPH_URL + '/delta1')
+        for key in [c.mk_group_result_transitive_path(args, 'g1'), c.mk_role_assignment_raw_path(args, 'r3')]:
+            value, _ = memory.entries[key]
+            memory.entries[key] = (value, 0.0)
+        args, urls = self.sync(sync_groups_with_delta, {
+            GRAPH_URL + '/delta1': {'value': [{'id': 'g2', 'members@delta': [{'id': 'u4'}]}], '@odata.deltaLink': GRAPH_URL + '/delta2'}
+        })
+        # Members of g1 and assignments of r3 are unknown
+        self.assertEqual(self.cached_entries(args), (['g3'], ['r2']))
+        self.assertEqual(c.get_cached(c.mk_groups_delta_link_path(args)), GRAPH_URL + '/delta2')
@@ -0,0 +1,47 @@
+import time
+import unittest
+from azure.core.credentials import AccessToken
+from catharsis.ms_credential import CachingTokenCredential, TOKEN_REFRESH_MARGIN
+
+class FakeCredential(object):
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.calls = []
+
+    def get_token(self, *scopes, **kwargs):
+        self.calls.append((scopes, kwargs))
+        return AccessToken('token%d' % len(self.calls), int(time.time() + self.lifetime))
+
+class TestCachingTokenCredential(unittest.TestCase):
+
+    def test_token_is_reused_until_expiry(self):
+        fake = FakeCredential(lifetime=3600)
+        credential = CachingTokenCredential(fake)
+        self.assertEqual(credential.get_token('scope-a').token, 'token1')
+        self.assertEqual(credential.get_token('scope-a').token, 'token1')
+        self.assertEqual(credential.get_token('scope-b').token, 'token2')
+        self.assertEqual(len(fake.calls), 2)
+
+    def test_token_about_to_expire_is_refreshed(self):
+        fake = FakeCredential(lifetime=TOKEN_REFRESH_MARGIN - 10)
+        credential = CachingTokenCredential(fake)
+        self.assertEqual(credential.get_token('scope-a').token, 'token1')
+        self.assertEqual(credential.get_token('scope-a').token, 'token2')
+
+    def test_claims_challenge_bypasses_cache(self):
+        fake = FakeCredential(lifetime=3600)
+        credential = CachingTokenCredential(fake)
+        credential.get_token('scope-a')
+        self.assertEqual(credential.get_token('scope-a', claims='{"access_token": {}}').token, 'token2')
+        self.assertEqual(credential.get_token('scope-a', claims='{"access_token": {}}').token, 'token3')
+        self.assertEqual(credential.get_token('scope-a').token, 'token1')
+        self.assertEqual(fake.calls[1], (('scope-a',), {'claims': '{"access_token": {}}'}))
+
+    def test_cae_tokens_are_kept_apart(self):
+        fake = FakeCredential(lifetime=3600)
+        credential = CachingTokenCredential(fake)
+        self.assertEqual(credential.get_token('scope-a').token, 'token1')
+        self.assertEqual(credential.get_token('scope-a', enable_cae=True).token, 'token2')
+        self.assertEqual(credential.get_token('scope-a', enable_cae=True).token, 'token2')
+        self.assertEqual(credential.get_token('scope-a').token, 'token1')
+        self.assertEqual(fake.calls[1], (('scope-a',), {'enable_cae': True}))
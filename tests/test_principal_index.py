@@ -0,0 +1,48 @@
+import unittest
+from catharsis.principal_index import PrincipalIndex, PrincipalDisplayIndex, TargetedPrincipals
+from catharsis.typedefs import Principal, PrincipalType, UserPrincipalDetails
+from catharsis.disjoint_sets import *
+
+class TestPrincipalIndex(unittest.TestCase):
+
+    def test_ids_follow_guid_order(self):
+        index = PrincipalIndex(['c-3', 'a-1', 'b-2', 'a-1'])
+        self.assertEqual(len(index), 3)
+        self.assertEqual([index.to_idx(g) for g in ['a-1', 'b-2', 'c-3']], [0, 1, 2])
+        self.assertEqual(index.to_guid(2), 'c-3')
+
+    def test_unknown_guids_are_dropped(self):
+        index = PrincipalIndex(['a-1', 'b-2'])
+        self.assertEqual(index.to_idx_set(['b-2', 'removed']), {1})
+        self.assertEqual(index.to_guid_set({0, 1}), {'a-1', 'b-2'})
+        self.assertNotIn('removed', index)
+        self.assertEqual(index.unknown_guids, {'removed'})
+
+    def test_partition_over_ids_matches_partition_over_guids(self):
+        guids = ['%02d-guid' % i for i in range(1, 21)]
+        index = PrincipalIndex(guids)
+        guid_groups = [
+            GroupMembers('pol1', set(guids)),
+            GroupMembers('pol2', set(guids[:6])),
+            GroupMembers('pol4', set([guids[3], guids[9], guids[10]]))
+        ]
+        idx_groups = [GroupMembers(g.name, index.to_idx_set(g.members)) for g in guid_groups]
+
+        guid_tg, guid_ag = split_to_disjoint_sets_ordered(guid_groups)
+        idx_tg, idx_ag = split_to_disjoint_sets_by_signature(idx_groups)
+        self.assertEqual(idx_tg, guid_tg)
+        self.assertEqual({k: index.to_guid_set(v) for k, v in idx_ag.items()}, guid_ag)
+
+    def test_targeted_principals_are_formatted_lazily(self):
+        users = {guid: Principal(id=guid, displayName=guid, accountEnabled=True, raw=None, usertype=PrincipalType.User,
+                                 userDetails=UserPrincipalDetails(upn=guid + '@example.com')) for guid in ['a-1', 'b-2']}
+        display_index = PrincipalDisplayIndex(users)
+        all_users = TargetedPrincipals(display_index)
+        self.assertTrue(all_users.all)
+        self.assertEqual(len(all_users), 2)
+        self.assertEqual(display_index.names, {})
+        self.assertEqual(list(all_users), ['User: a-1@example.com', 'User: b-2@example.com'])
+        self.assertEqual(list(TargetedPrincipals(display_index, ['b-2', 'gone'])), ['User: b-2@example.com', 'Principal removed? gone'])
+        # All users of an index over all principals
+        only_b = TargetedPrincipals(display_index, all_ids={'b-2'})
+        self.assertEqual((only_b.all, len(only_b), list(only_b)), (True, 1, ['User: b-2@example.com']))
@@ -0,0 +1,76 @@
+import asyncio
+import unittest
+import httpx
+from catharsis.graph_query import send_checked
+from catharsis.request_scheduler import RequestScheduler, get_throttling_info, parse_retry_after
+
+class FakeThrottled(Exception):
+    def __init__(self, status, headers=None):
+        self.response_status_code = status
+        self.response_headers = headers
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def test_throttling_info(self):
+        self.assertEqual(get_throttling_info(FakeThrottled(429, {'Retry-After': '3'})), (True, 3.0))
+        self.assertEqual(get_throttling_info(FakeThrottled(503)), (True, None))
+        self.assertEqual(get_throttling_info(FakeThrottled(404, {'Retry-After': '3'})), (False, None))
+        self.assertEqual(parse_retry_after({'retry-after': ['0']}), 0.0)
+
+    def test_retries_throttled_and_shrinks_concurrency(self):
+        calls = []
+        async def fn():
+            calls.append(1)
+            if len(calls) < 3:
+                raise FakeThrottled(429, {'Retry-After': '0'})
+            return 'ok'
+
+        async def run():
+            scheduler = RequestScheduler(max_concurrency=8)
+            return await scheduler.run('graph', fn), scheduler.stats()['graph']
+
+        result, stats = asyncio.run(run())
+        self.assertEqual(result, 'ok')
+        self.assertEqual((stats['requests'], stats['throttled'], stats['retried'], stats['in_flight']), (3, 2, 2, 0))
+        self.assertEqual(stats['concurrency_limit'], 2)
+
+    def test_native_responses_are_retried_when_throttled(self):
+        statuses = [429, 503, 200]
+        async def send():
+            return httpx.Response(statuses.pop(0), headers={'Retry-After': '0'}, request=httpx.Request('GET', 'https://graph.microsoft.com/v1.0/$batch'))
+
+        async def run():
+            scheduler = RequestScheduler()
+            return await scheduler.run('graph', send_checked, send), scheduler.stats()['graph']
+
+        response, stats = asyncio.run(run())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((stats['requests'], stats['throttled'], stats['retried']), (3, 2, 2))
+
+    def test_gives_up_after_max_retries(self):
+        async def fn():
+            raise FakeThrottled(503, {'Retry-After': '0'})
+
+        async def run():
+            scheduler = RequestScheduler(max_retries=1)
+            with self.assertRaises(FakeThrottled):
+                await scheduler.run('arm', fn)
+            return scheduler.stats()['arm']
+
+        stats = asyncio.run(run())
+        self.assertEqual((stats['throttled'], stats['retried'], stats['failed']), (2, 1, 1))
+
+    def test_limits_in_flight_requests(self):
+        peak = [0, 0]
+        async def fn():
+            peak[0] += 1
+            peak[1] = max(peak)
+            await asyncio.sleep(0.01)
+            peak[0] -= 1
+
+        async def run():
+            scheduler = RequestScheduler(max_concurrency=3)
+            await asyncio.gather(*[scheduler.run('graph', fn) for _ in range(10)])
+
+        asyncio.run(run())
+        self.assertEqual(peak[1], 3)
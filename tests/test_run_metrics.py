@@ -0,0 +1,33 @@
+import asyncio
+import unittest
+import catharsis.cached_get as c
+from catharsis import run_metrics
+from catharsis.graph_query import cached_query
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        run_metrics.reset()
+        c.set_cache_backends()
+
+    def test_percentiles(self):
+        values = sorted(float(v) for v in range(1, 101))
+        self.assertEqual([run_metrics.percentile(values, p) for p in [50, 90, 99, 100]], [50.0, 90.0, 99.0, 100.0])
+        self.assertEqual(run_metrics.percentile([3.0], 50), 3.0)
+
+    def test_fetches_are_counted_by_key_family(self):
+        async def fetch():
+            run_metrics.add_to_current('pages', 2)
+            return ['member']
+
+        async def run():
+            await cached_query(None, 'mem:/group_g1.json', fetch)
+            await cached_query(None, 'mem:/group_g1.json', fetch)
+            await cached_query(None, 'mem:/role_r1_resolved.json', fetch)
+
+        asyncio.run(run())
+        report = run_metrics.get_metrics().to_dict()
+        self.assertEqual({k: v for k, v in report['groups'].items() if k != 'fetch_seconds'}, {'hits': 1, 'misses': 1, 'pages': 2, 'writes': 1})
+        self.assertEqual(report['groups']['fetch_seconds']['count'], 1)
+        self.assertEqual(report['roles']['pages'], 2)
+        self.assertNotIn('other', report)
@@ -3,6 +3,7 @@ import unittest
 from catharsis.disjoint_sets import *
 from catharsis.typedefs import *
 import json
+from catharsis.cache_serialization import dumps, loads, BINARY_MAGIC
 
 class TestStringMethods(unittest.TestCase):
 
@@ -22,3 +23,28 @@ class TestStringMethods(unittest.TestCase):
         for attribute in ['id', 'displayName', 'accountEnabled', 'raw', 'usertype', 'userDetails']:
             self.assertEqual(getattr(user, attribute), getattr(deserialized, attribute))
 
+class TestBinaryCacheFormat(unittest.TestCase):
+
+    def test_typed_values_round_trip(self):
+        user = Principal(id='u1', displayName='John Doe', accountEnabled=True, raw={'~odd': 1, 'x': [1, None]},
+                         usertype=PrincipalType.User, userDetails=UserPrincipalDetails(upn='john.doe@domain.com'))
+        sp = Principal(id='s1', displayName='App', accountEnabled=False, raw=None, usertype=PrincipalType.ServicePrincipal,
+                       spDetails=ServicePrincipalDetails(ServicePrincipalType.Application, None, 'Publisher'))
+        values = [
+            {'u1': user, 's1': sp},
+            [AssignedMember('g1', PrincipalType.Group), AssignedMember('u1', PrincipalType.User)],
+            Tenant('t1', 'Tenant', 'example.com'),
+            [PrincipalType.User, None, 'x'],
+            {'link': 'https://graph', 'n': 1},
+            [],
+            None
+        ]
+        for value in values:
+            data = dumps(value, 'binary')
+            self.assertTrue(data.startswith(BINARY_MAGIC))
+            self.assertEqual(loads(data), value)
+
+    def test_json_is_still_read(self):
+        members = [AssignedMember('g1', PrincipalType.Group)]
+        self.assertEqual(loads(json.dumps(members, cls=CatharsisEncoder).encode('utf-8')), members)
+        self.assertEqual(loads(dumps(members, 'json')), members)
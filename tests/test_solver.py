@@ -0,0 +1,64 @@
+import argparse
+import itertools
+import math
+import unittest
+from catharsis.solver import *
+from catharsis.solver import cp
+from policy_fixtures import mk_general_info, policy
+
+POLICIES = [
+    policy('mfa', [0, 1, 2, 3], [0, 1, 2], ['mfa']),
+    policy('legacy auth', [0, 1, 2, 3], [0, 1, 2], ['block'], client_app_types=['exchangeActiveSync', 'other']),
+    policy('device for app3', [1, 2], [1], ['compliantDevice', 'mfa'], operator='AND'),
+    policy('risky sign-ins', [0, 1, 2, 3], [0, 1, 2], ['block'], signin_risk=['high']),
+]
+
+GENERAL_INFO = mk_general_info(
+    {0: set(range(10)), 1: set(range(10, 13)), 2: {13}, 3: {14}},
+    {0: {'app1', 'app2'}, 1: {'app3'}, 2: {'RestOfTheApps'}},
+    POLICIES)
+
+def brute_force_costs(args, policyModels, generalInfo):
+    """ Cheapest cost per scenario, controls tried one combination at a time """
+    controls = sorted(c for c in generalInfo.seen_grant_controls if c != 'block')
+    signin_levels = sorted(set().union(*[pm.condition_signin_risk_levels for pm in policyModels]) | {'none'})
+    costs = []
+    for uag, aag, client_app_type, signin_risk in itertools.product(
+            sorted(generalInfo.disjoint_artificial_user_groups), sorted(generalInfo.disjoint_artificial_app_groups),
+            ALL_CLIENT_APP_TYPES, signin_levels):
+        applying = [pm for pm in policyModels
+                    if uag in pm.condition_usergroups and aag in pm.condition_applications
+                    and client_app_type in pm.condition_client_app_types
+                    and (not pm.condition_signin_risk_levels or signin_risk in pm.condition_signin_risk_levels)]
+        options = []
+        for chosen in itertools.product([False, True], repeat=len(controls)):
+            have = {c for c, x in zip(controls, chosen) if x}
+            if all((any if pm.grant_operator == 'OR' else all)([c in have for c in pm.grant_controls if c != 'block']) for pm in applying):
+                options.append(math.prod(get_builtin_control_cost(args, c, generalInfo) if c in have else 1 for c in controls))
+        if options:
+            costs.append(get_uag_cost(args, uag, generalInfo) * get_aag_cost(args, aag, generalInfo)
+                         * get_client_app_type_cost(args, client_app_type) * get_signin_risk_cost(args, signin_risk) * min(options))
+    return sorted(costs)
+
+
+class TestEnumerationSolver(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        args = argparse.Namespace(number_of_solutions=8, workers=1)
+        solutions = enumerate_cheapest_scenarios(args, POLICIES, GENERAL_INFO)
+        self.assertEqual([s.cost for s in solutions], brute_force_costs(args, POLICIES, GENERAL_INFO)[:8])
+        self.assertEqual([math.prod(s.cost_parts) for s in solutions], [s.cost for s in solutions])
+        self.assertEqual(solutions[0].cell, ScenarioCell(2, 2, 'browser', None, 'none'))
+        self.assertEqual(solutions[0].controls, ['mfa'])
+        self.assertNotIn('high', [s.cell.signin_risk for s in solutions])
+
+    def test_workers_give_same_solutions(self):
+        one = enumerate_cheapest_scenarios(argparse.Namespace(number_of_solutions=20, workers=1), POLICIES, GENERAL_INFO)
+        three = enumerate_cheapest_scenarios(argparse.Namespace(number_of_solutions=20, workers=3), POLICIES, GENERAL_INFO)
+        self.assertEqual(one, three)
+
+    @unittest.skipIf(cp is None, 'cpmpy not available')
+    def test_optimum_matches_ortools(self):
+        args = argparse.Namespace(number_of_solutions=1, workers=1)
+        self.assertEqual(translate_policymodels_to_task(args, POLICIES, GENERAL_INFO),
+                         [s.cost for s in enumerate_cheapest_scenarios(args, POLICIES, GENERAL_INFO)])
@@ -0,0 +1,53 @@
+import io
+import json
+import unittest
+from catharsis.principal_index import PrincipalIndex
+from catharsis.settings import META_APP_ALL_UNMETIONED_APPS
+from catharsis.whatif import *
+from policy_fixtures import mk_general_info, policy
+
+INDEX = PrincipalIndex(['u-1', 'u-2', 'u-3'])
+POLICIES = [
+    policy('mfa', [0, 1], [0, 1], ['mfa', 'compliantDevice'], session_controls=['session_signInFrequency']),
+    policy('legacy', [0, 1], [0, 1], ['block'], client_app_types=['exchangeActiveSync', 'other']),
+    policy('risky app-2', [1], [1], ['mfa'], signin_risk=['high']),
+]
+
+GENERAL_INFO = mk_general_info(
+    {0: {0, 1}, 1: {2}},
+    {0: {'app-1', META_APP_ALL_UNMETIONED_APPS}, 1: {'app-2'}},
+    POLICIES, principal_index=INDEX)
+
+class TestWhatIf(unittest.TestCase):
+
+    def test_scenarios_are_evaluated_per_cell(self):
+        evaluator = WhatIfEvaluator(POLICIES, GENERAL_INFO)
+        results = list(evaluator.evaluate_all([
+            WhatIfScenario('u-3', 'app-2', 'browser', signin_risk='high'),
+            WhatIfScenario('u-1', 'unmentioned-app', 'other'),
+            WhatIfScenario('u-2', 'app-1', 'other'),
+            WhatIfScenario('removed-user', 'app-1', 'browser'),
+        ]))
+        self.assertEqual((results[0].user_group, results[0].app_group), (1, 1))
+        self.assertEqual(results[0].policies, ['mfa', 'risky app-2'])
+        self.assertEqual(results[0].grant_controls, ['compliantDevice|mfa', 'mfa'])
+        self.assertEqual(results[0].session_controls, ['session_signInFrequency'])
+        self.assertEqual((results[1].app_group, results[1].blocked), (0, True))
+        self.assertEqual(results[2][1:], results[1][1:])
+        self.assertEqual(results[3].user_group, None)
+        self.assertEqual(results[3].policies, [])
+        self.assertEqual(len(evaluator.cells), 2)
+
+    def test_sign_in_log_records_are_streamed(self):
+        signins = io.StringIO('\n'.join(json.dumps(r) for r in [
+            {'userId': 'u-3', 'appId': 'app-2', 'clientAppUsed': 'Browser', 'riskLevelAggregated': 'hidden', 'riskLevelDuringSignIn': 'high'},
+            {'userId': 'u-1', 'appId': 'app-1', 'clientAppUsed': 'IMAP4'},
+        ]))
+        scenarios = list(read_scenarios(signins, 'jsonl'))
+        self.assertEqual(scenarios, [WhatIfScenario('u-3', 'app-2', 'browser', 'none', 'high'), WhatIfScenario('u-1', 'app-1', 'other')])
+
+        out_f = io.StringIO()
+        scenarios_csv = io.StringIO('principal_id,app_id,client_app_type\nu-1,app-1,browser\n')
+        evaluator = WhatIfEvaluator(POLICIES, GENERAL_INFO)
+        self.assertEqual(write_results(out_f, evaluator.evaluate_all(read_scenarios(scenarios_csv, 'csv')), 'csv'), 1)
+        self.assertEqual(out_f.getvalue().splitlines()[1], 'u-1,app-1,browser,none,none,0,0,mfa,False,compliantDevice|mfa,session_signInFrequency')